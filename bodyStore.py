@@ -0,0 +1,74 @@
+import hashlib
+import zlib
+from collections import OrderedDict
+
+
+"""
+Moves a response body of at least minSize characters out of a HAR content object.
+The content keeps the sha256 of the body as _bodyRef and the body is added to bodies
+by its sha256, so a body is stored once however many HARs include it.
+minSize 0 keeps every body in the HAR.
+"""
+def extractBody(content, minSize, bodies):
+
+  if(minSize <= 0 or 'text' not in content or len(content['text']) < minSize):
+    return None
+  text = content.pop('text')
+  bodyRef = hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+  bodies[bodyRef] = {'text': text, 'encoding': content.get('encoding')}
+  content['_bodyRef'] = bodyRef
+  return bodyRef
+
+
+"""
+Returns if the body of a response is kept in the HAR, the other responses are
+recorded with their metadata only:
+ - mimeType is the content type header, size the body size in bytes or None if not known
+ - bodyTypes is a tuple of the lower case content type prefixes of the bodies kept,
+   an empty tuple keeps every type
+ - bodyMaxSize is the largest body kept, 0 means no limit
+Bodies without a content type are kept, the browser sniffs their type.
+"""
+def isBodyCaptured(mimeType, size, bodyTypes, bodyMaxSize):
+
+  if(len(bodyTypes) > 0 and mimeType != '' and not mimeType.lower().startswith(bodyTypes)):
+    return False
+  if(bodyMaxSize > 0 and size is not None and size > bodyMaxSize):
+    return False
+  return True
+
+
+class BodyLoader:
+
+
+  """
+  Loads the bodies referenced by HAR entries from the har_bodies table.
+  The most recently used bodies are cached, the same scripts are referenced by
+  many HARs.
+  """
+  def __init__(self, db, cacheSize = 1000):
+
+    self.db = db
+    self.cacheSize = cacheSize
+    self.cache = OrderedDict()
+
+
+  def getBodies(self, bodyRefs):
+
+    bodies = {}
+    missing = []
+    for bodyRef in bodyRefs:
+      if(bodyRef in self.cache):
+        self.cache.move_to_end(bodyRef)
+        bodies[bodyRef] = self.cache[bodyRef]
+      else:
+        missing.append(bodyRef)
+    if(len(missing) > 0):
+      with self.db.cursor() as cur:
+        cur.execute("SELECT sha256, body, encoding FROM har_bodies WHERE sha256 = ANY(%s)", (missing,))
+        for bodyRef, body, encoding in cur.fetchall():
+          bodies[bodyRef] = {'text': zlib.decompress(body).decode('utf-8', 'surrogatepass'), 'encoding': encoding}
+          self.cache[bodyRef] = bodies[bodyRef]
+      while(len(self.cache) > self.cacheSize):
+        self.cache.popitem(last = False)
+    return bodies
@@ -0,0 +1,166 @@
+import os
+import time
+import csv
+import multiprocessing
+from collections import deque
+
+
+"""
+Available memory of the host in MB, None if /proc/meminfo can't be read
+"""
+def getFreeMemoryMb():
+
+  try:
+    with open('/proc/meminfo') as fin:
+      for line in fin:
+        if(line.startswith('MemAvailable:')):
+          return int(line.split()[1])/1024
+  except OSError:
+    pass
+  return None
+
+
+"""
+One minute load average divided by the number of cpus
+"""
+def getLoadPerCpu():
+
+  return os.getloadavg()[0]/os.cpu_count()
+
+
+class ConcurrencyController:
+
+
+  """
+  Decides how many crawler workers should be active.
+  The number of workers grows additively while the host has spare cpu and memory and
+  pages load fine, and shrinks multiplicatively as soon as one of the limits is crossed:
+   - load per cpu above maxLoadPerCpu
+   - available memory below minFreeMemoryMb
+   - median page load time of the recent visits above maxPageLoadTime
+   - share of failed or timed out visits above maxFailureRate
+  Every decision is appended to the concurrencyLog csv file so the policy can be tuned.
+  """
+  def __init__(self, runConfig, maxWorkers):
+
+    self.maxWorkers = maxWorkers
+    self.minWorkers = min(maxWorkers, runConfig.minThreads)
+    self.active = self.minWorkers
+    self.maxLoadPerCpu = runConfig.maxLoadPerCpu
+    self.minFreeMemoryMb = runConfig.minFreeMemoryMb
+    self.maxPageLoadTime = runConfig.maxPageLoadTime
+    self.maxFailureRate = runConfig.maxFailureRate
+    self.interval = runConfig.concurrencyInterval
+    self.logFile = runConfig.concurrencyLog
+    self.increaseStep = max(1, int(maxWorkers/10))
+    self.minVisits = 10
+    self.lastDecision = time.time()
+    # Visits of the last two intervals: (time, page load time, failed)
+    self.visits = deque()
+
+
+  def recordVisit(self, pageLoadTime, failed):
+
+    self.visits.append((time.time(), pageLoadTime, failed))
+
+
+  def getVisitStats(self):
+
+    while(len(self.visits) > 0 and self.visits[0][0] < time.time() - 2*self.interval):
+      self.visits.popleft()
+    if(len(self.visits) < self.minVisits):
+      return None, None
+    loadTimes = sorted([x[1] for x in self.visits if x[1] is not None])
+    medianLoadTime = None
+    if(len(loadTimes) > 0):
+      medianLoadTime = loadTimes[int(len(loadTimes)/2)]
+    failureRate = sum([1 for x in self.visits if x[2]])/len(self.visits)
+    return medianLoadTime, failureRate
+
+
+  """
+  Returns the new number of active workers if it is time for a decision, None otherwise
+  """
+  def decide(self):
+
+    if(time.time() - self.lastDecision < self.interval):
+      return None
+    self.lastDecision = time.time()
+    loadPerCpu = getLoadPerCpu()
+    freeMemoryMb = getFreeMemoryMb()
+    medianLoadTime, failureRate = self.getVisitStats()
+
+    reasons = []
+    if(loadPerCpu > self.maxLoadPerCpu):
+      reasons.append('cpu load')
+    if(freeMemoryMb is not None and freeMemoryMb < self.minFreeMemoryMb):
+      reasons.append('memory')
+    if(medianLoadTime is not None and medianLoadTime > self.maxPageLoadTime):
+      reasons.append('page load time')
+    if(failureRate is not None and failureRate > self.maxFailureRate):
+      reasons.append('failure rate')
+
+    previous = self.active
+    if(len(reasons) > 0):
+      self.active = max(self.minWorkers, min(self.active-1, int(self.active*0.75)))
+      reason = 'decrease: ' + ', '.join(reasons)
+    # Only grow if there is clear headroom, otherwise the worker count would oscillate
+    elif(loadPerCpu < 0.8*self.maxLoadPerCpu and
+         (freeMemoryMb is None or freeMemoryMb > 1.5*self.minFreeMemoryMb) and
+         (failureRate is None or failureRate < self.maxFailureRate/2)):
+      self.active = min(self.maxWorkers, self.active+self.increaseStep)
+      reason = 'increase: headroom'
+    else:
+      reason = 'hold'
+    self.logDecision(previous, loadPerCpu, freeMemoryMb, medianLoadTime, failureRate, reason)
+    return self.active
+
+
+  def logDecision(self, previous, loadPerCpu, freeMemoryMb, medianLoadTime, failureRate, reason):
+
+    row = [time.time(), previous, self.active, round(loadPerCpu,2), freeMemoryMb,
+           medianLoadTime, failureRate, len(self.visits), reason]
+    print('Concurrency: ', previous, ' -> ', self.active, ' (', reason, ')')
+    if(self.logFile == ''):
+      return
+    writeHeader = not os.path.exists(self.logFile)
+    with open(self.logFile, mode = 'a', newline = '') as fout:
+      writer = csv.writer(fout)
+      if(writeHeader):
+        writer.writerow(['time','previous_workers','workers','load_per_cpu','free_memory_mb',
+                         'median_page_load_time','failure_rate','visits','reason'])
+      writer.writerow(row)
+
+
+class WorkerPause:
+
+
+  """
+  Shared between the crawler and its workers to pause the workers above the
+  number of active workers. Workers are paused per work type in proportion to
+  the number of workers of the type. Once a worker found its queue drained the
+  workers of that type are not paused anymore so they can finish.
+  """
+  def __init__(self, numTypes, active, poolSize):
+
+    self.active = multiprocessing.Value('i', active)
+    self.drained = multiprocessing.Array('b', numTypes)
+    self.poolSize = poolSize
+
+
+  def setActive(self, active):
+
+    self.active.value = active
+
+
+  def setDrained(self, typeIndex):
+
+    self.drained[typeIndex] = 1
+
+
+  def isPaused(self, slot):
+
+    if(self.drained[slot['typeIndex']]):
+      return False
+    typeActive = max(1, int(round(slot['typeSize']*self.active.value/self.poolSize)))
+    return slot['rank'] >= typeActive
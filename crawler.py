@@ -1,7 +1,6 @@
 from multiprocessing import Process
 from multiprocessing import Queue
 import multiprocessing
-import subprocess
 import time
 import os
 from pyvirtualdisplay import Display
@@ -9,66 +8,133 @@ import traceback
 import logging
 import random
 import shutil
+import queue
+import tempfile
+from collections import deque
+from urllib.parse import urlparse
 
 from linkFollow import LinkFollow
+from sharedBrowser import SharedBrowser
 from database import RedirectDB
-from proxy import Proxy
+from proxy import Proxy, ProxyTenant
+from leaseQueue import LeaseQueue, releaseDeadLeases
+from scheduler import interleaveJobs
+from batchDNS import resolveDns
+from redirectChainExtractor import getDomain
+from concurrency import ConcurrencyController, WorkerPause
+from warmStandby import WarmStandby
+from processCleanup import killProcessGroup, waitForProcessGroups, getDisplayServerPid, stopDisplayServer
+from metrics import CrawlMetrics, MetricsServer
+from fastStart import prepareTemplate
+
+
+TYPO_TARGET_TYPES = ['typosquatting','pharmaTypos','maliciousNsTypos',
+                     'topAlexaTypos','midAlexaTypos','tailAlexaTypos']
+OTHER_TARGET_TYPES = ['pharma','copyright','phishTank','stonyUrlShorteners','alexa',
+                      'surbl-cr','surbl-abuse','surbl-mw','surbl-ph','listTest']
+# Times a worker slot is restarted after its worker died without reporting, then it is given up
+MAX_DEAD_RESTARTS = 3
+
+
+"""
+Values of a spacing key for each job, None where the key doesn't apply.
+Supported keys: nameServer, registeredDomain, ip and targetType.
+"""
+def getSpacingValues(db,jobs,key,nameServers,dnsIntensity):
+
+  if(key == 'nameServer'):
+    return [nameServers.get(job[0]) for job in jobs]
+  elif(key == 'registeredDomain'):
+    return [getDomain(job[4]) for job in jobs]
+  elif(key == 'targetType'):
+    return [job[2] for job in jobs]
+  elif(key == 'ip'):
+    hostnames = [urlparse(job[4]).hostname for job in jobs]
+    records = resolveDns(list(set([x for x in hostnames if x is not None])),('A',),dnsIntensity)
+    ips = []
+    for hostname in hostnames:
+      if(hostname in records and 'as' in records[hostname]):
+        ips.append(sorted(records[hostname]['as'])[0])
+      else:
+        ips.append(None)
+    return ips
+  else:
+    print('Unknown spacing key: ', key)
+    return [None] * len(jobs)
 
 
 """
 Schedule the order in which target URLs should be visited to decrease the 
 probability of being detected. Each job is an URL to be visited.
- - typo domains using the same name servers are visited as far apart as possible
- - different target types (like pharma and typo) are visited in an alternating fashion
+ - typo domains using the same name servers are spread as evenly as possible
+ - different target types (like pharma and typo) are spread evenly too, so they alternate
+ - jobs sharing a value of a spacing rule key (like the name server or the registered domain)
+   are kept at least the rule's distance apart whenever possible
+spacingRules is a list of {'key':..., 'distance':...} dicts, see getSpacingValues for the keys.
+Schedules of the same jobs with different seedOffsets have different orders.
 """
-def scheduleJobs(db,jobs,day):
+def scheduleJobs(db,jobs,day,spacingRules=[],dnsIntensity=4,seedOffset=0):
 
   print('Number of jobs: ',len(jobs))
-  notTypoJobs = []
-  typoJobs = []
-  allJobs = []
-  typoIds = {}
-  # Separate different types of jobs.
-  for job in jobs:
-    if(job[2] in ['pharma','copyright','phishTank','stonyUrlShorteners','alexa',
-                  'surbl-cr','surbl-abuse','surbl-mw','surbl-ph','listTest']):
-      notTypoJobs.append(job)
-    elif(job[2] in ['typosquatting','pharmaTypos','maliciousNsTypos',
-                    'topAlexaTypos','midAlexaTypos','tailAlexaTypos']):
-      typoIds[job[0]] = job
-  random.seed(int(day)*len(jobs))
-  random.shuffle(notTypoJobs)     
-  # Get name servers for typo jobs.
+  jobs = [job for job in jobs if job[2] in TYPO_TARGET_TYPES or job[2] in OTHER_TARGET_TYPES]
+  if(len(jobs) == 0):
+    return []
+  typoIds = [job[0] for job in jobs if job[2] in TYPO_TARGET_TYPES]
   if(len(typoIds) > 0):
-    nameServers = db.getNameservers(list(typoIds.keys()))
-    typoJobsNotScheduled = True
-    while(typoJobsNotScheduled):
-      for ns in list(nameServers.keys()):
-        typoId = nameServers[ns].pop()
-        typoJobs.append(typoIds[typoId])
-        if(len(nameServers[ns]) == 0):
-          del nameServers[ns]
-        if(len(nameServers) == 0):
-          typoJobsNotScheduled = False       
-  # Alternate jobs as evenly as possible   
-  if(len(typoJobs) == 0 and len(notTypoJobs) == 0):
-    pass
-  elif(len(typoJobs) == 0):
-    allJobs = notTypoJobs
-  elif(len(notTypoJobs) == 0):
-    allJobs = typoJobs
+    nameServers = db.getNameserversByTarget(typoIds)
   else:
-    ratio = max(1,int(len(typoJobs)/len(notTypoJobs))) + 1
-    i = 0
-    while(len(notTypoJobs) != 0 or len(typoJobs) != 0):
-      i += 1
-      if((i % ratio != 0) and (len(typoJobs) != 0)):
-        allJobs.append(typoJobs.pop(0))
-      elif(len(notTypoJobs) != 0):
-        allJobs.append(notTypoJobs.pop(0))   
+    nameServers = {}
+  # Typo jobs are grouped by their name server, the others by their target type
+  groups = []
+  for job in jobs:
+    if(job[0] in nameServers):
+      groups.append(('ns',nameServers[job[0]]))
+    else:
+      groups.append(('type',job[2]))
+  constraints = []
+  for rule in spacingRules:
+    constraints.append((getSpacingValues(db,jobs,rule['key'],nameServers,dnsIntensity),rule['distance']))
+  scheduleStart = time.time()
+  allJobs, violations = interleaveJobs(jobs,groups,constraints,seed=int(day)*len(jobs)+seedOffset)
+  print('Scheduling took: ',time.time()-scheduleStart,' seconds, spacing violations: ',violations)
   return allJobs
 
 
+"""
+Keeps track of the targets visited by workers dedicated to one scrape type, so that
+a target is never visited by two scrape types at the same time and consecutive
+visits of the same target are at least minInterval seconds apart.
+The state is shared between processes through a multiprocessing Manager.
+"""
+class TargetSpacing:
+
+
+  def __init__(self, manager, minInterval):
+  
+    self.lock = manager.Lock()
+    self.visits = manager.dict()
+    self.minInterval = minInterval
+    
+    
+  """
+  Marks the target as being visited if it can be visited now
+  """
+  def tryAcquire(self, targetId):
+  
+    with self.lock:
+      busy, lastEnd = self.visits.get(targetId, (False, 0))
+      if(busy or time.time() - lastEnd < self.minInterval):
+        return False
+      self.visits[targetId] = (True, lastEnd)
+      return True
+      
+      
+  def release(self, targetId):
+  
+    with self.lock:
+      self.visits[targetId] = (False, time.time())
+
+
 class Crawler:
 
 
@@ -80,13 +146,40 @@ class Crawler:
     self.numThreads = runConfig.numThreads # 32
     self.numCrawlAttempts = runConfig.numCrawlAttempts #2
     self.batchSize = runConfig.batchSize # 600
-    self.proxyPortBase = runConfig.proxyPortBase # 8200
     self.numScrapeRetriesCrawler = runConfig.numScrapeRetriesCrawler #2
     self.waitScrapeIntervals = runConfig.waitScrapeIntervals #20
+    self.dispatchMode = runConfig.dispatchMode # target or scrapeType
+    self.maxDeferredJobs = runConfig.maxDeferredJobs # 20
+    self.jobQueue = runConfig.jobQueue # local or database
+    self.warmStandby = runConfig.warmStandby # True
+    self.persistentWorkers = runConfig.persistentWorkers # False
+    self.workerRecycleJobs = runConfig.workerRecycleJobs # 0 means batchSize/numThreads
+    if(self.workerRecycleJobs <= 0):
+      self.workerRecycleJobs = max(1,int(self.batchSize/self.numThreads))
+    self.poolSize = sum([self.getNumWorkers(x) for x in self.getWorkTypes()])
+    # Timings used to report how much the batch boundaries cost
+    self.crawlStats = {'batches':0,'poolStartups':[],'teardowns':[],'tailIdle':[],'workerRestarts':0,
+                       'standbySwaps':0,'standbySwapTime':0,'standbyWaitTime':0,'avoidedBatches':0}
     
     self.webProxies = self.loadProxies()
     random.shuffle(self.webProxies)
-    self.proxyAssignment = self.getProxyAssignment()
+    self.proxyAssignment = self.getProxyAssignment(self.poolSize)
+    # With adaptive concurrency numThreads is the maximum number of active workers
+    self.concurrency = None
+    if(runConfig.adaptiveConcurrency):
+      self.concurrency = ConcurrencyController(runConfig, self.poolSize)
+    # Process groups of the workers and temp folder of this crawl, only these are cleaned up
+    # so other crawls can run on the same host
+    self.processGroups = set()
+    # The mitmproxies shared by the workers for each upstream web proxy, if sharedProxy is set
+    self.sharedProxies = {}
+    self.tmpDir = None
+    self.previousTmpDir = None
+    # Metrics are aggregated by the crawler, workers keep their timings and failures
+    # that are not part of a visit until the next report
+    self.metrics = CrawlMetrics()
+    self.pendingTimings = deque()
+    self.pendingFailures = deque()
     print('Proxy assignment: ',self.proxyAssignment)
 
 
@@ -106,15 +199,19 @@ class Crawler:
         if(result is None):
           return 'linkFollower cannot start'
         # We got back some results
-        if((result is not None) and (result[5] != "")):
-          linkFollower.cleanup()
+        if(result[5] != ""):
           return result
       # If something went wrong we can try again
       except Exception as e:
         logging.error(traceback.format_exc())
         print("Error Following Search Result: "+ str(job[4]) + " as "+linkFollower.name+" result")
-        linkFollower.cleanup()
         continue
+      # The state of the visit is cleared after every attempt, whatever its result
+      finally:
+        try:
+          linkFollower.cleanup()
+        except Exception as e:
+          print('Cleanup failed for ', linkFollower.name, ': ', e)
     # If we didn't return anything yet then return None
     return None
 
@@ -141,9 +238,11 @@ class Crawler:
   """  
   def startMultipleLinkFollowersAndProxies(self,id,lock,webProxies,modifier):
   
-    portBase = self.proxyPortBase+id  
+    if(self.runConfig.sharedBrowser):
+      return self.startSharedBrowser(id,lock,webProxies,modifier)
     linkFollowers = []
     proxies = []
+    httpProxies = []
     lock.acquire()
     counter = 0
     for scrapeType in self.runConfig.scrapeTypes:
@@ -151,21 +250,99 @@ class Crawler:
         httpProxy = webProxies[(counter+modifier) % len(webProxies)]
       else:
         httpProxy = None
-      proxy = Proxy(portBase+counter*200,httpProxy)
-      if(not proxy.startProxy()):
-        lock.release()
-        return None, None
+      proxy = None
+      if(self.needsProxy(scrapeType, httpProxy)):
+        proxy = self.newProxy(id, httpProxy)
+        if(not proxy.startProxy(wait = False)):
+          lock.release()
+          self.pendingFailures.append('proxy_start')
+          self.stopDriversAndProxies(linkFollowers,proxies)
+          return None, None
       proxies.append(proxy)
-      linkFollowers.append(LinkFollow(id, self.runConfig, scrapeType, proxy, httpProxy))
+      httpProxies.append(httpProxy)
+      # Browsers started from their own profile clone don't have to be started one at a time
+      if(not self.runConfig.fastStart):
+        linkFollowers.append(self.startLinkFollower(id, scrapeType, proxy, httpProxy))
       counter += 1
     lock.release()
+    if(self.runConfig.fastStart):
+      for k in range(len(proxies)):
+        linkFollowers.append(self.startLinkFollower(id, self.runConfig.scrapeTypes[k], proxies[k], httpProxies[k]))
     
-    # If we were not able to start even one of the browser instances then quit this worker
-    for linkFollower in linkFollowers:
-      if(linkFollower is None):
+    # If we were not able to start even one of the browser instances or proxies then quit this worker
+    for k in range(len(linkFollowers)):
+      lFollower = linkFollowers[k]
+      if(lFollower is not None and proxies[k] is not None):
+        lFollower = self.waitForProxy(id, self.runConfig.scrapeTypes[k], lFollower, proxies[k], httpProxies[k])
+      if(lFollower is None):
+        self.pendingFailures.append('proxy_start')
         self.stopDriversAndProxies(linkFollowers,proxies)
         return None, None
+      linkFollowers[k] = lFollower
     return linkFollowers, proxies
+    
+    
+  """
+  Waits until a proxy started without waiting is ready. If it was relaunched on
+  another port, the browser started with the old port is restarted.
+  Returns the link follower to use, None if the proxy couldn't start.
+  """
+  def waitForProxy(self, id, scrapeType, lFollower, proxy, httpProxy):
+  
+    proxyUrl = proxy.proxyUrl
+    if(not proxy.retryUntilReady()):
+      return None
+    if(proxy.proxyUrl != proxyUrl):
+      try:
+        lFollower.driver.quit()
+      except:
+        pass
+      lFollower = self.startLinkFollower(id, scrapeType, proxy, httpProxy)
+    return lFollower
+  
+  
+  """
+  Starts one Chrome and one proxy shared by the link followers of all scrape types,
+  each link follower gets its own browser context of the Chrome.
+  The proxies list has the shared proxy for every link follower.
+  """
+  def startSharedBrowser(self,id,lock,webProxies,modifier):
+  
+    httpProxy = None
+    if(len(webProxies) > 0 ):
+      httpProxy = webProxies[modifier % len(webProxies)]
+    proxy = None
+    lock.acquire()
+    if(any([self.needsProxy(x, httpProxy) for x in self.runConfig.scrapeTypes])):
+      proxy = self.newProxy(id, httpProxy)
+      if(not proxy.startProxy(wait = False)):
+        lock.release()
+        self.pendingFailures.append('proxy_start')
+        return None, None
+    lock.release()
+    # The browser is started after the proxy is ready, so it gets the port of a relaunch
+    if(proxy is not None and not proxy.retryUntilReady()):
+      self.pendingFailures.append('proxy_start')
+      proxy.close()
+      return None, None
+    driverStart = time.time()
+    sharedBrowser = SharedBrowser(id, self.runConfig, proxy, httpProxy)
+    if(sharedBrowser.driver is None):
+      self.pendingFailures.append('browser_start')
+      if(proxy is not None):
+        proxy.close()
+      return None, None
+    linkFollowers = []
+    try:
+      for scrapeType in self.runConfig.scrapeTypes:
+        linkFollowers.append(LinkFollow(id, self.runConfig, scrapeType, proxy, httpProxy, sharedBrowser = sharedBrowser))
+    except Exception as e:
+      logging.error(traceback.format_exc())
+      self.pendingFailures.append('browser_start')
+      self.stopOneDriverAndProxy(sharedBrowser.host, proxy)
+      return None, None
+    self.pendingTimings.append(('driver_start', time.time() - driverStart))
+    return linkFollowers, [proxy] * len(linkFollowers)
   
   
   """
@@ -184,7 +361,7 @@ class Crawler:
     
     
   """
-  Starts one driver and proxy used for scraping
+  Starts one driver and proxy used for scraping, returns None if they couldn't be started
   """
   def startOneDriverAndProxy(self,id,lock,scrapeType,webProxies,wpc):
   
@@ -194,39 +371,272 @@ class Crawler:
     else:
       httpProxy = None
   
-    portBase = self.proxyPortBase+id  
     lock.acquire()
-    proxy = Proxy(portBase,httpProxy)
-    if(not proxy.startProxy()):
+    proxy = None
+    if(self.needsProxy(scrapeType, httpProxy)):
+      proxy = self.newProxy(id, httpProxy)
+      if(not proxy.startProxy(wait = False)):
+        lock.release()
+        self.pendingFailures.append('proxy_start')
+        return None
+    # Browsers started from their own profile clone don't have to be started one at a time
+    if(self.runConfig.fastStart):
       lock.release()
-      return None, None
-    lFollower = LinkFollow(id, self.runConfig, scrapeType, proxy, httpProxy)
-    lock.release()
+    lFollower = self.startLinkFollower(id, scrapeType, proxy, httpProxy)
+    if(not self.runConfig.fastStart):
+      lock.release()
+    if(proxy is not None):
+      readyFollower = self.waitForProxy(id, scrapeType, lFollower, proxy, httpProxy)
+      if(readyFollower is None):
+        self.pendingFailures.append('proxy_start')
+        self.stopOneDriverAndProxy(lFollower,proxy)
+        return None
+      lFollower = readyFollower
     return lFollower, proxy
     
     
+  """
+  Returns the proxy of a new browser, a tenant of a shared mitmproxy with the
+  same upstream web proxy if there is one
+  """
+  def newProxy(self, id, httpProxy):
+  
+    pool = self.sharedProxies.get(httpProxy, [])
+    if(len(pool) > 0):
+      return ProxyTenant(pool[id % len(pool)])
+    return Proxy(httpProxy,self.runConfig.proxyStartTimeout)
+    
+    
+  """
+  Starts the shared mitmproxies that are not running, sharedProxyPoolSize for
+  each upstream web proxy the workers can use. The workers inherit them at fork.
+  Browsers get a mitmproxy of their own if the shared ones couldn't start.
+  """
+  def startSharedProxies(self):
+  
+    if(not self.runConfig.sharedProxy):
+      return
+    httpProxies = list(self.webProxies)
+    if(any([self.needsProxy(x, None) for x in self.runConfig.scrapeTypes])):
+      httpProxies.append(None)
+    for httpProxy in httpProxies:
+      pool = [x for x in self.sharedProxies.get(httpProxy, []) if x.isAlive()]
+      while(len(pool) < self.runConfig.sharedProxyPoolSize):
+        proxy = Proxy(httpProxy, self.runConfig.proxyStartTimeout, multiTenant = True)
+        if(not proxy.startProxy()):
+          self.metrics.recordFailure('proxy_start')
+          break
+        pool.append(proxy)
+      self.sharedProxies[httpProxy] = pool
+      
+      
+  def stopSharedProxies(self):
+  
+    for pool in self.sharedProxies.values():
+      for proxy in pool:
+        try:
+          proxy.close()
+        except:
+          pass
+    self.sharedProxies = {}
+    
+    
+  """
+  With the devtools network capture a mitmproxy is only needed to use an upstream
+  web proxy or to add the referer header
+  """
+  def needsProxy(self, scrapeType, httpProxy):
+  
+    return (self.runConfig.networkCapture == 'mitm' or httpProxy is not None or scrapeType['ref'])
+    
+    
+  """
+  Starts the browser of a link follower and records how long it took
+  """
+  def startLinkFollower(self, id, scrapeType, proxy, httpProxy):
+  
+    driverStart = time.time()
+    lFollower = LinkFollow(id, self.runConfig, scrapeType, proxy, httpProxy)
+    self.pendingTimings.append(('driver_start', time.time() - driverStart))
+    if(lFollower.driver is None):
+      self.pendingFailures.append('browser_start')
+    return lFollower
+    
+    
+  """
+  Sends a status message from a worker to the process supervising the workers
+  """
+  def reportStatus(self, statusQueue, *message):
+  
+    if(statusQueue is not None):
+      statusQueue.put(message)
+      
+      
   """
   Worker function
 
+  Runs the worker loop and reports to the supervisor why the worker stopped:
+   - done: the worker received the DONE message
+   - retired: the worker visited maxJobs targets and should be replaced by a fresh process
+   - failed: the worker couldn't start its browsers, proxies or db connection
+  Each worker is the leader of its own process group, so the browsers and proxies
+  it started can be killed together without touching other crawls.
+  """
+  def worker(self, id, lock, slot, webProxies, statusQueue = None, maxJobs = 0, 
+             spacing = None, pause = None):
+  
+    os.setpgid(0, 0)
+    workQueue = slot['queue']
+    if(slot['scrapeType'] is None):
+      status = self.workerLoop(id, lock, slot, webProxies, statusQueue, maxJobs, pause)
+    else:
+      status = self.scrapeTypeWorkerLoop(id, lock, slot, webProxies, statusQueue, maxJobs, 
+                                         spacing, pause)
+    if(isinstance(workQueue, LeaseQueue)):
+      workQueue.close()
+    self.reportMetrics(statusQueue, id)
+    self.reportStatus(statusQueue, status, id, time.time())
+    
+    
+  """
+  Reports the page load time and the outcome of a visit, these are used to adapt concurrency
+  """
+  def reportVisit(self, statusQueue, id, linkFollower, result):
+  
+    failureType = None
+    if(result == 'linkFollower cannot start'):
+      failureType = 'browser_start'
+    elif(linkFollower.pageLoadTimedOut):
+      failureType = 'page_load_timeout'
+    elif(result is None):
+      failureType = 'no_result'
+    self.reportStatus(statusQueue, 'visit', id, linkFollower.pageLoadTime, failureType is not None,
+                      linkFollower.name, failureType, list(linkFollower.timings.items()))
+    self.reportMetrics(statusQueue, id)
+    
+    
+  """
+  Sends the timings and failures recorded outside of visits (driver starts, db inserts)
+  """
+  def reportMetrics(self, statusQueue, id):
+  
+    timings = []
+    failures = []
+    # Standby threads may add entries meanwhile, popleft is atomic
+    while(len(self.pendingTimings) > 0):
+      timings.append(self.pendingTimings.popleft())
+    while(len(self.pendingFailures) > 0):
+      failures.append(self.pendingFailures.popleft())
+    if(len(timings) > 0 or len(failures) > 0):
+      self.reportStatus(statusQueue, 'metrics', id, timings, failures)
+    
+    
+  """
+  Waits while the crawler wants fewer workers to be active than the slot of this worker
+  """
+  def waitWhilePaused(self, id, slot, pause):
+  
+    print('Worker paused: ',id)
+    while(pause.isPaused(slot)):
+      time.sleep(1)
+    print('Worker resumed: ',id)
+    
+    
+  """
+  Called when the results of a job were added to the db. Jobs leased from the 
+  crawl_jobs table are marked done after their results are committed.
+  """
+  def finishJob(self, db, workQueue, job):
+  
+    if(isinstance(workQueue, LeaseQueue)):
+      db.commit()
+      workQueue.complete(job)
+    
+    
+  """
+  Replaces the browsers and proxies in use with fresh ones of the given generation.
+  The fresh ones are taken from the warm standby if there is one (and the next
+  standby is prepared), otherwise they are started now.
+  Returns None if the fresh ones couldn't be started.
+  """
+  def swapBrowsers(self, id, statusQueue, standby, current, start, stop, generation):
+  
+    if(standby is None):
+      stop(current)
+      time.sleep(1)
+      return start(generation)
+    item, swapTime, waitTime = standby.take()
+    self.reportStatus(statusQueue, 'standby', id, swapTime, waitTime)
+    if(item is None):
+      stop(current)
+      return None
+    standby.prepare(generation+1, current)
+    return item
+    
+    
+  """
+  Worker loop
+
   This is a threaded function that pulls links out of a queue and then 
   performs 4 link follow requests using the default, referrer, android and googlebot 
   configurations
   """
-  def worker(self, id, lock, workQueue, webProxies):
+  def workerLoop(self, id, lock, slot, webProxies, statusQueue, maxJobs, pause):
 
     print('worker starting: ', id)
+    workQueue = slot['queue']
+    startTime = time.time()
+    # With persistent workers the browser restarts are staggered between workers
+    # so they don't all restart at the same time
+    restartOffset = 0
+    if(self.persistentWorkers):
+      restartOffset = id % self.runConfig.requestPerDriver
+    modifier = len(self.runConfig.scrapeTypes)
+    
+    def startSet(generation):
+      linkFollowers, proxies = self.startMultipleLinkFollowersAndProxies(id,lock,webProxies,generation*modifier)
+      if(linkFollowers is None):
+        return None
+      return linkFollowers, proxies
+      
+    def stopSet(item):
+      self.stopDriversAndProxies(item[0],item[1])
+      
+    def getStartOne(k):
+      return lambda generation: self.startOneDriverAndProxy(id,lock,self.runConfig.scrapeTypes[k],webProxies,
+                                                            k+generation*modifier)
+      
+    def stopOne(item):
+      self.stopOneDriverAndProxy(item[0],item[1])
+      
     # Create the browser objects ahead of time and then re-use them for the current batch
     modCounter = 0
-    modifier = len(self.runConfig.scrapeTypes)
+    standby = None
+    standbys = None
     if(not self.runConfig.driverPerRequest):
-      linkFollowers, proxies = self.startMultipleLinkFollowersAndProxies(id,lock,webProxies,modCounter*modifier)
-      if(linkFollowers is None):
-        return
+      browserSet = startSet(modCounter)
+      if(browserSet is None):
+        return 'failed'
+      if(self.warmStandby):
+        standby = WarmStandby(startSet, stopSet)
+        standby.prepare(modCounter+1)
     # If we have a new driver per each request then just put scrape type into linkFollowers
     else:
-      linkFollowers = []
-      for scrapeType in self.runConfig.scrapeTypes:
-        linkFollowers.append(scrapeType)
+      browserSet = None
+      if(self.warmStandby):
+        standbys = []
+        for k in range(modifier):
+          standbys.append(WarmStandby(getStartOne(k), stopOne))
+          standbys[k].prepare(1)
+          
+    def stopAll():
+      if(standby is not None):
+        standby.discard()
+      if(standbys is not None):
+        for x in standbys:
+          x.discard()
+      if(browserSet is not None):
+        stopSet(browserSet)
     
     # Try to create a db connection
     try:
@@ -234,120 +644,554 @@ class Crawler:
     except Exception as e:
       logging.error(traceback.format_exc())
       print("Error couldn't create db connection")
-      return
+      stopAll()
+      return 'failed'
       
     print('Ready for scraping: ',id)
+    self.reportStatus(statusQueue, 'ready', id, time.time()-startTime)
     # Start scraping pages
+    status = 'done'
     counter = 0
     while True:
+      # Retire this worker so that a fresh process can take over its slot
+      if(maxJobs > 0 and counter >= maxJobs):
+        status = 'retired'
+        break
+      # Paused workers don't keep their browsers and proxies
+      if(pause is not None and pause.isPaused(slot)):
+        stopAll()
+        self.waitWhilePaused(id, slot, pause)
+        if(not self.runConfig.driverPerRequest):
+          modCounter += 2
+          browserSet = startSet(modCounter)
+          if(browserSet is None):
+            db.commit()
+            db.close()
+            return 'failed'
+          if(standby is not None):
+            standby.prepare(modCounter+1)
+        elif(standbys is not None):
+          for k in range(modifier):
+            standbys[k].prepare(counter+1)
       counter += 1
       # Get a page to scrape, if there are no more then stop!
       job = workQueue.get()
       if(len(job) == 1 and job[0] == "DONE"):
         break
       results = {}
-      wpc = 0 # web proxy counter
-      for linkFollower in linkFollowers:
+      for k in range(modifier):
         # Create proxy and driver then follow links then close proxy and driver
         if(self.runConfig.driverPerRequest):
-          lFollower, proxy = self.startOneDriverAndProxy(id,lock,linkFollower,webProxies,wpc+counter*modifier)
-          if(lFollower is None):
+          scrapeType = self.runConfig.scrapeTypes[k]
+          if(standbys is not None):
+            item, swapTime, waitTime = standbys[k].take()
+            self.reportStatus(statusQueue, 'standby', id, swapTime, waitTime)
+          else:
+            item = self.startOneDriverAndProxy(id,lock,scrapeType,webProxies,k+counter*modifier)
+          if(item is None):
+            if(standbys is not None):
+              standbys[k].prepare(counter+1)
             continue
-          result = self.followOneLink(job, lFollower)
-          self.stopOneDriverAndProxy(lFollower,proxy)
-          time.sleep(1)
+          result = self.followOneLink(job, item[0])
+          self.reportVisit(statusQueue, id, item[0], result)
+          # The used driver and proxy are stopped while the next ones start
+          if(standbys is not None):
+            standbys[k].prepare(counter+1, item)
+          else:
+            stopOne(item)
+            time.sleep(1)
         # Use proxies created earlier
         else:
-          result = self.followOneLink(job, linkFollower)
-        wpc += 1
+          scrapeType = browserSet[0][k].scrapeType
+          result = self.followOneLink(job, browserSet[0][k])
+          self.reportVisit(statusQueue, id, browserSet[0][k], result)
         
         if(result == 'linkFollower cannot start'):
-          return
+          db.commit()
+          db.close()
+          stopAll()
+          return 'failed'
         elif(result is not None):
-          if(self.runConfig.driverPerRequest):
-            results[linkFollower['name']] = {'result':result,'scrapeType':linkFollower}
-          else:
-            results[linkFollower.name] = {'result':result,'scrapeType':linkFollower.scrapeType}
+          results[scrapeType['name']] = {'result':result,'scrapeType':scrapeType}
           time.sleep(self.waitScrapeIntervals)
       # Update results
+      insertStart = time.time()
       if(len(results) > 0):
         db.addScrapes(job[0],results,self.runConfig)
+      self.finishJob(db, workQueue, job)
+      self.pendingTimings.append(('db_insert', time.time() - insertStart))
       # Commit periodically
       if(counter % self.runConfig.commitFrequency == 0):
         db.commit()
       # If enough driver and proxy has been used for enough requests then restart them
       # This can only happen if driverPerRequest is False
-      if(not self.runConfig.driverPerRequest and (counter % self.runConfig.requestPerDriver == 0)):
+      if(not self.runConfig.driverPerRequest and (counter % self.runConfig.requestPerDriver == restartOffset)):
         modCounter += 1
-        self.stopDriversAndProxies(linkFollowers,proxies)
-        time.sleep(1)
-        linkFollowers, proxies = self.startMultipleLinkFollowersAndProxies(id,lock,webProxies,modCounter*modifier)
-        if(linkFollowers is None):
-          return
+        browserSet = self.swapBrowsers(id, statusQueue, standby, browserSet, startSet, stopSet, modCounter)
+        if(browserSet is None):
+          db.commit()
+          db.close()
+          stopAll()
+          return 'failed'
           
     # Commit and close database connection
     db.commit()
     db.close()     
     # Attempt to stop browser instances and proxy when they are done.
+    stopAll()
+    return status
+    
+    
+  """
+  Gets the next job that the target spacing allows to be visited now.
+  Jobs that can't be visited yet are deferred and tried again later, this way
+  the worker can continue with other targets in the meantime.
+  Returns None if there are no more jobs.
+  """
+  def getSpacedJob(self, workQueue, spacing, state):
+  
+    while True:
+      for i in range(len(state['deferred'])):
+        if(spacing.tryAcquire(state['deferred'][i][0])):
+          return state['deferred'].pop(i)
+      if(not state['queueDone'] and state['canFetch'] and len(state['deferred']) < self.maxDeferredJobs):
+        job = workQueue.get()
+        if(len(job) == 1 and job[0] == "DONE"):
+          state['queueDone'] = True
+        elif(spacing.tryAcquire(job[0])):
+          return job
+        else:
+          state['deferred'].append(job)
+        continue
+      if(len(state['deferred']) == 0):
+        return None
+      time.sleep(0.5)
+      
+      
+  """
+  Worker loop for workers dedicated to one scrape type
+
+  Each job is one (target, scrapeType) pair, so a slow scrape type doesn't
+  hold up the others. The target spacing keeps the different scrape types
+  of one target apart in time.
+  """
+  def scrapeTypeWorkerLoop(self, id, lock, slot, webProxies, statusQueue, maxJobs, spacing, pause):
+  
+    workQueue = slot['queue']
+    scrapeType = slot['scrapeType']
+    print('worker starting: ', id, ' - ', scrapeType['name'])
+    startTime = time.time()
+    restartOffset = 0
+    if(self.persistentWorkers):
+      restartOffset = id % self.runConfig.requestPerDriver
+    
+    def startOne(wpc):
+      return self.startOneDriverAndProxy(id,lock,scrapeType,webProxies,wpc)
+      
+    def stopOne(item):
+      self.stopOneDriverAndProxy(item[0],item[1])
+      
+    wpc = 0 # web proxy counter
+    item = None
+    standby = None
     if(not self.runConfig.driverPerRequest):
-      self.stopDriversAndProxies(linkFollowers,proxies)
+      item = startOne(wpc)
+      if(item is None):
+        return 'failed'
+    if(self.warmStandby):
+      standby = WarmStandby(startOne, stopOne)
+      standby.prepare(wpc+1)
+      
+    def stopAll():
+      if(standby is not None):
+        standby.discard()
+      if(item is not None):
+        stopOne(item)
+        
+    # Try to create a db connection
+    try:
+      db = RedirectDB(self.runConfig)
+    except Exception as e:
+      logging.error(traceback.format_exc())
+      print("Error couldn't create db connection")
+      stopAll()
+      return 'failed'
+      
+    print('Ready for scraping: ',id,' - ',scrapeType['name'])
+    self.reportStatus(statusQueue, 'ready', id, time.time()-startTime)
+    state = {'deferred':[],'queueDone':False,'canFetch':True}
+    status = 'done'
+    counter = 0
+    while True:
+      # Retire this worker, but only after the deferred jobs are done and
+      # before the DONE message is taken from the queue
+      if(maxJobs > 0 and counter >= maxJobs and not state['queueDone']):
+        state['canFetch'] = False
+        if(len(state['deferred']) == 0):
+          status = 'retired'
+          break
+      # Paused workers don't keep their browser and proxy
+      if(pause is not None and pause.isPaused(slot)):
+        stopAll()
+        item = None
+        self.waitWhilePaused(id, slot, pause)
+        wpc += 2
+        if(not self.runConfig.driverPerRequest):
+          item = startOne(wpc)
+          if(item is None):
+            db.commit()
+            db.close()
+            return 'failed'
+        if(standby is not None):
+          standby.prepare(wpc+1)
+      job = self.getSpacedJob(workQueue, spacing, state)
+      if(job is None):
+        break
+      counter += 1
+      if(self.runConfig.driverPerRequest):
+        wpc += 1
+        if(standby is not None):
+          item, swapTime, waitTime = standby.take()
+          self.reportStatus(statusQueue, 'standby', id, swapTime, waitTime)
+        else:
+          item = startOne(wpc)
+        if(item is None):
+          if(standby is not None):
+            standby.prepare(wpc+1)
+          spacing.release(job[0])
+          continue
+      try:
+        result = self.followOneLink(job, item[0])
+      finally:
+        spacing.release(job[0])
+      self.reportVisit(statusQueue, id, item[0], result)
+      if(self.runConfig.driverPerRequest):
+        # The used driver and proxy are stopped while the next ones start
+        if(standby is not None):
+          standby.prepare(wpc+1, item)
+        else:
+          stopOne(item)
+          time.sleep(1)
+        item = None
+        
+      if(result == 'linkFollower cannot start'):
+        db.commit()
+        db.close()
+        stopAll()
+        return 'failed'
+      insertStart = time.time()
+      if(result is not None):
+        db.addScrapes(job[0],{scrapeType['name']:{'result':result,'scrapeType':scrapeType}},self.runConfig)
+      self.finishJob(db, workQueue, job)
+      self.pendingTimings.append(('db_insert', time.time() - insertStart))
+      # Commit periodically
+      if(counter % self.runConfig.commitFrequency == 0):
+        db.commit()
+      # Restart the driver and proxy after requestPerDriver visits
+      if(not self.runConfig.driverPerRequest and (counter % self.runConfig.requestPerDriver == restartOffset)):
+        wpc += 1
+        item = self.swapBrowsers(id, statusQueue, standby, item, startOne, stopOne, wpc)
+        if(item is None):
+          db.commit()
+          db.close()
+          stopAll()
+          return 'failed'
+          
+    db.commit()
+    db.close()
+    stopAll()
+    return status
       
 
+  """
+  The scrape types that get their own workers. None means that a worker
+  visits each target with all scrape types.
+  """
+  def getWorkTypes(self):
+  
+    if(self.dispatchMode == 'scrapeType'):
+      return self.runConfig.scrapeTypes
+    return [None]
+    
+    
+  """
+  Number of workers visiting the targets for the given scrape type.
+  Slow scrape types can be given more workers with the workers field.
+  """
+  def getNumWorkers(self, scrapeType):
+  
+    if(scrapeType is None):
+      return self.numThreads
+    return scrapeType.get('workers', self.numThreads)
+    
+    
+  """
+  Starts one worker process in the given slot
+  """
+  def startWorker(self, id, lock, slot, statusQueue, maxJobs, spacing, pause):
+  
+    print('Process starting: ',id)
+    p = Process(target = self.worker, args = (id, lock, slot, self.proxyAssignment[id], 
+                                              statusQueue, maxJobs, spacing, pause))
+    p.start()
+    self.processGroups.add(p.pid)
+    return p
+    
+    
+  """
+  Waits for a worker process to exit and kills what is left of its process group
+  """
+  def stopWorker(self, p):
+  
+    p.join()
+    killProcessGroup(p.pid)
+    self.processGroups.discard(p.pid)
+    
+    
+  """
+  Number of jobs a worker takes before it is replaced by a fresh process.
+  The first generation of persistent workers retire at different times so that
+  only one worker slot is restarting at a time.
+  """
+  def getWorkerJobLimit(self, id, firstGeneration):
+  
+    if(not self.persistentWorkers):
+      return 0
+    if(firstGeneration):
+      return max(1,int(self.workerRecycleJobs*(id+1)/self.poolSize))
+    return self.workerRecycleJobs
+    
+    
+  """
+  Starts a worker for each slot and waits for them to finish.
+  Persistent workers that retire are replaced by a fresh process in the same slot.
+  Returns the time it took until all workers were ready for scraping.
+  """
+  def superviseWorkers(self, lock, slots, statusQueue, spacing, pause):
+  
+    threads = {}
+    poolStart = time.time()
+    for i in range(len(slots)):
+      threads[i] = self.startWorker(i, lock, slots[i], statusQueue, self.getWorkerJobLimit(i, True), spacing, pause)
+    print('Workers started')
+    poolStartup = None
+    readyWorkers = set()
+    doneTimes = []
+    deadRestarts = {}
+    while(len(threads) > 0):
+      self.metrics.setGauge('odin_workers', len(threads), help = 'Running worker processes')
+      if(self.concurrency is not None):
+        active = self.concurrency.decide()
+        if(active is not None):
+          pause.setActive(active)
+      try:
+        message = statusQueue.get(timeout = 5)
+      except queue.Empty:
+        # Workers that were killed or crashed can't report, their slot gets a new worker.
+        # A worker that exited normally has put its report on the queue before exiting.
+        for i, p in list(threads.items()):
+          if(p.is_alive() or p.exitcode == 0):
+            continue
+          print('Worker exited without reporting: ',i,' exit code: ',p.exitcode)
+          self.stopWorker(p)
+          del threads[i]
+          deadRestarts[i] = deadRestarts.get(i, 0) + 1
+          if(deadRestarts[i] > MAX_DEAD_RESTARTS):
+            print('Worker slot given up: ',i)
+            continue
+          # The dead worker might have taken the DONE message of the new one,
+          # an extra one after the jobs doesn't stop the other workers early
+          if(not isinstance(slots[i]['queue'], LeaseQueue)):
+            slots[i]['queue'].put(["DONE"])
+          self.crawlStats['workerRestarts'] += 1
+          threads[i] = self.startWorker(i, lock, slots[i], statusQueue, self.getWorkerJobLimit(i, False), spacing, pause)
+        continue
+      status, id = message[0], message[1]
+      # Messages of a worker whose slot was given up
+      if(id not in threads):
+        continue
+      if(status == 'visit'):
+        if(self.concurrency is not None):
+          self.concurrency.recordVisit(message[2], message[3])
+        self.metrics.recordVisit(message[4], message[5], message[6])
+      elif(status == 'metrics'):
+        for stage, seconds in message[2]:
+          self.metrics.observeStage(stage, seconds)
+        for failureType in message[3]:
+          self.metrics.recordFailure(failureType)
+      elif(status == 'standby'):
+        self.crawlStats['standbySwaps'] += 1
+        self.crawlStats['standbySwapTime'] += message[2]
+        self.crawlStats['standbyWaitTime'] += message[3]
+      elif(status == 'ready'):
+        readyWorkers.add(id)
+        if(poolStartup is None and len(readyWorkers) == len(slots)):
+          poolStartup = time.time() - poolStart
+      elif(status == 'retired'):
+        self.stopWorker(threads[id])
+        self.crawlStats['workerRestarts'] += 1
+        threads[id] = self.startWorker(id, lock, slots[id], statusQueue, self.getWorkerJobLimit(id, False), spacing, pause)
+      elif(status in ['done','failed']):
+        # The queue is drained, so the paused workers of this type can finish
+        if(status == 'done' and pause is not None):
+          pause.setDrained(slots[id]['typeIndex'])
+        self.stopWorker(threads[id])
+        del threads[id]
+        doneTimes.append(message[2])
+    if(len(doneTimes) > 0):
+      lastDone = max(doneTimes)
+      self.crawlStats['tailIdle'].append(sum([lastDone-x for x in doneTimes]))
+    if(poolStartup is None):
+      poolStartup = time.time() - poolStart
+    return poolStartup
+    
+
   """
   The part responsible to run actual visits to webpages using multiprocessing.
+  workLists is a list of (scrapeType, jobs) pairs, each getting its own queue and
+  workers. A scrapeType of None means that the workers visit with all scrape types.
   """
-  def followLinksSample(self,links):
+  def followLinksSample(self,workLists):
   
-    workQueue = Queue()
-    threads = []
-    linksFollowed = 0
-    for l in links:
-      linksFollowed += 1
-      workQueue.put(l)
+    self.startSharedProxies()
+    slots = []
+    for typeIndex in range(len(workLists)):
+      scrapeType, links = workLists[typeIndex]
+      if(len(links) == 0):
+        continue
+      numWorkers = self.getNumWorkers(scrapeType)
+      # Jobs leased from the db don't have to be added to a queue
+      if(isinstance(links, LeaseQueue)):
+        workQueue = links
+      else:
+        workQueue = Queue()
+        for l in links:
+          workQueue.put(l)
+        #All the work has been added, tell the threads to quit now that things are done
+        for i in range(numWorkers):
+          workQueue.put(["DONE"])
+      for i in range(numWorkers):
+        slots.append({'queue':workQueue,'scrapeType':scrapeType,'rank':i,'typeSize':numWorkers,'typeIndex':typeIndex})
     print("Finished adding the all links to the queue")
+    statusQueue = Queue()
+    manager = None
+    spacing = None
+    pause = None
+    if(self.concurrency is not None):
+      pause = WorkerPause(len(workLists), self.concurrency.active, self.poolSize)
+    if(self.dispatchMode == 'scrapeType'):
+      manager = multiprocessing.Manager()
+      spacing = TargetSpacing(manager, self.waitScrapeIntervals)
     #Create the virtual display adapter so that the link follower can work headless
     display = Display(visible = 0, size = (1280, 768))
     display.start()
+    displayNumber = getattr(display, 'display', None)
+    displayPid = getDisplayServerPid(display)
     lock = multiprocessing.Lock()
     print("Finished creating virtual display adapter")
-    # Start workers
-    for i in range(self.numThreads):
-      print('Process starting: ',i)
-      p = Process(target = self.worker, args = (i, lock, workQueue, self.proxyAssignment[i]))
-      p.start()
-      threads.append(p)
-    print('Workers started')
-    #All the work has been added, tell the threads to quit now that things are done
-    for i in range(self.numThreads):
-      workQueue.put(["DONE"])
-
-    #Join with the threads,
-    for t in threads:
-      t.join()
+    if(self.runConfig.fastStart and not prepareTemplate(self.runConfig)):
+      print('Fast start disabled, the template could not be created')
+      self.runConfig.fastStart = False
+    # Start workers and wait for them to finish
+    poolStartup = self.superviseWorkers(lock, slots, statusQueue, spacing, pause)
+    
     # Stop processes
+    teardownStart = time.time()
+    if(manager is not None):
+      manager.shutdown()
     display.stop() 
-    # Cleanup if some processes didn't stop properly
-    subprocess.call("pkill -f chrom", shell = True)
-    subprocess.call("pkill -f mitm", shell = True)
-    subprocess.call("pkill -f Xvfb", shell = True)
-    time.sleep(8)
+    # Cleanup if some processes of this crawl didn't stop properly
+    for pgid in self.processGroups:
+      killProcessGroup(pgid)
+    if(displayPid is not None):
+      stopDisplayServer(displayPid, displayNumber)
+    alive = waitForProcessGroups(self.processGroups, 8)
+    if(len(alive) > 0):
+      print('Process groups still running after teardown: ', alive)
+    self.processGroups = set(alive)
+    self.crawlStats['batches'] += 1
+    self.crawlStats['poolStartups'].append(poolStartup)
+    self.crawlStats['teardowns'].append(time.time() - teardownStart)
     
-    return linksFollowed
+    return max([len(x[1]) for x in workLists])
+
 
+  """
+  Summary of the time spent at batch boundaries (starting and stopping the workers).
+  For persistent workers the saving is estimated from the one startup and teardown 
+  measured and the number of batches the crawl would have been split into.
+  """
+  def getCrawlStats(self):
+  
+    stats = self.crawlStats
+    if(stats['batches'] == 0):
+      return 'No crawl batches were run\n'
+    boundaryTime = sum(stats['poolStartups']) + sum(stats['teardowns'])
+    text = 'Worker mode: ' + ('persistent' if self.persistentWorkers else 'batch') + '\n'
+    text += 'Worker pool starts: ' + str(stats['batches']) + ', worker restarts: ' + str(stats['workerRestarts']) + '\n'
+    text += 'Time spent starting and stopping worker pools: ' + str(round(boundaryTime,1)) + ' seconds\n'
+    text += 'Worker idle time waiting for the last worker of a pool: ' + str(round(sum(stats['tailIdle']),1)) + ' seconds\n'
+    if(self.persistentWorkers and stats['avoidedBatches'] > 0):
+      perBoundary = boundaryTime/stats['batches']
+      text += 'Batch boundaries avoided: ' + str(stats['avoidedBatches']) + ', estimated time saved: '
+      text += str(round(perBoundary*stats['avoidedBatches'],1)) + ' seconds (without worker idle time)\n'
+    if(stats['standbySwaps'] > 0):
+      # Without the standby every swap would have waited for the stop and start
+      saved = stats['standbySwapTime'] - stats['standbyWaitTime']
+      text += 'Warm standby swaps: ' + str(stats['standbySwaps']) + ', waiting for standby: '
+      text += str(round(stats['standbyWaitTime'],1)) + ' seconds, wall-clock time saved: ' + str(round(saved,1)) + ' seconds\n'
+    return text
+    
 
   """
-  Clean the /tmp folder to remove thrash left there by chromium
+  Serves the crawl metrics in the Prometheus text format on metricsPort (0 disables it).
+  A port that is in use (e.g. by another crawl) doesn't stop the crawl.
+  """
+  def startMetricsServer(self):
+  
+    if(self.runConfig.metricsPort == 0):
+      return None
+    try:
+      return MetricsServer(self.metrics, self.runConfig.metricsPort)
+    except OSError as e:
+      print("Couldn't start metrics server: ", e)
+      return None
+    
+    
+  """
+  Creates the temp folder of this crawl. The workers, browsers and proxies inherit
+  TMPDIR, so the thrash left by chromium ends up in this folder.
+  """
+  def createTmpFolder(self):
+  
+    self.tmpDir = tempfile.mkdtemp(prefix = 'odin-' + self.day + '-')
+    self.previousTmpDir = os.environ.get('TMPDIR')
+    os.environ['TMPDIR'] = self.tmpDir
+    tempfile.tempdir = None
+    # The profile clones of the browsers go to the tmpfs of the fast-start template
+    if(self.runConfig.fastStart):
+      os.makedirs(self.runConfig.profileTemplateFolder, exist_ok = True)
+      self.runConfig.profileCloneFolder = tempfile.mkdtemp(prefix = 'clones-' + self.day + '-',
+                                                            dir = self.runConfig.profileTemplateFolder)
+    
+    
+  """
+  Clean the temp folder of this crawl to remove thrash left there by chromium
   """
   def cleanTmpFolder(self):
   
-    for path, subdirs, files in os.walk('/tmp'):
-      for subdir in subdirs:
-        dirName = os.path.join(path, subdir)
-        if(dirName.startswith('/tmp/.org.chromium')):
-          try:
-            shutil.rmtree(dirName)
-          except:
-            pass
+    if(self.tmpDir is None):
+      return
+    shutil.rmtree(self.tmpDir, ignore_errors = True)
+    if(hasattr(self.runConfig, 'profileCloneFolder')):
+      shutil.rmtree(self.runConfig.profileCloneFolder, ignore_errors = True)
+      del self.runConfig.profileCloneFolder
+    if(self.previousTmpDir is None):
+      del os.environ['TMPDIR']
+    else:
+      os.environ['TMPDIR'] = self.previousTmpDir
+    tempfile.tempdir = None
+    self.tmpDir = None
 
   
   """
@@ -369,39 +1213,118 @@ class Crawler:
    - if there are more proxies than thread then they are distributed among threads
      as equally as possible
   """
-  def getProxyAssignment(self):
+  def getProxyAssignment(self, numWorkers):
     
-    if(len(self.webProxies) < self.numThreads):
-      return [self.webProxies] * self.numThreads
+    if(len(self.webProxies) < numWorkers):
+      return [self.webProxies] * numWorkers
       
-    assignments = [[] for i in range(self.numThreads)] 
+    assignments = [[] for i in range(numWorkers)] 
     for j in range(len(self.webProxies)):
-      i = j % self.numThreads
+      i = j % numWorkers
       assignments[i].append(self.webProxies[j])
     return assignments
       
   
+  """
+  Name of the scrape type in the crawl_jobs table, empty if workers visit with all scrape types
+  """
+  def getScrapeTypeName(self, workType):
+  
+    if(workType is None):
+      return ''
+    return workType['name']
+    
+    
+  """
+  Schedules the targets that were not visited yet.
+  With scrapeType dispatch each scrape type gets the targets it didn't visit yet.
+  Returns a list of (scrapeType, jobs) pairs.
+  """
+  def scheduleWorkLists(self, db):
+  
+    workLists = []
+    workTypes = self.getWorkTypes()
+    for typeIndex in range(len(workTypes)):
+      workType = workTypes[typeIndex]
+      if(workType is None):
+        scrapeTypes = self.runConfig.scrapeTypes
+      else:
+        scrapeTypes = [workType]
+      cur = db.getUncrawledTargets(self.day,self.runConfig.experimentName,scrapeTypes)
+      # Each scrape type gets its own order, otherwise the workers of the types would visit
+      # the same targets at the same time and TargetSpacing would defer most jobs
+      workLists.append((workType, scheduleJobs(db,list(cur),self.day,
+                                               self.runConfig.scheduleSpacing,self.runConfig.dnsIntensity,
+                                               seedOffset=typeIndex)))
+      cur.close()
+    return workLists
+    
+    
+  """
+  Schedules and saves the crawl plan of an attempt to the crawl_jobs table 
+  unless it was saved already (possibly by another crawler node).
+  """
+  def createCrawlPlan(self, db, attempt):
+  
+    if(db.hasCrawlPlan(self.day,self.runConfig.experimentName,attempt)):
+      return
+    plans = [(self.getScrapeTypeName(x[0]),[job[0] for job in x[1]]) for x in self.scheduleWorkLists(db)]
+    db.addCrawlPlan(self.day,self.runConfig.experimentName,attempt,plans)
+    
+    
+  """
+  Work lists leasing the jobs of the saved crawl plan of an attempt
+  """
+  def getLeasedWorkLists(self, db, attempt):
+  
+    self.createCrawlPlan(db, attempt)
+    workLists = []
+    for workType in self.getWorkTypes():
+      scrapeTypeName = self.getScrapeTypeName(workType)
+      numJobs = db.countOpenCrawlJobs(self.day,self.runConfig.experimentName,attempt,scrapeTypeName)
+      workLists.append((workType, LeaseQueue(self.runConfig, attempt, scrapeTypeName, numJobs)))
+    return workLists
+    
+      
   """
   The main function to run the crawler.
   """
   def followLinks(self):
 
     linksFollowed = 0
+    self.createTmpFolder()
+    metricsServer = self.startMetricsServer()
+    if(self.jobQueue == 'database'):
+      db = RedirectDB(self.runConfig)
+      releaseDeadLeases(db)
+      db.close()
     # Try crawling all pages from where we don't have even one successful screenshot multiple times
     for i in range(self.numCrawlAttempts):
       db = RedirectDB(self.runConfig)
-      cur = db.getUncrawledTargets(self.day,self.runConfig.experimentName,self.runConfig.scrapeTypes)
-      links = scheduleJobs(db,list(cur),self.day)
+      # The plan of the db job queue is shared by all crawler nodes and survives crashes
+      if(self.jobQueue == 'database'):
+        workLists = self.getLeasedWorkLists(db, i)
+      else:
+        workLists = self.scheduleWorkLists(db)
       print('Jobs scheduled')
+      numJobs = max([len(x[1]) for x in workLists])
           
+      # Persistent workers visit all jobs in one pool and replace themselves
+      # one at a time to keep the infrastructure fresh.
+      # Jobs leased from the db are always visited in one pool.
+      if(self.persistentWorkers or self.jobQueue == 'database'):
+        if(numJobs > 0):
+          linksFollowed += self.followLinksSample(workLists)
+          self.crawlStats['avoidedBatches'] += int((numJobs-1)/self.batchSize)
       # Execute jobs in smaller batches to solve the infrastructure going stale over time
-      n = self.batchSize
-      linksParts = [links[i:i+n] for i in range(0,len(links),n)]
-      for linksPart in linksParts:
-        linksFollowed += self.followLinksSample(linksPart)
+      else:
+        n = self.batchSize
+        for j in range(0,numJobs,n):
+          linksFollowed += self.followLinksSample([(x[0],x[1][j:j+n]) for x in workLists])
             
-      cur.close()
       db.close()
+    self.stopSharedProxies()
     self.cleanTmpFolder()
+    if(metricsServer is not None):
+      metricsServer.stop()
     return linksFollowed
-
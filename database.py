@@ -19,20 +19,30 @@ class RedirectDB:
   def __init__(self, runConfig):
     
     self.dbname = runConfig.dbname
+    self.runConfig = runConfig
     if(runConfig.dbuser is not None and runConfig.dbuser != ''):
       print('Remote connection')
-      self.db = psycopg2.connect(dbname = runConfig.dbname, 
-                                  user = runConfig.dbuser, 
-                                  password = runConfig.dbpwd,
-                                  host = runConfig.dbhost,
-                                  port = runConfig.dbport)
-    else:
-      self.db = psycopg2.connect(dbname = runConfig.dbname)
+    self.db = self.connect()
+    # Connection of the HAR bodies, opened when the first bodies are saved
+    self.bodyDb = None
+    
+    
+  def connect(self):
+  
+    if(self.runConfig.dbuser is not None and self.runConfig.dbuser != ''):
+      return psycopg2.connect(dbname = self.runConfig.dbname, 
+                              user = self.runConfig.dbuser, 
+                              password = self.runConfig.dbpwd,
+                              host = self.runConfig.dbhost,
+                              port = self.runConfig.dbport)
+    return psycopg2.connect(dbname = self.runConfig.dbname)
     
     
   def close(self):
   
     self.db.close()
+    if(self.bodyDb is not None):
+      self.bodyDb.close()
 
 
   def getDatabase(self):
@@ -158,6 +168,157 @@ class RedirectDB:
     return nameServers
 
 
+  """
+  Checks if the crawl plan of the given attempt has been saved already
+  """
+  def hasCrawlPlan(self, day, experimentName, attempt):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT EXISTS (SELECT 1 FROM crawl_jobs 
+                      WHERE day_added = %s AND experiment_name = %s AND attempt = %s)""",
+                  [day, experimentName, attempt])
+      return cur.fetchone()[0]
+      
+      
+  """
+  Saves the scheduled crawl plan of one attempt, plans is a list of 
+  (scrapeTypeName, targetIds) pairs in the order they should be visited.
+  Several crawler nodes may try to save the same plan, only the first one is kept.
+  """
+  def addCrawlPlan(self, day, experimentName, attempt, plans):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT pg_advisory_xact_lock(hashtext(%s))""", ['crawl_jobs '+experimentName+' '+day])
+      cur.execute("""SELECT EXISTS (SELECT 1 FROM crawl_jobs 
+                      WHERE day_added = %s AND experiment_name = %s AND attempt = %s)""",
+                  [day, experimentName, attempt])
+      if(not cur.fetchone()[0]):
+        for scrapeTypeName, targetIds in plans:
+          data = [(targetId, day, experimentName, attempt, scrapeTypeName, position) 
+                  for position, targetId in enumerate(targetIds)]
+          psycopg2.extras.execute_values(cur, """INSERT INTO crawl_jobs (target_id, day_added, 
+                                                  experiment_name, attempt, scrape_type, position) 
+                                                  VALUES %s""", data, page_size=1000)
+    self.db.commit()
+    
+    
+  """
+  Returns the target ids of a saved crawl plan in the order they are visited
+  """
+  def getCrawlPlanTargetIds(self, day, experimentName, attempt):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT target_id FROM crawl_jobs 
+                      WHERE day_added = %s AND experiment_name = %s AND attempt = %s 
+                      GROUP BY target_id ORDER BY MIN(position)""",
+                  [day, experimentName, attempt])
+      return [x[0] for x in cur]
+      
+      
+  """
+  Number of jobs of a crawl plan that are not done yet
+  """
+  def countOpenCrawlJobs(self, day, experimentName, attempt, scrapeTypeName):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT COUNT(*) FROM crawl_jobs 
+                      WHERE day_added = %s AND experiment_name = %s AND attempt = %s 
+                      AND scrape_type = %s AND status != 'done'""",
+                  [day, experimentName, attempt, scrapeTypeName])
+      return cur.fetchone()[0]
+      
+      
+  """
+  Leases the next pending job (or a job whose lease expired) of a crawl plan.
+  Returns the job in the same format as getUncrawledTargets with the job_id appended
+  or None if there is no job to lease right now.
+  """
+  def leaseCrawlJob(self, day, experimentName, attempt, scrapeTypeName, owner, leaseTimeout):
+  
+    query = """WITH next AS (SELECT job_id FROM crawl_jobs 
+                  WHERE day_added = %s AND experiment_name = %s AND attempt = %s AND scrape_type = %s 
+                  AND (status = 'pending' OR (status = 'leased' AND lease_expires < now())) 
+                  ORDER BY position LIMIT 1 
+                  FOR UPDATE SKIP LOCKED) 
+                UPDATE crawl_jobs c SET status = 'leased', lease_owner = %s, 
+                  lease_expires = now() + %s * interval '1 second' 
+                FROM next, targets t 
+                WHERE c.job_id = next.job_id AND t.target_id = c.target_id 
+                RETURNING t.target_id, t.time_added, t.target_type, t.day_added, t.url, c.job_id"""
+    with self.db.cursor() as cur:
+      cur.execute(query, [day, experimentName, attempt, scrapeTypeName, owner, leaseTimeout])
+      job = cur.fetchone()
+    self.db.commit()
+    if(job is None):
+      return None
+    return list(job)
+    
+    
+  """
+  Number of jobs of a crawl plan that are leased by other owners and the lease didn't expire
+  """
+  def countActiveLeases(self, day, experimentName, attempt, scrapeTypeName, owner):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT COUNT(*) FROM crawl_jobs 
+                      WHERE day_added = %s AND experiment_name = %s AND attempt = %s 
+                      AND scrape_type = %s AND status = 'leased' AND lease_expires >= now() 
+                      AND lease_owner != %s""",
+                  [day, experimentName, attempt, scrapeTypeName, owner])
+      count = cur.fetchone()[0]
+    self.db.commit()
+    return count
+    
+    
+  def renewCrawlJobLeases(self, owner, leaseTimeout):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""UPDATE crawl_jobs SET lease_expires = now() + %s * interval '1 second' 
+                      WHERE lease_owner = %s AND status = 'leased'""", [leaseTimeout, owner])
+    self.db.commit()
+    
+    
+  def completeCrawlJob(self, jobId, owner):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""UPDATE crawl_jobs SET status = 'done', lease_expires = NULL 
+                      WHERE job_id = %s AND lease_owner = %s""", [jobId, owner])
+    self.db.commit()
+    
+    
+  """
+  Gives back the leased jobs of the owners so other crawlers can take them immediately.
+  ownerPattern is a LIKE pattern.
+  """
+  def releaseCrawlJobLeases(self, ownerPattern):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""UPDATE crawl_jobs SET status = 'pending', lease_owner = NULL, lease_expires = NULL 
+                      WHERE lease_owner LIKE %s AND status = 'leased'""", [ownerPattern])
+    self.db.commit()
+    
+    
+  def getLeaseOwners(self, ownerPattern):
+  
+    with self.db.cursor() as cur:
+      cur.execute("""SELECT DISTINCT lease_owner FROM crawl_jobs 
+                      WHERE lease_owner LIKE %s AND status = 'leased'""", [ownerPattern])
+      return [x[0] for x in cur]
+
+
+  """
+  Returns the first name server of each typo target
+  """
+  def getNameserversByTarget(self,typoIds):
+  
+    nameServers = {}
+    with self.db.cursor() as c:
+      c.execute("""SELECT target_id, name_server FROM typo_targets WHERE target_id = ANY(%s)""", [typoIds])
+      for row in c:
+        nameServers[row[0]] = row[1].split(';')[0]
+    return nameServers
+
+
   def addTyposquatting(self, targets, type, runConfig):
   
     with self.db.cursor() as cur:
@@ -285,6 +446,16 @@ class RedirectDB:
     return config_id
     
     
+  """
+  The HARs of LinkFollow are already compressed and stored as they are
+  """
+  def compressHar(self, har):
+  
+    if(isinstance(har, bytes)):
+      return har
+    return zlib.compress(har.encode("utf-8"))
+    
+    
   def compressDict(self, dictObject):
   
     return zlib.compress(pickle.dumps(dictObject))
@@ -295,7 +466,7 @@ class RedirectDB:
     for name,item in results.items():
       result = item['result']
       scrapeType = item['scrapeType']
-      data = [None] * 21
+      data = [None] * 22
       data[0] = target_id
       data[1] = runConfig.configId
       data[2] = scrapeType['name']
@@ -308,16 +479,17 @@ class RedirectDB:
       data[6] = scrapeType['browser']
       data[7] = scrapeType['mobile']
       data[8] = result[0] # time
-      data[9] = zlib.compress(result[4].encode("utf-8")) # har
+      data[9] = self.compressHar(result[4]) # har
       data[10] = zlib.compress(result[6].encode("utf-8")) # perflog
       data[11] = zlib.compress(result[3].encode("utf-8")) # html
       data[12] = zlib.compress(result[5]) # screenshot
       data[19] = result[2] # landing url
       data[20] = result[8]# proxy
+      data[21] = result[9] # rule that ended the dwell
       if(result[7] is not None and result[7]['perWindowData'] is not None):
         perWindowData = result[7]['perWindowData']
         data[13] = self.compressDict({k:i[2] for k,i in perWindowData.items()})
-        data[14] = zlib.compress(result[7]['har'].encode("utf-8"))
+        data[14] = self.compressHar(result[7]['har'])
         data[15] = self.compressDict({k:i[1] for k,i in perWindowData.items()})
         data[16] = self.compressDict({k:i[0] for k,i in perWindowData.items()})
         data[17] = self.compressDict({k:i[3] for k,i in perWindowData.items()})
@@ -327,17 +499,83 @@ class RedirectDB:
                       useragent, referrer, browser_type, mobile_emulation, scrape_time,
                       har, performance_log, html, screenshot, after_click_urls, 
                       after_click_har, after_click_htmls, after_click_screenshots, 
-                      after_click_landing_urls, after_click_perflogs,landing_url, http_proxy)
-                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""")
+                      after_click_landing_urls, after_click_perflogs,landing_url, http_proxy, dwell_end)
+                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                      RETURNING scrape_id""")
       
+      try:
+        self.addHarBodies(result[12])
+      except Exception as e:
+        print('Saving HAR bodies to db failed: ', e)
+        print('Target id: ',target_id)
+      # A failed scrape is rolled back alone, the other scrapes of the transaction are kept
       with self.db.cursor() as cur:
         try:
+          cur.execute('SAVEPOINT scrape')
           cur.execute(query, data)
+          scrape_id = cur.fetchone()[0]
+          self.addScreenshotHashes(cur, target_id, scrape_id, result)
+          self.addDownloadHashes(cur, target_id, scrape_id, result)
+          cur.execute('RELEASE SAVEPOINT scrape')
         except Exception as e:
           print('Saving to db failed: ', e)
           print('Target id: ',target_id)
+          cur.execute('ROLLBACK TO SAVEPOINT scrape')
       
     
+  """
+  Saves the hashes computed when the screenshots were taken, so imageClustering
+  doesn't have to load the screenshots to hash them
+  """
+  def addScreenshotHashes(self, cur, target_id, scrape_id, result):
+  
+    rows = [(None, hashType, hash) for hashType, hash in result[10].items()]
+    if(result[7] is not None and result[7]['perWindowData'] is not None):
+      for windowId, item in result[7]['perWindowData'].items():
+        rows.extend([(windowId, hashType, hash) for hashType, hash in item[5].items()])
+    query = ("""INSERT INTO perceptual_hashes (target_id, scrape_id, hash, maliciousness, window_id, hash_type)
+                VALUES (%s, %s, %s, %s, %s, %s)""")
+    for windowId, hashType, hash in rows:
+      cur.execute(query, [target_id, scrape_id, hash, 'unknown', windowId, hashType])
+      
+      
+  """
+  Saves the hashes of the files downloaded during the scrape, computed when the downloads finished
+  """
+  def addDownloadHashes(self, cur, target_id, scrape_id, result):
+  
+    query = ("""INSERT INTO downloads_hashes (target_id, scrape_id, filename, sha256, md5) 
+                VALUES (%s, %s, %s, %s, %s)""")
+    for filename, sha256Hash, md5Hash in result[11]:
+      cur.execute(query, [target_id, scrape_id, filename, sha256Hash, md5Hash])
+      
+      
+  """
+  Saves the response bodies taken out of the HARs, once per sha256. The bodies are
+  shared by the workers, so they are committed right away on their own connection
+  instead of being locked until the scrapes are committed, and inserted in sha256
+  order so two workers saving the same bodies can't deadlock.
+  """
+  def addHarBodies(self, bodies):
+  
+    if(len(bodies) == 0):
+      return
+    if(self.bodyDb is None or self.bodyDb.closed):
+      self.bodyDb = self.connect()
+    query = ("""INSERT INTO har_bodies (sha256, body, encoding, size) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (sha256) DO NOTHING""")
+    try:
+      with self.bodyDb.cursor() as cur:
+        for bodyRef in sorted(bodies):
+          body = bodies[bodyRef]
+          text = body['text'].encode('utf-8', 'surrogatepass')
+          cur.execute(query, [bodyRef, zlib.compress(text), body['encoding'], len(text)])
+      self.bodyDb.commit()
+    except Exception as e:
+      self.bodyDb.rollback()
+      raise
+      
+      
   def getDailyScrapeStats(self,day):
   
     query = """SELECT 
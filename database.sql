@@ -70,16 +70,49 @@ CREATE TABLE scrapes (
   after_click_landing_urls  BYTEA,
   after_click_perflogs      BYTEA,
   landing_url               TEXT,
-  http_proxy                TEXT
+  http_proxy                TEXT,
+  dwell_end                 TEXT
 );  
 
+CREATE TABLE crawl_jobs (
+  job_id            SERIAL NOT NULL PRIMARY KEY,
+  target_id         INTEGER NOT NULL REFERENCES targets(target_id),
+  day_added         TEXT NOT NULL,
+  experiment_name   TEXT NOT NULL,
+  attempt           INTEGER NOT NULL,
+  scrape_type       TEXT NOT NULL,
+  position          INTEGER NOT NULL,
+  status            TEXT NOT NULL DEFAULT 'pending',
+  lease_owner       TEXT,
+  lease_expires     TIMESTAMP WITH TIME ZONE,
+  UNIQUE (day_added, experiment_name, attempt, scrape_type, target_id)
+);
+CREATE INDEX crawl_jobs_plan ON crawl_jobs("day_added", "experiment_name", "attempt", "scrape_type", "status", "position");
+
 CREATE TABLE perceptual_hashes (
   hash_id       SERIAL NOT NULL PRIMARY KEY,
   target_id     INTEGER NOT NULL REFERENCES targets(target_id),
   scrape_id     INTEGER NOT NULL REFERENCES scrapes(scrape_id),
   hash          TEXT NOT NULL,
   maliciousness TEXT NOT NULL,
-  window_id     INTEGER  
+  window_id     INTEGER,
+  hash_type     TEXT NOT NULL DEFAULT 'dhash'
+);
+
+CREATE TABLE har_bodies (
+  sha256        TEXT NOT NULL PRIMARY KEY,
+  body          BYTEA NOT NULL,
+  encoding      TEXT,
+  size          INTEGER NOT NULL
+);
+
+CREATE TABLE downloads_hashes (
+  download_id   SERIAL NOT NULL PRIMARY KEY,
+  target_id     INTEGER NOT NULL REFERENCES targets(target_id),
+  scrape_id     INTEGER REFERENCES scrapes(scrape_id),
+  filename      TEXT NOT NULL,
+  sha256        TEXT NOT NULL,
+  md5           TEXT NOT NULL
 );
 
 CREATE TABLE redirect_stats (
@@ -0,0 +1,368 @@
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime
+from datetime import timezone
+from urllib.parse import urlparse, parse_qsl
+
+from bodyStore import extractBody, isBodyCaptured
+
+
+PROTOCOLS = {'http/0.9':'HTTP/0.9', 'http/1.0':'HTTP/1.0', 'http/1.1':'HTTP/1.1',
+             'h2':'HTTP/2.0', 'h2c':'HTTP/2.0', 'spdy':'HTTP/2.0', 'quic':'HTTP/3.0'}
+
+
+"""
+Adds the chromedriver endpoints to send DevTools commands to a selenium driver
+"""
+def addDevtoolsCommands(driver):
+
+  driver.command_executor._commands["send_command"] = ("POST", '/session/$sessionId/chromium/send_command')
+  driver.command_executor._commands["send_command_and_get_result"] = ("POST",
+                                                                     '/session/$sessionId/chromium/send_command_and_get_result')
+
+
+"""
+Sends a DevTools command to the current window of the driver and returns its result
+"""
+def sendDevtoolsCommand(driver, cmd, params = {}):
+
+  return driver.execute("send_command_and_get_result", {'cmd': cmd, 'params': params})['value']
+
+
+"""
+Converts a DevTools headers object to HAR name/value pairs.
+DevTools joins repeated headers with new lines.
+"""
+def nameValue(headers):
+
+  pairs = []
+  for name, value in headers.items():
+    for v in str(value).split('\n'):
+      pairs.append({"name": name, "value": v})
+  return pairs
+
+
+def getHeader(headers, key):
+
+  for name, value in headers.items():
+    if(name.lower() == key):
+      return str(value).split('\n')[0]
+  return ''
+
+
+class DevtoolsHar:
+
+
+  """
+  Builds a HAR of the requests of a page from the Network events of the Chrome
+  performance log, so no mitmproxy is needed to capture the traffic. The HAR has
+  the fields that mitmInterceptor.py fills and redirectChainExtractor uses:
+  requests and responses with headers, status, redirectURL, body sizes and the
+  response bodies. Requests that never got a response are left out like in the
+  mitm capture. Bodies are fetched with Network.getResponseBody from the window
+  that is current when fetchBodies is called. Bodies of at least bodyMinSize
+  characters are returned separately by getHar. Only the bodies of the bodyTypes
+  content types of at most bodyMaxSize bytes are fetched, see bodyStore.isBodyCaptured.
+  """
+  def __init__(self, driver, maxBodySize, bodyMinSize = 0, bodyTypes = (), bodyMaxSize = 0):
+
+    self.driver = driver
+    self.maxBodySize = maxBodySize
+    self.bodyMinSize = bodyMinSize
+    self.bodyTypes = tuple([x.lower() for x in bodyTypes])
+    self.bodyMaxSize = bodyMaxSize
+    self.pageref = None
+    self.startedDateTime = None
+    self.active = {}
+    self.entries = []
+
+
+  """
+  Raises the DevTools buffers so the bodies are still there when the HAR is built
+  """
+  def enable(self):
+
+    sendDevtoolsCommand(self.driver, 'Network.enable', {'maxTotalBufferSize': 20*self.maxBodySize,
+                                                        'maxResourceBufferSize': self.maxBodySize})
+
+
+  def start(self, url):
+
+    self.pageref = url
+    self.startedDateTime = datetime.now(timezone.utc).astimezone().isoformat()
+    self.active = {}
+    self.entries = []
+
+
+  """
+  Processes performance log entries of the page
+  """
+  def addLog(self, performanceLog):
+
+    if(self.pageref is None):
+      return
+    for log in performanceLog:
+      message = log['message']
+      if(isinstance(message, str)):
+        # Skip the json parsing of the events that are not needed
+        if('"Network.' not in message):
+          continue
+        message = json.loads(message)
+      method = message['message']['method']
+      params = message['message']['params']
+      if(method == 'Network.requestWillBeSent'):
+        self.requestWillBeSent(params)
+      elif(method == 'Network.responseReceived'):
+        record = self.active.get(params['requestId'])
+        if(record is not None):
+          record['response'] = params['response']
+          record['responseTime'] = params['timestamp']
+      elif(method == 'Network.loadingFinished'):
+        record = self.active.pop(params['requestId'], None)
+        if(record is not None and record['response'] is not None):
+          record['endTime'] = params['timestamp']
+          record['encodedDataLength'] = params['encodedDataLength']
+          self.entries.append(record)
+      elif(method == 'Network.loadingFailed'):
+        record = self.active.pop(params['requestId'], None)
+        if(record is not None and record['response'] is None and 'blockedReason' in params):
+          # Suppressed heavy resources are kept in the HAR without a response
+          record['response'] = {'status': 0, 'statusText': 'blocked: ' + params['blockedReason'], 'headers': {}}
+          record['body'] = {}
+        if(record is not None and record['response'] is not None):
+          record['endTime'] = params['timestamp']
+          self.entries.append(record)
+
+
+  def requestWillBeSent(self, params):
+
+    requestId = params['requestId']
+    # Redirects reuse the request id, the response of the previous hop comes with the new request
+    previous = self.active.pop(requestId, None)
+    if(previous is not None and 'redirectResponse' in params):
+      previous['response'] = params['redirectResponse']
+      previous['responseTime'] = params['timestamp']
+      previous['endTime'] = params['timestamp']
+      previous['redirect'] = True
+      self.entries.append(previous)
+    self.active[requestId] = {'requestId': requestId, 'request': params['request'],
+                              'wallTime': params.get('wallTime', time.time()),
+                              'startTime': params['timestamp'], 'responseTime': None,
+                              'endTime': None, 'response': None, 'encodedDataLength': None,
+                              'redirect': False, 'body': None, 'captured': True}
+
+
+  """
+  Fetches the bodies of the finished responses that don't have one yet
+  """
+  def fetchBodies(self):
+
+    for record in self.entries:
+      if(record['body'] is not None or record['redirect']):
+        continue
+      if(record['encodedDataLength'] is not None and record['encodedDataLength'] > self.maxBodySize):
+        continue
+      if(not isBodyCaptured(getHeader(record['response']['headers'], 'content-type'), record['encodedDataLength'],
+                            self.bodyTypes, self.bodyMaxSize)):
+        record['body'] = {}
+        record['captured'] = False
+        continue
+      try:
+        record['body'] = sendDevtoolsCommand(self.driver, 'Network.getResponseBody',
+                                             {'requestId': record['requestId']})
+      except Exception as e:
+        # The body is not available (other window, evicted from the buffer or no body)
+        record['body'] = {}
+
+
+  def getEntry(self, record, bodies):
+
+    request = record['request']
+    response = record['response']
+    startedDateTime = datetime.fromtimestamp(record['wallTime'], timezone.utc).astimezone().isoformat()
+    timings = {'send': 0, 'wait': -1, 'receive': -1, 'connect': -1, 'ssl': -1}
+    if(record['responseTime'] is not None):
+      timings['wait'] = int(1000*(record['responseTime'] - record['startTime']))
+    if(record['endTime'] is not None and record['responseTime'] is not None):
+      timings['receive'] = int(1000*(record['endTime'] - record['responseTime']))
+    bodySize = 0
+    if(record['encodedDataLength'] is not None):
+      bodySize = max(0, record['encodedDataLength'] - response.get('encodedDataLength', 0))
+    content = {"size": bodySize, "compression": 0, "mimeType": getHeader(response['headers'], 'content-type')}
+    body = record['body']
+    if(body is not None and 'body' in body):
+      if(body.get('base64Encoded', False)):
+        content["text"] = body['body']
+        content["encoding"] = "base64"
+        content["size"] = int(len(body['body'])*3/4)
+      else:
+        content["text"] = body['body']
+        content["size"] = len(body['body'].encode('utf-8', 'ignore'))
+      content["compression"] = content["size"] - bodySize
+      extractBody(content, self.bodyMinSize, bodies)
+    elif(not record['captured']):
+      content["comment"] = "body not captured"
+    httpVersion = PROTOCOLS.get(response.get('protocol', ''), 'HTTP/1.1')
+    entry = {
+      "pageref": self.pageref,
+      "startedDateTime": startedDateTime,
+      "time": sum(v for v in timings.values() if v > -1),
+      "request": {
+        "method": request['method'],
+        "url": request['url'],
+        "httpVersion": httpVersion,
+        "cookies": [],
+        "headers": nameValue(response.get('requestHeaders', request['headers'])),
+        "queryString": [{"name": k, "value": v} for k, v in parse_qsl(urlparse(request['url']).query)],
+        "headersSize": -1,
+        "bodySize": len(request.get('postData', '')),
+      },
+      "response": {
+        "status": response['status'],
+        "statusText": response.get('statusText', ''),
+        "httpVersion": httpVersion,
+        "cookies": [],
+        "headers": nameValue(response['headers']),
+        "content": content,
+        "redirectURL": getHeader(response['headers'], 'location'),
+        "headersSize": -1,
+        "bodySize": bodySize,
+      },
+      "cache": {},
+      "timings": timings,
+    }
+    if('postData' in request):
+      entry["request"]["postData"] = {"mimeType": getHeader(request['headers'], 'content-type'),
+                                      "text": request['postData'], "params": []}
+    if(response.get('remoteIPAddress', '') != ''):
+      entry["serverIPAddress"] = response['remoteIPAddress']
+    return entry
+
+
+  """
+  Returns the HAR and its bodies like Proxy.getHar and stops collecting
+  """
+  def getHar(self, compress = False):
+
+    bodies = {}
+    if(self.pageref is None):
+      har = {}
+    else:
+      har = self.buildHar(bodies)
+    if(compress):
+      return zlib.compress(json.dumps(har).encode('utf-8', 'surrogatepass')), bodies
+    return json.dumps(har), bodies
+
+
+  def buildHar(self, bodies):
+
+
+    har = {
+      "log": {
+        "version": "1.2",
+        "creator": {"name": "odin devtools capture", "version": "0.1", "comment": ""},
+        "pages": [{
+          "id": self.pageref,
+          "startedDateTime": self.startedDateTime,
+          "title": self.pageref,
+          "pageTimings": {"comment": ""}, "comment": ""}],
+        "entries": [self.getEntry(x, bodies) for x in self.entries]
+      }}
+    self.pageref = None
+    self.active = {}
+    self.entries = []
+    return har
+
+
+"""
+Sum of the resident memory of the given processes in MB
+"""
+def getMemoryMb(pids):
+
+  total = 0
+  for pid in pids:
+    try:
+      with open('/proc/' + str(pid) + '/status') as fin:
+        for line in fin:
+          if(line.startswith('VmRSS:')):
+            total += int(line.split()[1])
+    except OSError:
+      pass
+  return total/1024
+
+
+"""
+Processes in the process group of this process, except this process
+"""
+def getGroupProcesses():
+
+  pids = []
+  pgid = os.getpgid(0)
+  for name in os.listdir('/proc'):
+    if(name.isdigit() and int(name) != os.getpid()):
+      try:
+        if(os.getpgid(int(name)) == pgid):
+          pids.append(int(name))
+      except OSError:
+        pass
+  return pids
+
+
+"""
+Visits the urls with one browser per scrape type in both capture modes and
+reports the time, the number of processes, their memory and the HAR entries.
+Only scrape types without referer are used, those always need the proxy.
+"""
+def benchmark(configFile, urls):
+
+  from pyvirtualdisplay import Display
+  from config import Config
+  from linkFollow import LinkFollow
+  from proxy import Proxy
+
+  os.setpgid(0, 0)
+  runConfig = Config(configFile)
+  scrapeTypes = [x for x in runConfig.scrapeTypes if not x['ref']]
+  display = Display(visible = 0, size = (1280, 768))
+  display.start()
+  print('mode, seconds, processes, memory MB, har entries')
+  for mode in ['mitm', 'devtools']:
+    runConfig.networkCapture = mode
+    start = time.time()
+    linkFollowers = []
+    proxies = []
+    for scrapeType in scrapeTypes:
+      proxy = None
+      if(mode == 'mitm'):
+        proxy = Proxy(None, runConfig.proxyStartTimeout)
+        proxy.startProxy()
+        proxies.append(proxy)
+      linkFollowers.append(LinkFollow(0, runConfig, scrapeType, proxy))
+    pids = getGroupProcesses()
+    memory = getMemoryMb(pids)
+    numEntries = 0
+    for url in urls:
+      for linkFollower in linkFollowers:
+        result = linkFollower.followLink(url)
+        if(result is not None and result[4] != ''):
+          har = zlib.decompress(result[4]).decode('utf-8', 'surrogatepass')
+          numEntries += len(json.loads(har).get('log', {}).get('entries', []))
+        memory = max(memory, getMemoryMb(getGroupProcesses()))
+    took = time.time() - start
+    for linkFollower in linkFollowers:
+      linkFollower.driver.quit()
+    for proxy in proxies:
+      proxy.close()
+    print(mode, round(took,1), len(pids), round(memory), numEntries, flush=True)
+  display.stop()
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 3):
+    print('Usage: python devtoolsCapture.py runConfig.txt url [url ...]')
+    exit()
+  benchmark(sys.argv[1], sys.argv[2:])
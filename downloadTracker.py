@@ -0,0 +1,96 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import struct
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+EVENT_HEADER = struct.Struct('iIII')
+# Suffixes of the files that are not finished downloads
+PARTIAL_SUFFIXES = ('.crdownload', '.tmp', '.tds.')
+
+
+"""
+Sha256 and md5 of a file in one streaming pass, so large downloads are not read into memory
+"""
+def hashFile(fileName, chunkSize = 1 << 20):
+
+  sha256 = hashlib.sha256()
+  md5 = hashlib.md5()
+  with open(fileName, mode = 'rb') as fin:
+    chunk = fin.read(chunkSize)
+    while(chunk):
+      sha256.update(chunk)
+      md5.update(chunk)
+      chunk = fin.read(chunkSize)
+  return sha256.hexdigest(), md5.hexdigest()
+
+
+class DownloadTracker:
+
+
+  """
+  Tracks the finished downloads of a download folder with inotify. Chrome writes
+  a download to a .crdownload file and renames it when it is complete, so a file
+  moved into the folder (or closed after writing) is a finished download.
+  Falls back to listing the folder if inotify is not available.
+  """
+  def __init__(self, folder):
+
+    self.folder = folder
+    self.fd = None
+    self.pending = set()
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+      fd = libc.inotify_init1(IN_NONBLOCK)
+      if(fd >= 0 and libc.inotify_add_watch(fd, folder.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) >= 0):
+        self.fd = fd
+      elif(fd >= 0):
+        os.close(fd)
+    except (OSError, AttributeError):
+      self.fd = None
+
+
+  def isDownload(self, name):
+
+    return not name.endswith(PARTIAL_SUFFIXES) and os.path.isfile(os.path.join(self.folder, name))
+
+
+  def readEvents(self):
+
+    while(True):
+      try:
+        buffer = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return
+      offset = 0
+      while(offset < len(buffer)):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+        offset += EVENT_HEADER.size
+        name = buffer[offset:offset+length].rstrip(b'\0').decode('utf-8', 'ignore')
+        offset += length
+        self.pending.add(name)
+
+
+  """
+  Returns the paths of the downloads finished since the last call
+  """
+  def getFinished(self):
+
+    if(self.fd is None):
+      names = os.listdir(self.folder)
+    else:
+      self.readEvents()
+      names = self.pending
+      self.pending = set()
+    return [os.path.join(self.folder, x) for x in sorted(names) if self.isDownload(x)]
+
+
+  def close(self):
+
+    if(self.fd is not None):
+      os.close(self.fd)
+      self.fd = None
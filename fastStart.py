@@ -0,0 +1,179 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+import logging
+import traceback
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+
+
+CHROMEDRIVER = 'prereqs/chromedriver-v74/chromedriver'
+EXTENSIONS = ['Sheets_v1.2.crx', 'Docs_v0.10.crx', 'Referer-Control_v1.32.crx']
+# Files Chrome uses to lock a user data dir, a clone must not have the ones of the template
+LOCK_FILES = ['SingletonLock', 'SingletonSocket', 'SingletonCookie']
+
+
+def getExtensionsDir(runConfig):
+
+  return os.path.join(runConfig.profileTemplateFolder, 'extensions')
+
+
+def getExtensionDir(runConfig, crxName):
+
+  return os.path.join(getExtensionsDir(runConfig), crxName[:-len('.crx')])
+
+
+def getTemplateDir(runConfig):
+
+  return os.path.join(runConfig.profileTemplateFolder, 'profile')
+
+
+"""
+Folder of the profile clones of a crawl, the crawler sets it to a folder it removes at the end
+"""
+def getCloneFolder(runConfig):
+
+  if(hasattr(runConfig, 'profileCloneFolder')):
+    return runConfig.profileCloneFolder
+  return os.path.join(runConfig.profileTemplateFolder, 'clones')
+
+
+def isTemplateReady(runConfig):
+
+  return os.path.exists(os.path.join(runConfig.profileTemplateFolder, 'ready'))
+
+
+"""
+Creates the fast-start template in profileTemplateFolder (a tmpfs like /dev/shm):
+ - the extensions unpacked once, instead of chromedriver unpacking the .crx files
+   it gets base64 encoded in the capabilities at every start
+ - a user data dir Chrome already initialised with the extensions, so a clone
+   skips the first-run setup of a new profile
+"""
+def prepareTemplate(runConfig):
+
+  if(isTemplateReady(runConfig)):
+    return True
+  # The folder also has the profile clones of the crawls
+  shutil.rmtree(getExtensionsDir(runConfig), ignore_errors = True)
+  shutil.rmtree(getTemplateDir(runConfig), ignore_errors = True)
+  os.makedirs(getExtensionsDir(runConfig))
+  for crxName in EXTENSIONS:
+    # A .crx file is a zip file with a header, zipfile finds the archive after the header
+    with zipfile.ZipFile(os.path.join(runConfig.extensionsFolder, crxName)) as crx:
+      crx.extractall(getExtensionDir(runConfig, crxName))
+  opts = Options()
+  opts.add_argument("--no-sandbox")
+  opts.add_argument("--disable-dev-shm-usage")
+  opts.add_argument("--user-data-dir=" + getTemplateDir(runConfig))
+  opts.add_argument("--load-extension=" + ','.join([getExtensionDir(runConfig, x) for x in EXTENSIONS[:2]]))
+  driver = None
+  try:
+    driver = webdriver.Chrome(CHROMEDRIVER, chrome_options = opts)
+    driver.get('about:blank')
+    # Give the extensions and the profile time to be written
+    time.sleep(3)
+  except Exception as e:
+    logging.error(traceback.format_exc())
+    print('Creating the fast-start template failed')
+    return False
+  finally:
+    if(driver is not None):
+      driver.quit()
+  for name in LOCK_FILES:
+    try:
+      os.remove(os.path.join(getTemplateDir(runConfig), name))
+    except OSError:
+      pass
+  open(os.path.join(runConfig.profileTemplateFolder, 'ready'), 'w').close()
+  return True
+
+
+"""
+Copies the template user data dir for one browser, returns its path
+"""
+def cloneProfile(runConfig):
+
+  cloneFolder = getCloneFolder(runConfig)
+  os.makedirs(cloneFolder, exist_ok = True)
+  profileDir = tempfile.mkdtemp(prefix = 'profile-', dir = cloneFolder)
+  os.rmdir(profileDir)
+  shutil.copytree(getTemplateDir(runConfig), profileDir, symlinks = True)
+  return profileDir
+
+
+def removeProfile(profileDir):
+
+  if(profileDir is not None):
+    shutil.rmtree(profileDir, ignore_errors = True)
+
+
+"""
+Breaks the startup of a browser down to chromedriver spawn, Chrome launch,
+extension load and first navigation, with and without the fast-start template.
+The times are the means of repeat starts of the first scrape type:
+ - chromedriver spawn: starting and stopping chromedriver alone
+ - Chrome launch: a start without extensions minus the chromedriver spawn
+ - extension load: a start with the .crx extensions minus a start without
+ - fast start: a start from a clone of the template, including the copy
+ - first navigation: loading the url after the start
+"""
+def benchmark(configFile, url, repeat = 5):
+
+  from pyvirtualdisplay import Display
+  from selenium.webdriver.chrome.service import Service
+  from config import Config
+  from linkFollow import LinkFollow
+
+  runConfig = Config(configFile)
+  runConfig.networkCapture = 'devtools'
+  runConfig.fastStart = False
+  scrapeType = dict(runConfig.scrapeTypes[0], ref = False)
+  display = Display(visible = 0, size = (1280, 768))
+  display.start()
+  if(not prepareTemplate(runConfig)):
+    display.stop()
+    return
+  linkFollower = LinkFollow(0, runConfig, scrapeType, None)
+  linkFollower.driver.quit()
+
+  spawnTime = 0
+  for i in range(repeat):
+    start = time.time()
+    service = Service(CHROMEDRIVER)
+    service.start()
+    spawnTime += time.time() - start
+    service.stop()
+  times = {}
+  for mode in ['no extensions', 'extensions', 'fast start']:
+    linkFollower.fastStart = (mode == 'fast start')
+    times[mode] = [0, 0]
+    for i in range(repeat):
+      start = time.time()
+      driver = linkFollower._startChromeDriver(extensions = (mode != 'no extensions'))
+      times[mode][0] += time.time() - start
+      start = time.time()
+      driver.get(url)
+      times[mode][1] += time.time() - start
+      driver.quit()
+      linkFollower.removeProfile()
+  display.stop()
+  print('chromedriver spawn, seconds: ', round(spawnTime/repeat, 2))
+  print('Chrome launch, seconds: ', round((times['no extensions'][0] - spawnTime)/repeat, 2))
+  print('extension load, seconds: ', round((times['extensions'][0] - times['no extensions'][0])/repeat, 2))
+  print('start with extensions, seconds: ', round(times['extensions'][0]/repeat, 2))
+  print('fast start, seconds: ', round(times['fast start'][0]/repeat, 2))
+  print('first navigation, seconds: ', round(times['extensions'][1]/repeat, 2),
+        ' after fast start: ', round(times['fast start'][1]/repeat, 2))
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 3):
+    print('Usage: python fastStart.py runConfig.txt url [repeat]')
+    exit()
+  benchmark(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 5)
@@ -1,13 +1,13 @@
 import os
 import sys
 import csv
-import hashlib
 import psycopg2
 import psycopg2.extras
 import zlib
 import sys
 
 from database import RedirectDB
+from downloadTracker import hashFile
 
 
 def concatenateLogFiles(downloadFolder,day):
@@ -52,14 +52,15 @@ def saveHashes(logfile,db,day,experimentName):
     reader = csv.reader(flog)
     for row in reader:
       filename,url = row
-      with open(filename, mode='rb') as fin:
-        fileContent = fin.read()
-        sha256Hash = str(hashlib.sha256(fileContent).hexdigest())
-        md5Hash = str(hashlib.md5(fileContent).hexdigest())
-        targetId = getTargetId(db,url,day,experimentName)
-        saveHashesToDatabase(db,targetId,filename,sha256Hash,md5Hash)
+      sha256Hash, md5Hash = hashFile(filename)
+      targetId = getTargetId(db,url,day,experimentName)
+      saveHashesToDatabase(db,targetId,filename,sha256Hash,md5Hash)
   
   
+"""
+The crawler saves the download hashes with the scrapes, this is only needed
+for the download folders of crawls that didn't do that
+"""
 def getAndSaveHashesMain(runConfig):
 
   db = RedirectDB(runConfig)
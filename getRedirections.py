@@ -16,6 +16,7 @@ import sys
 
 import redirectChainExtractor as rce
 from database import RedirectDB
+from bodyStore import BodyLoader
 from config import Config
 
 
@@ -87,6 +88,7 @@ def saveRedirectionChains(targetId,scrapeId,windowId, crawlType, redirectionChai
 def getRedirectionsFromHar(runConfig,workQueue):
 
   db = RedirectDB(runConfig).db
+  bodyLoader = BodyLoader(db)
   while True:
     job = workQueue.get()
     if(len(job) == 1 and job[0] == "DONE"):
@@ -100,7 +102,7 @@ def getRedirectionsFromHar(runConfig,workQueue):
     if(perflog is None or len(perflog) == 0):
       print('perflog None')
       return
-    har = json.loads(har)
+    har = rce.loadHar(har, bodyLoader)
     performanceLog = json.loads(perflog)
     
     # main redirection chain
@@ -121,7 +123,7 @@ def getRedirectionsFromHar(runConfig,workQueue):
     
     # Secondary redirection chains after clicks
     if(afterClickhar is not None):
-      afterClickhar = json.loads(afterClickhar)
+      afterClickhar = rce.loadHar(afterClickhar, bodyLoader)
       for id, data in perWindowData.items():
         try:
           redirectionChain, contentDistribution, errorCodes, notused = rce.getRedirectChain(json.loads(data['perfLog']),afterClickhar,data['startUrl'],data['landingUrl'])
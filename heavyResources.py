@@ -0,0 +1,45 @@
+"""
+MIME classes of the heavy resources that can be suppressed, with the content type
+prefixes of the class and the file extensions used when there is no proxy
+"""
+HEAVY_TYPES = {
+  'video': (('video/', 'application/x-mpegurl', 'application/vnd.apple.mpegurl', 'application/dash+xml'),
+            ['mp4', 'webm', 'm3u8', 'mpd', 'mov', 'mkv', 'flv', 'avi']),
+  'audio': (('audio/',),
+            ['mp3', 'ogg', 'wav', 'm4a', 'aac', 'flac', 'opus']),
+  'font': (('font/', 'application/font', 'application/x-font', 'application/vnd.ms-fontobject'),
+           ['woff', 'woff2', 'ttf', 'otf', 'eot']),
+}
+
+
+"""
+Returns why a response should be suppressed or None:
+ - contentType and contentLength are the response headers, contentLength can be None
+ - maxSize is the largest body kept, 0 means no limit
+ - heavyTypes is the list of suppressed MIME classes
+"""
+def getSuppressReason(contentType, contentLength, maxSize, heavyTypes):
+
+  contentType = contentType.lower()
+  for heavyType in heavyTypes:
+    if(contentType.startswith(HEAVY_TYPES[heavyType][0])):
+      return heavyType
+  if(maxSize > 0 and contentLength is not None and contentLength > maxSize):
+    return 'size'
+  return None
+
+
+"""
+Url patterns for Network.setBlockedURLs, without a proxy the content type is not
+known before the response so the MIME classes are matched by file extension.
+A pattern matches the whole url, so the extension has to end the path, followed by
+nothing or a query, and can't match a hostname like www.movies.com.
+? is a wildcard in the patterns, a literal ? is escaped.
+"""
+def getBlockedUrlPatterns(heavyTypes):
+
+  patterns = []
+  for heavyType in heavyTypes:
+    for extension in HEAVY_TYPES[heavyType][1]:
+      patterns.extend(['*.' + extension, '*.' + extension + '\\?*'])
+  return patterns
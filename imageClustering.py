@@ -11,6 +11,7 @@ import pickle
 import sys
 
 from database import RedirectDB
+from screenshots import getImageExtension
      
 
 
@@ -26,7 +27,8 @@ def loadHashes(days, experimentName):
   query = """SELECT p.hash, p.hash_id 
             FROM perceptual_hashes p 
             JOIN targets t ON t.target_id = p.target_id 
-            WHERE t.day_added IN ("""+', '.join(["'"+x+"'" for x in days])+""") AND t.experiment_name = '"""+experimentName+"""'"""
+            WHERE t.day_added IN ("""+', '.join(["'"+x+"'" for x in days])+""") AND t.experiment_name = '"""+experimentName+"""'
+            AND p.hash_type = 'dhash'"""
   counter = 0
   with db.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
     cur.execute(query)
@@ -52,7 +54,7 @@ def topHashes(days,experimentName,dbname):
               FROM perceptual_hashes p 
               JOIN targets t ON t.target_id = p.target_id 
               WHERE t.day_added IN ("""+', '.join(["'"+x+"'" for x in days])+""") 
-              AND t.experiment_name = '"""+experimentName+"""' 
+              AND t.experiment_name = '"""+experimentName+"""' AND p.hash_type = 'dhash' 
               GROUP BY p.hash) AS pc WHERE pc.cnt > """+minCount
   
   with db.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
@@ -121,7 +123,8 @@ def saveImages(invCluster,outFolder,days,experimentName,manyImages):
             FROM scrapes s 
             JOIN perceptual_hashes p  ON s.scrape_id = p.scrape_id
             JOIN targets t ON t.target_id = s.target_id 
-            WHERE t.day_added IN ("""+', '.join(["'"+x+"'" for x in days])+""") AND t.experiment_name = '"""+experimentName+"""'"""
+            WHERE t.day_added IN ("""+', '.join(["'"+x+"'" for x in days])+""") AND t.experiment_name = '"""+experimentName+"""'
+            AND p.hash_type = 'dhash'"""
     counter = 0
     with db.cursor(name='saveImages '+str(os.getpid()),cursor_factory=psycopg2.extras.DictCursor) as cur:
       cur.itersize = 200
@@ -129,23 +132,24 @@ def saveImages(invCluster,outFolder,days,experimentName,manyImages):
       for row in cur:
         if(row['hash'] in invCluster[threshold]):
           if(manyImages):
-            file = folder + str(invCluster[threshold][row['hash']]) + '-' + str(row['scrape_id']) + '-' + str(row['window_id']) + '.png'
+            file = folder + str(invCluster[threshold][row['hash']]) + '-' + str(row['scrape_id']) + '-' + str(row['window_id']) + '.'
           else:
             subfolder = folder + str(invCluster[threshold][row['hash']]) + '/'
             if(not os.path.exists(subfolder)):
               os.makedirs(subfolder)
-            file = subfolder + str(row['scrape_id']) + '-' + str(row['window_id']) + '.png'
+            file = subfolder + str(row['scrape_id']) + '-' + str(row['window_id']) + '.'
           found = False
           if(row['window_id'] is None):
             found = True
-            with open(file, mode = 'wb') as fout:
-              fout.write(zlib.decompress(row['screenshot']))    
+            screenshot = zlib.decompress(row['screenshot'])
+            with open(file + getImageExtension(screenshot), mode = 'wb') as fout:
+              fout.write(screenshot)    
           else:
             screenshots = decompressDict(row['after_click_screenshots'])
             for id, screenshot in screenshots.items():
               if(id == row['window_id']):
                 found = True
-                with open(file, mode = 'wb') as fout:
+                with open(file + getImageExtension(screenshot), mode = 'wb') as fout:
                   fout.write(screenshot) 
           if(not found):
             print('error, not found scrape_id: ', row['scrape_id'])
@@ -292,7 +296,8 @@ def getMaliciousHashes(maliciousIds,db):
   with db.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
     cur.execute("""SELECT p.target_id, p.hash, s.name FROM perceptual_hashes p 
                 JOIN scrapes s ON p.scrape_id = s.scrape_id 
-                WHERE p.target_id IN ("""+','.join([str(x) for x in maliciousIds.keys()])+""")""")
+                WHERE p.target_id IN ("""+','.join([str(x) for x in maliciousIds.keys()])+""")
+                AND p.hash_type = 'dhash'""")
     for row in cur:
       if(row['name'] in maliciousIds[row['target_id']]):
         hashes.add(row['hash'])
@@ -305,7 +310,8 @@ def setMaliciousnessForMatchings(maliciousHashes,db):
   with db.cursor() as cur:
     query = """UPDATE perceptual_hashes 
                 SET maliciousness = 'malicious' 
-                WHERE hash IN ("""+', '.join(["'"+x+"'" for x in maliciousHashes])+""")"""
+                WHERE hash IN ("""+', '.join(["'"+x+"'" for x in maliciousHashes])+""")
+                AND hash_type = 'dhash'"""
     cur.execute(query)
   db.commit()
   
@@ -318,7 +324,8 @@ def setMaliciousness(maliciousHashes,dist,db,runConfig):
     cur.itersize = 10000
     cur.execute("""SELECT hash_id, hash FROM perceptual_hashes p 
                   JOIN scrapes s ON s.scrape_id = p.scrape_id 
-                  JOIN targets t ON t.target_id = p.target_id """)
+                  JOIN targets t ON t.target_id = p.target_id 
+                  WHERE p.hash_type = 'dhash'""")
                   
     malCounter = 0
     for row in cur:
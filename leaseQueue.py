@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import logging
+
+from database import RedirectDB
+
+
+"""
+Owner prefix of the leases taken by the crawler running in this process.
+The crawler pid is part of the owner so that leases left behind by a crawler
+that died on this host can be recognised and released.
+"""
+def getLeaseOwnerPrefix(crawlerPid = None):
+
+  if(crawlerPid is None):
+    crawlerPid = os.getpid()
+  return socket.gethostname() + ':' + str(crawlerPid) + ':'
+
+
+"""
+Releases the leases of crawlers on this host that are not running anymore,
+so that a restarted crawler can continue with those jobs immediately.
+"""
+def releaseDeadLeases(db):
+
+  hostPrefix = socket.gethostname() + ':'
+  for owner in db.getLeaseOwners(hostPrefix + '%'):
+    crawlerPid = int(owner[len(hostPrefix):].split(':')[0])
+    try:
+      os.kill(crawlerPid, 0)
+    except ProcessLookupError:
+      print('Releasing leases of dead crawler: ', owner)
+      db.releaseCrawlJobLeases(getLeaseOwnerPrefix(crawlerPid) + '%')
+    except PermissionError:
+      pass
+
+
+class LeaseQueue:
+
+
+  """
+  Work queue backed by the crawl_jobs table, so several crawler nodes can share one
+  crawl plan. It is created by the crawler process and used by one worker process,
+  the db connection and the heartbeat thread are only started in the worker.
+  numJobs is the number of open jobs when the queue was created.
+  """
+  def __init__(self, runConfig, attempt, scrapeTypeName, numJobs):
+
+    self.runConfig = runConfig
+    self.day = runConfig.day
+    self.experimentName = runConfig.experimentName
+    self.attempt = attempt
+    self.scrapeTypeName = scrapeTypeName
+    self.numJobs = numJobs
+    self.leaseTimeout = runConfig.leaseTimeout
+    self.heartbeatInterval = runConfig.heartbeatInterval
+    self.leasePollInterval = runConfig.leasePollInterval
+    self.ownerPrefix = getLeaseOwnerPrefix()
+    self.owner = None
+    self.db = None
+    self.heartbeatThread = None
+    self.stopped = None
+
+
+  def __len__(self):
+
+    return self.numJobs
+
+
+  def connect(self):
+
+    self.owner = self.ownerPrefix + str(os.getpid())
+    self.db = RedirectDB(self.runConfig)
+    self.stopped = threading.Event()
+    self.heartbeatThread = threading.Thread(target = self.heartbeat, daemon = True)
+    self.heartbeatThread.start()
+
+
+  """
+  Extends the leases of this worker while it is working on them
+  """
+  def heartbeat(self):
+
+    db = RedirectDB(self.runConfig)
+    while(not self.stopped.wait(self.heartbeatInterval)):
+      try:
+        db.renewCrawlJobLeases(self.owner, self.leaseTimeout)
+      except Exception as e:
+        logging.error(traceback.format_exc())
+        print('Renewing leases failed: ', self.owner)
+    db.close()
+
+
+  """
+  Leases the next job, waits while other workers still hold leases of this plan
+  because those jobs come back if the crawler holding them dies.
+  Returns ["DONE"] when every job of the plan is done.
+  """
+  def get(self):
+
+    if(self.db is None):
+      self.connect()
+    while True:
+      job = self.db.leaseCrawlJob(self.day, self.experimentName, self.attempt, self.scrapeTypeName,
+                                  self.owner, self.leaseTimeout)
+      if(job is not None):
+        return job
+      if(self.db.countActiveLeases(self.day, self.experimentName, self.attempt, self.scrapeTypeName,
+                                   self.owner) == 0):
+        return ["DONE"]
+      time.sleep(self.leasePollInterval)
+
+
+  """
+  Marks a leased job as done, the results of the job must be committed already
+  """
+  def complete(self, job):
+
+    self.db.completeCrawlJob(job[5], self.owner)
+
+
+  """
+  Stops the heartbeat and gives back the jobs that were leased but not completed
+  """
+  def close(self):
+
+    if(self.db is None):
+      return
+    self.stopped.set()
+    try:
+      self.db.releaseCrawlJobLeases(self.owner)
+    except Exception as e:
+      logging.error(traceback.format_exc())
+    self.db.close()
+    self.db = None
@@ -6,11 +6,13 @@ import os.path
 import random
 import json
 import sys
+import zlib
 from selenium.webdriver.firefox.firefox_profile import AddonFormatError
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import UnexpectedAlertPresentException
 from selenium.common.exceptions import NoAlertPresentException
+from selenium.common.exceptions import MoveTargetOutOfBoundsException
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -19,8 +21,156 @@ import traceback
 import logging
 import csv
 import smtplib
+from urllib.parse import urlparse, urljoin
 
 import redirectChainExtractor as rce
+from devtoolsCapture import DevtoolsHar, addDevtoolsCommands, sendDevtoolsCommand
+from screenshots import processScreenshot, getImageExtension
+from downloadTracker import DownloadTracker, hashFile
+from heavyResources import getBlockedUrlPatterns
+from fastStart import CHROMEDRIVER, EXTENSIONS, cloneProfile, removeProfile, getExtensionDir
+
+
+# Performance log events that show the page is still loading something
+ACTIVITY_EVENTS = set(['Network.requestWillBeSent', 'Page.frameScheduledNavigation',
+                       'Page.frameRequestedNavigation'])
+# Performance log events that end a request
+REQUEST_END_EVENTS = set(['Network.loadingFinished', 'Network.loadingFailed'])
+# Requests that stay open while the page is idle, they don't keep the dwell going
+LONG_LIVED_REQUEST_TYPES = ['EventSource', 'Media', 'WebSocket']
+# Seconds after which a request that is still loading is taken for a long poll or a
+# stream and no longer keeps the dwell going
+MAX_PENDING_SECONDS = 10
+# Metadata of the elements that can be clicked, collected in one call instead of
+# one WebDriver call per element and attribute. The visibility check approximates is_displayed.
+CANDIDATES_SCRIPT = """
+function isVisible(e) {
+  var style = window.getComputedStyle(e);
+  return e.getClientRects().length > 0 && style.visibility !== 'hidden' && style.display !== 'none' &&
+         (e.offsetWidth > 0 || e.offsetHeight > 0);
+}
+var candidates = [];
+arguments[0].forEach(function(tagName) {
+  var elements = document.getElementsByTagName(tagName);
+  for(var i = 0; i < elements.length; i++) {
+    var e = elements[i];
+    var rect = e.getBoundingClientRect();
+    // The properties have the resolved url like get_attribute, not the raw attribute
+    var urlName = tagName === 'a' ? 'href' : 'src';
+    candidates.push({'element': e, 'tag': tagName, 'visible': isVisible(e),
+                     'url': e.hasAttribute(urlName) ? e[urlName] : null,
+                     'y': rect.top + window.pageYOffset, 'width': rect.width});
+  }
+});
+return candidates;
+"""
+# Scrolls an element into view when the mouse can't be moved to it
+SCROLL_INTO_VIEW_SCRIPT = "arguments[0].scrollIntoView({block: 'center', inline: 'center'});"
+# Seconds of mouse movement sent as one action sequence while dwelling,
+# the performance log is drained after each
+DWELL_STEP = 5
+# Seconds a pointer move of a Selenium action sequence takes
+MOUSE_MOVE_SECONDS = 0.25
+# Storage types cleared for every origin by the full reset
+RESET_STORAGE_TYPES = 'cookies,local_storage,indexeddb,websql,cache_storage,service_workers,file_systems,shader_cache'
+
+
+"""
+Method of a performance log entry without parsing the whole json message.
+The method of the event is the first one in the message.
+"""
+def getLogMethod(entry):
+
+  message = entry['message']
+  start = message.find('"method":"')
+  if(start == -1):
+    return json.loads(message)['message'].get('method')
+  start += len('"method":"')
+  return message[start:message.find('"', start)]
+
+
+"""
+True if a Network.requestWillBeSent event is for a request that stays open while the
+page is idle, without parsing the whole json message
+"""
+def isLongLivedRequest(entry):
+
+  return any([('"type":"' + x + '"') in entry['message'] for x in LONG_LIVED_REQUEST_TYPES])
+
+
+"""
+Request id of a Network event without parsing the whole json message
+"""
+def getLogRequestId(entry):
+
+  message = entry['message']
+  start = message.find('"requestId":"')
+  if(start == -1):
+    return None
+  start += len('"requestId":"')
+  return message[start:message.find('"', start)]
+
+
+def getOrigin(url):
+
+  parsed = urlparse(url)
+  return parsed.scheme + '://' + parsed.netloc
+
+
+"""
+Target id of the window of a performance log entry, chromedriver adds it as webview
+"""
+def getLogWebview(entry):
+
+  message = entry['message']
+  start = message.find('"webview":"')
+  if(start == -1):
+    return None
+  start += len('"webview":"')
+  return message[start:message.find('"', start)]
+
+
+"""
+Url of the first main frame navigation of a window in its performance log entries.
+The main frame of a window has the id of its target.
+"""
+def getStartUrl(entries, default):
+
+  for entry in entries:
+    if(getLogMethod(entry) == 'Network.requestWillBeSent'):
+      message = json.loads(entry['message'])
+      params = message['message']['params']
+      if(params.get('type') == 'Document' and params.get('frameId') == message.get('webview')):
+        return params['request']['url']
+  return default
+
+
+"""
+Url where the redirect chain that ends at url started, following the chain back
+through the redirectURL of the entries of a HAR
+"""
+def getChainStartUrl(entries, url):
+
+  sources = {}
+  for entry in entries:
+    redirect = entry['response'].get('redirectURL', '')
+    if(redirect != ''):
+      sources.setdefault(rce.getUrl(urljoin(entry['request']['url'], redirect)), entry['request']['url'])
+  seen = set()
+  while(rce.getUrl(url) in sources and url not in seen):
+    seen.add(url)
+    url = sources[rce.getUrl(url)]
+  return url
+
+
+"""
+HAR bytes of a HAR from getHar, which is compressed unless it is empty
+"""
+def decompressHar(har):
+
+  if(isinstance(har, bytes)):
+    return zlib.decompress(har)
+  return har.encode('utf8','ignore')
 
 
 def sendEmail(msg):
@@ -39,8 +189,10 @@ class LinkFollow:
   """
   Initialize 
   proxyInfo[3] is used as and id for LinkFollow, thus always must be given!
+  With a sharedBrowser the link follower uses its own browser context of the shared
+  Chrome instead of starting a Chrome.
   """
-  def __init__(self, id ,runConfig, scrapeType, proxy, httpProxy = None):
+  def __init__(self, id ,runConfig, scrapeType, proxy, httpProxy = None, sharedBrowser = None):
   
     # Supress urllib3 warnings
     logging.getLogger("urllib3").setLevel(logging.ERROR)
@@ -50,6 +202,18 @@ class LinkFollow:
     self.name = scrapeType['name']
     self.scrapeType = scrapeType
     self.logTimestamp = 0
+    # Page load time and timeout of the last visit, used by the crawler to adapt concurrency
+    self.pageLoadTime = None
+    self.pageLoadTimedOut = False
+    # Rule that ended the dwell on the last page: fixed, quiet or max time
+    self.dwellEndRule = None
+    # Seconds spent in the stages of the last visit (page_load, dwell, screenshot, har_fetch)
+    self.timings = {}
+    self.harBodies = {}
+    # Performance log entries of the current page drained from the browser so far
+    self.perfLogBuffer = []
+    # Requests of the current page that didn't finish yet
+    self.pendingRequests = {}
     
     self.useragent = getattr(runConfig,scrapeType['ua'])
     if(scrapeType['ref']):
@@ -62,6 +226,12 @@ class LinkFollow:
     self.headless = runConfig.headless
     self.timeout = runConfig.timeout
     self.fileWaitTimeout = runConfig.fileWaitTimeout
+    self.dwellMode = runConfig.dwellMode
+    # Only these performance log events are kept, all of them if the list is empty
+    self.performanceLogEvents = None
+    if(len(runConfig.performanceLogEvents) > 0):
+      self.performanceLogEvents = set(runConfig.performanceLogEvents)
+    self.quietPeriod = runConfig.quietPeriod
     self.browserStartRetry = runConfig.browserStartRetry
     self.maxRetry = runConfig.numScrapeRetriesLinkFollower
     # Alert and Download settings:
@@ -70,12 +240,31 @@ class LinkFollow:
     self.downloadFolder = runConfig.downloadFolder+runConfig.day+'/'+str(id) +'/'+self.name+'/'
     if(not os.path.exists(self.downloadFolder)):
       os.makedirs(self.downloadFolder)
+    self.downloadTracker = DownloadTracker(self.downloadFolder)
     # Other settings    
+    self.runConfig = runConfig
     self.saveToDisk = runConfig.saveToDisk
     self.extensionsFolder = runConfig.extensionsFolder
+    # With fastStart every browser starts from a copy of the template user data dir
+    self.fastStart = runConfig.fastStart
+    self.profileDir = None
     # Web proxy info for network logging
     self.proxy = proxy   
     self.httpProxy = httpProxy
+    # Without a proxy the HAR is built from the DevTools network events
+    self.harRecorder = None
+    self.sharedBrowser = sharedBrowser
+    self.contextId = None
+    self.windowHandle = None
+    self.fullReset = runConfig.fullReset
+    # Heavy resource suppression, a scrape type can override the defaults
+    self.heavyMaxSize = scrapeType.get('heavyMaxSize', runConfig.heavyMaxSize)
+    self.heavyTypes = scrapeType.get('heavyTypes', runConfig.heavyTypes)
+    # Origins of the frames loaded since the last reset
+    self.visitedOrigins = set()
+    # Targets opened by clicks that were resumed after chromedriver attached to them
+    self.resumedTargets = set()
+    self.targetMessageId = 0
     # Result destination settings  
     if(self.saveToDisk):
       randomString = str(random.randint(1, 1000000))
@@ -88,14 +277,27 @@ class LinkFollow:
       if(not os.path.exists(self.screenshot_folder)):
         os.makedirs(self.screenshot_folder)
     # Start Web driver
-    if(self.browserType == 'chrome'):
+    if(self.sharedBrowser is not None):
+      self.driver = self.sharedBrowser.driver
+      self.contextId, self.windowHandle = self.sharedBrowser.createContext(self.downloadFolder)
+      self.activate()
+      self.setOverrides()
+    elif(self.browserType == 'chrome'):
       self.driver = self._startChromeDriver()
     else:
       self.driver is None
     if(self.driver is None):
       return None
-    if(self.headless):
+    if(self.windowHandle is None):
+      self.windowHandle = self.driver.current_window_handle
+    addDevtoolsCommands(self.driver)
+    # The downloads of a shared browser context are set for all its windows by createContext
+    if(self.headless and self.sharedBrowser is None):
       self.enableDownloadInHeadless(self.downloadFolder)
+    if(self.proxy is None and runConfig.networkCapture == 'devtools'):
+      self.harRecorder = DevtoolsHar(self.driver, runConfig.maxBodySize, runConfig.harBodyMinSize,
+                                     runConfig.harBodyTypes, runConfig.harBodyMaxSize)
+      self.harRecorder.enable()
     
     
   """
@@ -110,8 +312,6 @@ class LinkFollow:
     This method is a hacky work-around until the official chromedriver support for this.
     Requires chrome version 62.0.3196.0 or above.
     """
-    # add missing support for chrome "send_command"  to selenium webdriver
-    self.driver.command_executor._commands["send_command"] = ("POST", '/session/$sessionId/chromium/send_command')
     params = {'cmd': 'Page.setDownloadBehavior', 'params': {'behavior': 'allow', 'downloadPath': downloadFolder}}
     commandResult = self.driver.execute("send_command", params)
 
@@ -119,7 +319,7 @@ class LinkFollow:
   """
   Try to start the chrome driver
   """
-  def _startChromeDriver(self):
+  def _startChromeDriver(self, extensions = True):
   
     opts = Options()
     if(True):
@@ -132,8 +332,20 @@ class LinkFollow:
     opts.add_argument("--start-maximized")
     if(self.proxy is not None):
       opts.add_argument("--proxy-server={0}".format(self.proxy.proxyUrl))
-    opts.add_extension(self.extensionsFolder+'Sheets_v1.2.crx')
-    opts.add_extension(self.extensionsFolder+'Docs_v0.10.crx')
+    crxNames = []
+    if(extensions):
+      crxNames = EXTENSIONS[:2]
+      if(self.referer is not None and not self.headless):
+        crxNames = EXTENSIONS
+    if(self.fastStart):
+      self.removeProfile()
+      self.profileDir = cloneProfile(self.runConfig)
+      opts.add_argument("--user-data-dir=" + self.profileDir)
+      if(len(crxNames) > 0):
+        opts.add_argument("--load-extension=" + ','.join([getExtensionDir(self.runConfig, x) for x in crxNames]))
+    else:
+      for crxName in crxNames:
+        opts.add_extension(self.extensionsFolder + crxName)
     
     if(self.isMobile):
       mobileEmulation = {
@@ -149,8 +361,6 @@ class LinkFollow:
             'safebrowsing.disable_download_protection': True}
     opts.add_experimental_option('prefs', prefs)
     
-    if(self.referer is not None and not self.headless):
-      opts.add_extension(self.extensionsFolder+'Referer-Control_v1.32.crx')
     if(self.headless):
       opts.add_argument('headless')
       
@@ -163,8 +373,7 @@ class LinkFollow:
     
     for i in range(self.browserStartRetry):
       try:
-        driver = webdriver.Chrome('prereqs/chromedriver-v74/chromedriver',
-                                  chrome_options=opts, desired_capabilities=desiredCaps)
+        driver = webdriver.Chrome(CHROMEDRIVER, chrome_options=opts, desired_capabilities=desiredCaps)
         driver.set_page_load_timeout(self.timeout)
       except Exception as e:
         logging.error(traceback.format_exc())
@@ -188,10 +397,25 @@ class LinkFollow:
   """
   def __del__(self):
   
+    # __init__ might have failed before the attributes were set
+    downloadTracker = getattr(self, 'downloadTracker', None)
+    if(downloadTracker is not None):
+      downloadTracker.close()
+    # The shared browser is stopped by its owner
+    if(getattr(self, 'sharedBrowser', None) is not None):
+      return
     try:
       self.driver.quit()
     except:
       pass
+    if(getattr(self, 'profileDir', None) is not None):
+      self.removeProfile()
+    
+    
+  def removeProfile(self):
+  
+    removeProfile(self.profileDir)
+    self.profileDir = None
     
   
   """
@@ -199,6 +423,14 @@ class LinkFollow:
   """
   def cleanup(self):    
   
+    self.activate()
+    if(self.fullReset):
+      try:
+        self.resetState()
+        return
+      except Exception as e:
+        logging.error(traceback.format_exc())
+        print("Full reset failed, falling back to clearing the current origin")
     try:
       self.driver.delete_all_cookies()
     except Exception as e:
@@ -213,6 +445,43 @@ class LinkFollow:
       print("window.sessionStorage.clear() failed")
      
      
+  """
+  Resets the browser to a fresh state without restarting it: closes the extra windows,
+  leaves the page, and clears cookies, the HTTP cache, the permissions and the storage
+  (local storage, IndexedDB, cache storage, service workers, ...) of every origin whose
+  frames were loaded since the last reset. Session storage goes with the closed windows
+  and the left page.
+  """
+  def resetState(self):
+  
+    for handle in self.getWindowHandles():
+      if(handle != self.windowHandle):
+        self.driver.switch_to.window(handle)
+        self.driver.close()
+    self.driver.switch_to.window(self.windowHandle)
+    if(self.sharedBrowser is not None):
+      self.sharedBrowser.current = self.windowHandle
+    self.driver.get('about:blank')
+    self.drainPerformanceLog()
+    self.perfLogBuffer = []
+    # Service workers can belong to origins that only requested resources
+    targets = sendDevtoolsCommand(self.driver, 'Target.getTargets')['targetInfos']
+    for target in targets:
+      if(target['type'] == 'service_worker' and
+         (self.contextId is None or target.get('browserContextId') == self.contextId)):
+        self.visitedOrigins.add(getOrigin(target['url']))
+    for origin in self.visitedOrigins:
+      sendDevtoolsCommand(self.driver, 'Storage.clearDataForOrigin',
+                          {'origin':origin, 'storageTypes':RESET_STORAGE_TYPES})
+    self.visitedOrigins = set()
+    sendDevtoolsCommand(self.driver, 'Network.clearBrowserCookies')
+    sendDevtoolsCommand(self.driver, 'Network.clearBrowserCache')
+    if(self.contextId is not None):
+      sendDevtoolsCommand(self.driver, 'Browser.resetPermissions', {'browserContextId':self.contextId})
+    else:
+      sendDevtoolsCommand(self.driver, 'Browser.resetPermissions')
+    
+    
   """
   Set referrer through plug-in, this is not used anymore
   """
@@ -267,15 +536,28 @@ class LinkFollow:
 
   def setupScrape(self):
     
+    # The shared browser can't be restarted by one of its link followers
+    if(self.sharedBrowser is not None):
+      try:
+        self.activate()
+      except Exception as e:
+        logging.error(traceback.format_exc())
+        return False
     # check if driver is still working return None if not
-    if(self.driver is None):
+    elif(self.driver is None):
       self.driver = self._startChromeDriver()
       if(self.driver is None):
         return False 
+      self.windowHandle = self.driver.current_window_handle
+      self.visitedOrigins = set()
+      addDevtoolsCommands(self.driver)
+      if(self.harRecorder is not None):
+        self.harRecorder = DevtoolsHar(self.driver, self.harRecorder.maxBodySize, self.harRecorder.bodyMinSize,
+                                       self.harRecorder.bodyTypes, self.harRecorder.bodyMaxSize)
+        self.harRecorder.enable()
     # Check if proxy crashed    
     if(self.proxy is not None):
-      poll = self.proxy.proc.poll()
-      if(poll is not None):
+      if(not self.proxy.isAlive()):
         print('Mitmproxy crashed: ',self.id)
         return False
       # Try to set the referer using th plugin if not headless
@@ -283,24 +565,84 @@ class LinkFollow:
         self.proxy.addHeader('Referer',self.referer)
       else:
         self.proxy.removeAddHeader('Referer')
+      # The proxy can be shared by scrape types with different policies
+      self.proxy.suppressHeavy(self.heavyMaxSize, self.heavyTypes)
+    elif(len(self.heavyTypes) > 0):
+      # Without a proxy the size of a response is not known before its body is loaded,
+      # only the MIME classes can be suppressed by url
+      try:
+        self.blockHeavyResources()
+      except Exception as e:
+        logging.error(traceback.format_exc())
+        return False
     return True
 
 
   """
-  Updates downloaded file names.
+  Switches the shared browser to the main window of this link follower
+  """
+  def activate(self):
+  
+    if(self.sharedBrowser is not None):
+      self.sharedBrowser.activate(self.windowHandle)
+      
+      
+  """
+  DevTools commands that set the user agent and device metrics of the scrape type
+  on a window of the shared browser, every window of the context needs them
+  """
+  def getOverrides(self):
+  
+    overrides = [('Network.setUserAgentOverride', {'userAgent':self.useragent})]
+    if(self.isMobile):
+      overrides.append(('Emulation.setDeviceMetricsOverride',
+                        {'width':self.scrapeType['width'], 'height':self.scrapeType['height'],
+                         'deviceScaleFactor':self.scrapeType['pixelRatio'], 'mobile':True}))
+      overrides.append(('Emulation.setTouchEmulationEnabled', {'enabled':True}))
+    return overrides
+    
+    
+  """
+  Sets the overrides of the scrape type on the current window of the shared browser
+  """
+  def setOverrides(self):
+  
+    for method, params in self.getOverrides():
+      sendDevtoolsCommand(self.driver, method, params)
+      
+      
+  """
+  Window handles of this link follower, only the ones of its context with a shared browser
+  """
+  def getWindowHandles(self):
+  
+    if(self.sharedBrowser is not None):
+      return self.sharedBrowser.getContextHandles(self.contextId)
+    return self.driver.window_handles
+    
+    
+  """
+  Updates downloaded file names and hashes the downloads finished since the last page.
+  Returns a list of (file name, sha256, md5) that is saved with the scrape.
   """
   def updateDownloadedFileNames(self,url):
     
-    for f in os.listdir(self.downloadFolder):
-      fileName = os.path.join(self.downloadFolder, f)
-      if(os.path.isfile(fileName) and not fileName.endswith('.tds.')):
-        newFileName = fileName+'.'+str(time.time())+'.tds.'
+    downloads = []
+    for fileName in self.downloadTracker.getFinished():
+      newFileName = fileName+'.'+str(time.time())+'.tds.'
+      try:
         os.rename(fileName, newFileName)
-        # log the download event
-        logFile = self.downloadFolder + 'downloads.log.tds.'
-        with open(logFile, mode='a', newline='') as fout:
-          writer = csv.writer(fout)
-          writer.writerow([newFileName,url])
+        sha256Hash, md5Hash = hashFile(newFileName)
+      except OSError as e:
+        print('Hashing download failed: ', e)
+        continue
+      downloads.append((newFileName, sha256Hash, md5Hash))
+      # log the download event
+      logFile = self.downloadFolder + 'downloads.log.tds.'
+      with open(logFile, mode='a', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow([newFileName,url])
+    return downloads
   
   
   def moveMouse(self, x, y):
@@ -313,6 +655,32 @@ class LinkFollow:
       self.handleAlerts()
       
       
+  """
+  Moves the mouse by a few pixels at random intervals for the given seconds. The moves
+  and the pauses between them are sent as one action sequence, chromedriver runs it
+  in one request. The rest of the time is waited if the moves failed.
+  """
+  def moveMouseFor(self, seconds):
+  
+    start = time.time()
+    action =  ActionChains(self.driver)
+    timeLeft = seconds
+    while(timeLeft >= MOUSE_MOVE_SECONDS):
+      waitTime = min(random.uniform(MOUSE_MOVE_SECONDS, 1), timeLeft)
+      action.move_by_offset(int(random.uniform(-3, 3)),int(random.uniform(-3, 3)))
+      action.pause(waitTime - MOUSE_MOVE_SECONDS)
+      timeLeft -= waitTime
+    try:
+      # Shorter times than a move are only waited
+      if(timeLeft < seconds):
+        action.perform()
+    except UnexpectedAlertPresentException as e: 
+      self.handleAlerts()
+    except MoveTargetOutOfBoundsException as e:
+      pass
+    self.wait(max(0, seconds - (time.time() - start)))
+      
+      
   def wait(self, t):
   
     try:
@@ -326,13 +694,11 @@ class LinkFollow:
     try:
       timeLeft = float(timeLimit)
       self.moveMouse(random.randint(40,80),random.randint(40,80))
-      for i in range(int(timeLimit)):
-        self.moveMouse(int(random.uniform(-3, 3)),int(random.uniform(-3, 3)))
-        waitTime = random.uniform(0, 1)
-        self.wait(waitTime)
-        timeLeft -= waitTime
-      if(timeLeft > 0):
-        time.sleep(timeLeft)
+      while(timeLeft > 0):
+        step = min(DWELL_STEP, timeLeft)
+        self.moveMouseFor(step)
+        self.drainPerformanceLog()
+        timeLeft -= step
     except TimeoutException as e:
       print("Page took longer than "+str(self.timeout)+" seconds while time.sleep")
       return False
@@ -343,34 +709,185 @@ class LinkFollow:
     else:
       return True
       
+      
+  """
+  Drains the performance log of the browser, it is called while dwelling on a page
+  so the log doesn't pile up in the browser. The network events are added to the HAR
+  when it is built from DevTools and the events in performanceLogEvents are kept.
+  Returns the time of the last request or scheduled navigation, None if there was none.
+  A scheduled navigation counts as activity until its delay is over, the requests
+  that didn't finish yet are kept in pendingRequests with the time they started,
+  except the long lived ones.
+  """
+  def drainPerformanceLog(self):
+  
+    lastActivity = None
+    entries = self.filterLog(self.driver.get_log('performance'))
+    if(self.harRecorder is not None):
+      self.harRecorder.addLog(entries)
+    for entry in entries:
+      method = getLogMethod(entry)
+      if(method == 'Page.frameNavigated' and self.fullReset):
+        frameUrl = json.loads(entry['message'])['message']['params']['frame']['url']
+        if(frameUrl.startswith('http')):
+          self.visitedOrigins.add(getOrigin(frameUrl))
+      if(method == 'Network.requestWillBeSent' and not isLongLivedRequest(entry)):
+        self.pendingRequests[getLogRequestId(entry)] = entry['timestamp']/1000
+      elif(method in REQUEST_END_EVENTS):
+        self.pendingRequests.pop(getLogRequestId(entry), None)
+      if(method in ACTIVITY_EVENTS):
+        # Log timestamps are in milliseconds, the delay of a meta refresh or timer redirect is in seconds
+        activity = entry['timestamp']/1000
+        if(method == 'Page.frameScheduledNavigation'):
+          activity += json.loads(entry['message'])['message']['params'].get('delay', 0)
+        lastActivity = max(lastActivity or 0, activity)
+      if(self.performanceLogEvents is None or method in self.performanceLogEvents):
+        self.perfLogBuffer.append(entry)
+    return lastActivity
+    
+    
+  """
+  Returns the kept performance log entries of the page since the last call
+  """
+  def collectPerformanceLog(self):
+  
+    self.drainPerformanceLog()
+    entries = self.perfLogBuffer
+    self.perfLogBuffer = []
+    if(self.harRecorder is not None):
+      self.harRecorder.fetchBodies()
+    return entries
+    
+    
+  def startHarCollection(self,url):
+  
+    if(self.proxy is not None):
+      self.proxy.startHarCollection(url, self.runConfig.harBodyMinSize, self.runConfig.harBodyTypes,
+                                    self.runConfig.harBodyMaxSize)
+    elif(self.harRecorder is not None):
+      self.harRecorder.start(url)
+      
+      
+  """
+  Returns the HAR as zlib compressed json bytes, the way it is stored, the bodies
+  taken out of it are kept in harBodies until they are returned with the result of the visit
+  """
+  def getHar(self):
+  
+    if(self.proxy is not None):
+      har, bodies = self.proxy.getHar(compress = True)
+    elif(self.harRecorder is not None):
+      har, bodies = self.harRecorder.getHar(compress = True)
+    else:
+      return ''
+    self.harBodies.update(bodies)
+    return har
+    
+    
+  """
+  Without a proxy the suppressed heavy resources of the current window are blocked
+  by url through DevTools
+  """
+  def blockHeavyResources(self):
+  
+    sendDevtoolsCommand(self.driver, 'Network.setBlockedURLs', {'urls': getBlockedUrlPatterns(self.heavyTypes)})
+    
+    
+  """
+  Waits until there were no new requests or scheduled navigations for quietPeriod
+  seconds and no request started in the last MAX_PENDING_SECONDS is still loading,
+  but at most timeLimit seconds, while moving the mouse like waitAndMoveMouse.
+  Returns the rule that ended the wait: quiet or max time, None if waiting failed.
+  """
+  def waitForQuiescence(self,timeLimit):
+  
+    try:
+      start = time.time()
+      lastActivity = start
+      self.moveMouse(random.randint(40,80),random.randint(40,80))
+      while True:
+        activity = self.drainPerformanceLog()
+        if(activity is not None):
+          lastActivity = max(lastActivity, activity)
+        now = time.time()
+        loading = [x for x in self.pendingRequests.values() if now - x < MAX_PENDING_SECONDS]
+        if(now - lastActivity >= self.quietPeriod and len(loading) == 0):
+          return 'quiet'
+        if(now - start >= timeLimit):
+          return 'max time'
+        # The log is read every half quiet period, the mouse moves in between
+        self.moveMouseFor(min(self.quietPeriod/2, start + timeLimit - now))
+    except TimeoutException as e:
+      print("Page took longer than "+str(self.timeout)+" seconds while time.sleep")
+      return None
+    except Exception as e:
+      logging.error(traceback.format_exc())
+      print('Unhandled exception while waiting for quiescence: ',e)
+      return None
+      
+      
+  """
+  Dwells on the current page for at most timeLimit seconds, either for the whole
+  time or until the page is quiet depending on dwellMode.
+  Returns the rule that ended the dwell, None if dwelling failed.
+  """
+  def dwell(self,timeLimit):
+  
+    if(self.dwellMode == 'quiescence'):
+      return self.waitForQuiescence(timeLimit)
+    if(self.waitAndMoveMouse(timeLimit)):
+      return 'fixed'
+    return None
+      
+
+  """
+  Takes a screenshot, hashes it and converts it to the stored format.
+  Returns the screenshot to store and its hashes.
+  """
+  def takeScreenshot(self):
+  
+    png = self.driver.get_screenshot_as_png()
+    try:
+      return processScreenshot(png, self.runConfig)
+    except Exception as e:
+      logging.error(traceback.format_exc())
+      print('Processing screenshot failed: ', e)
+      return png, {}
+      
 
+  """
+  Returns the metadata of the elements with the given tag names in document order per tag
+  """
+  def getCandidates(self, tagNames):
+  
+    return self.driver.execute_script(CANDIDATES_SCRIPT, tagNames)
+    
+    
   def getVideoToClick(self):
   
     adDomains = set(['google.com','facebook.com','twitter.com'])
     maxVid = None
     maxWidth = 0
     maxType = None
-    for tagName in ['embed','video','iframe']:
-      for b in self.driver.find_elements_by_xpath("//"+tagName):
-        if(b.location['y'] >= 0 and b.location['y'] < 10000 and b.is_displayed()):
-          domain = rce.getDomain(b.get_attribute("src"))
-          if(b.size['width'] > maxWidth and domain not in adDomains):
-            maxVid = b
-            maxWidth = b.size['width']
-            maxType = tagName
+    for b in self.getCandidates(['embed','video','iframe']):
+      if(b['y'] >= 0 and b['y'] < 10000 and b['visible']):
+        domain = rce.getDomain(b['url'])
+        if(b['width'] > maxWidth and domain not in adDomains):
+          maxVid = b['element']
+          maxWidth = b['width']
+          maxType = b['tag']
     return maxVid
     
     
   def getLinkToClick(self):
   
     links = {}
-    for b in self.driver.find_elements_by_xpath("//a"):
-      if(b.is_displayed()):
-        href = b.get_attribute("href")
-        aDomain = rce.getDomain(href)
+    for b in self.getCandidates(['a']):
+      if(b['visible']):
+        aDomain = rce.getDomain(b['url'])
         if(aDomain not in links):
           links[aDomain] = []
-        links[aDomain].append(b)
+        links[aDomain].append(b['element'])
     maxDomain = None
     maxLinks = 0
     for domain,hrefs in links.items():
@@ -382,52 +899,79 @@ class LinkFollow:
       return selectedLink
       
       
+  """
+  Moves the mouse to the element and clicks it in one action sequence, the element
+  is only scrolled into view if the mouse can't be moved to it
+  """
   def clickElement(self,element,nClick):
   
-    action =  ActionChains(self.driver)
-    # Move the mouse to the element
     try:
-      action.move_by_offset(random.randint(0,1),random.randint(0,1))
-      action.move_to_element(element)
-      action.perform()
+      for i in range(2):
+        action =  ActionChains(self.driver)
+        action.move_to_element(element)
+        action.move_by_offset(random.randint(0,1),random.randint(0,1))
+        action.click()
+        try:
+          action.perform()
+          break
+        except MoveTargetOutOfBoundsException as e:
+          if(i > 0):
+            raise
+          self.driver.execute_script(SCROLL_INTO_VIEW_SCRIPT, element)
     except UnexpectedAlertPresentException as e: 
       self.handleAlerts()
     except Exception as e:
-      print('Element to move to not found for click number ',nClick,' : ', e)
-    # Click the element  
+      print('Click ',nClick,' failed: ',e)
+    # Windows opened by the click wait until chromedriver attached to them,
+    # the ones opened later are resumed by the next click or selectAndClickElement
     try:
-      action.click()
-      action.perform()
-    except UnexpectedAlertPresentException as e: 
-      self.handleAlerts()
+      self.resumePopups()
     except Exception as e:
-      print('Click ',nClick,' failed: ',e)
+      print('Resuming windows of click ',nClick,' failed: ',e)
     time.sleep(random.uniform(1, 2))
   
   
+  """
+  Captures the windows after the clicks. The windows are not reloaded: a new window
+  waits until chromedriver attached to it (see pausePopups), so its network events
+  since its first navigation are in the performance log, where every event has the
+  target id of its window. All windows load while this
+  link follower dwells once, then each window is captured as it is.
+  Windows of a shared browser got the overrides of the scrape type before they
+  were resumed.
+  """
   def getPerWindowData(self, url, urlBeforeClick):
   
     domain = rce.getDomain(url)
     counter = 0
     perWindowData = {}
-    windows = {}
-    for handle in self.driver.window_handles:
+    self.dwell(4)
+    perWindowLogs = {}
+    for entry in self.collectPerformanceLog():
+      perWindowLogs.setdefault(getLogWebview(entry), []).append(entry)
+    for handle in self.getWindowHandles():
       counter += 1
       try:
         self.driver.switch_to.window(handle)
+        if(self.sharedBrowser is not None):
+          self.sharedBrowser.current = handle
       except UnexpectedAlertPresentException as e: 
         self.handleAlerts()
       except Exception as e:
-        print('Element to move to not found for click number')
+        print('Switching to window failed for window number ',counter)
         logging.error(traceback.format_exc())
-        
-      # Try reloading the current window
+        continue
+      entries = []
+      for webview, windowEntries in perWindowLogs.items():
+        if(webview is not None and handle.endswith(webview)):
+          entries = windowEntries
       try:
-        startUrl = self.driver.current_url
-        # We don't want to reload the main page
-        if(startUrl == urlBeforeClick):
+        currentUrl = self.driver.current_url
+        # Without the first request in the log the start url is taken from the HAR by fillStartUrls
+        startUrl = getStartUrl(entries, None)
+        # The main window is only captured if the click navigated it
+        if((startUrl or currentUrl) == urlBeforeClick):
           continue
-        self.driver.refresh()
       except UnexpectedAlertPresentException as e: 
         self.handleAlerts()
       except TimeoutException as e:
@@ -438,13 +982,10 @@ class LinkFollow:
         print('Unhandled exception for window: ',counter,' and for url: ',url)
         continue
         
-      if(not self.waitAndMoveMouse(4)):
-        continue
-        
       # Save information about the current windows
       try:
-        screenshotData = self.driver.get_screenshot_as_png()
-        performanceFile = json.dumps(self.filterLog(self.driver.get_log('performance')), ensure_ascii=False)
+        screenshotData, screenshotHashes = self.takeScreenshot()
+        performanceFile = json.dumps(entries, ensure_ascii=False)
       except Exception as e:
         print('Saving screenshot/perflog failed: ', e)
         continue
@@ -456,8 +997,7 @@ class LinkFollow:
         print('Getting html failed: ', e)
         html = self.driver.page_source   
       currentUrl = self.driver.current_url
-      perWindowData[counter] = [screenshotData,html,startUrl,currentUrl,performanceFile]
-      randomString = str(random.randint(1, 1000000))
+      perWindowData[counter] = [screenshotData,html,startUrl,currentUrl,performanceFile,screenshotHashes]
       
     return perWindowData
   
@@ -478,22 +1018,98 @@ class LinkFollow:
     if(element is None):
       return None
     urlBeforeClick = self.driver.current_url
-    self.proxy.removeResponse()
+    self.resumedTargets = set()
+    try:
+      self.pausePopups(True)
+    except Exception as e:
+      print('Pausing the windows opened by clicks failed: ', e)
     self.clickElement(element,1)
     self.clickElement(element,2)
-    self.proxy.keepResponse()
-    time.sleep(1)
+    try:
+      self.pausePopups(False)
+      self.resumePopups()
+    except Exception as e:
+      print('Resuming the windows opened by clicks failed: ', e)
     return self.getPerWindowData(url, urlBeforeClick)
+
+
+  """
+  With pause the targets opened by the current window wait before they run until
+  resumePopups, so their first requests are not made before chromedriver attached
+  to them and logs their events
+  """
+  def pausePopups(self, pause):
+  
+    sendDevtoolsCommand(self.driver, 'Target.setAutoAttach', {'autoAttach':pause, 'waitForDebuggerOnStart':pause})
+
+
+  """
+  Sends a DevTools command to a target the current window is attached to
+  """
+  def sendToTarget(self, targetId, method, params):
+  
+    self.targetMessageId += 1
+    message = json.dumps({'id':self.targetMessageId, 'method':method, 'params':params})
+    sendDevtoolsCommand(self.driver, 'Target.sendMessageToTarget', {'targetId':targetId, 'message':message})
+
+
+  """
+  Lists the window handles, which makes chromedriver attach to the new windows,
+  then resumes the targets waiting since pausePopups. With a shared browser the
+  overrides of the scrape type are set on a target before it is resumed, the
+  messages to a target are handled in order.
+  """
+  def resumePopups(self):
+  
+    targets = sendDevtoolsCommand(self.driver, 'Target.getTargets')['targetInfos']
+    targets = [x for x in targets if x.get('attached', False) and x['targetId'] not in self.resumedTargets]
+    # Nothing opened since the last call
+    if(len(targets) == 0):
+      return
+    self.getWindowHandles()
+    for target in targets:
+      # A target attached to chromedriver and not to the current window is not tried again
+      self.resumedTargets.add(target['targetId'])
+      try:
+        if(self.sharedBrowser is not None):
+          for method, params in self.getOverrides():
+            self.sendToTarget(target['targetId'], method, params)
+        self.sendToTarget(target['targetId'], 'Runtime.runIfWaitingForDebugger', {})
+      except Exception as e:
+        continue
   
 
+  """
+  Sets the start url of the windows whose first request is not in their performance
+  log to the start of the redirect chain of their landing url in the after click HAR
+  """
+  def fillStartUrls(self, perWindowData, har):
+  
+    if(perWindowData is None or not any([x[2] is None for x in perWindowData.values()])):
+      return
+    entries = []
+    try:
+      if(har != ''):
+        entries = json.loads(decompressHar(har).decode('utf8','ignore')).get('log', {}).get('entries', [])
+    except Exception as e:
+      print('Reading the after click HAR failed: ', e)
+    for item in perWindowData.values():
+      if(item[2] is None):
+        item[2] = getChainStartUrl(entries, item[3])
+        
+        
   def getPage(self, url):
   
     try:
-      if(self.proxy is not None):
-        self.proxy.startHarCollection(url)
+      self.startHarCollection(url)
+      self.pendingRequests = {}
+      loadStart = time.time()
       self.driver.get(url)
+      self.pageLoadTime = time.time() - loadStart
+      self.timings['page_load'] = self.pageLoadTime
     except TimeoutException as e:
       print("Page took longer than "+str(self.timeout)+" seconds, retrying")
+      self.pageLoadTimedOut = True
       return False
     except UnexpectedAlertPresentException as e:
       try:
@@ -517,14 +1133,18 @@ class LinkFollow:
 
   def saveDataToDisk(self,data):
 
-    ts, url, landingUrl, html, harFile, screenshotData, performanceFile, secondaryData = data
+    ts, url, landingUrl, html, harFile, screenshotData, performanceFile, secondaryData = data[:8]
     
     # Save primary data
     randomString = str(random.randint(1, 1000000))
-    with open(self.screenshot_folder + randomString + "-screenshot.png", mode = 'wb') as fout:
+    with open(self.screenshot_folder + randomString + "-screenshot." + getImageExtension(screenshotData), mode = 'wb') as fout:
       fout.write(screenshotData)
     with open(self.harFolder+randomString+"-test.har", mode = 'wb') as fout:
-      fout.write(harFile.encode('utf8','ignore'))
+      fout.write(decompressHar(harFile))
+    # The bodies referenced by _bodyRef in the HAR files
+    if(len(data[12]) > 0):
+      with open(self.harFolder+randomString+"-bodies.json", mode = 'wb') as fout:
+        fout.write(json.dumps(data[12]).encode('utf8','ignore'))
     with open(self.harFolder+randomString+"-performance.log", mode = 'wb') as fout:
       fout.write(performanceFile.encode('utf8','ignore'))
     with open(self.harFolder+randomString+"-main.html", mode = 'wb') as fout:
@@ -537,14 +1157,14 @@ class LinkFollow:
     if(secondaryData is None):
       return
     with open(self.harFolder+randomString+"-afterclick.har", mode = 'wb') as fout:
-      fout.write(secondaryData['har'].encode('utf8','ignore'))
+      fout.write(decompressHar(secondaryData['har']))
     flog = open(self.screenshot_folder+randomString+"-afterclick-urls.txt", mode = 'w')
     csvwriter = csv.writer(flog)
     if(secondaryData['perWindowData'] is not None):
       for key,item in secondaryData['perWindowData'].items():
         with open(self.harFolder+randomString+"-afterclick-window"+str(key)+".html", mode = 'wb') as fout:
           fout.write(item[1].encode('utf8','ignore'))
-        with open(self.screenshot_folder + randomString + "-afterclick-window"+str(key)+"-screenshot.png", mode = 'wb') as fout:
+        with open(self.screenshot_folder + randomString + "-afterclick-window"+str(key)+"-screenshot."+getImageExtension(item[0]), mode = 'wb') as fout:
           fout.write(item[0])   
         with open(self.harFolder+randomString + "-afterclick-window"+str(key)+"-performance.log", mode = 'wb') as fout:
           fout.write(item[4].encode('utf8','ignore'))
@@ -560,6 +1180,11 @@ class LinkFollow:
     # Check if driver and proxy are still able to collect the page
     if(not self.setupScrape()):
       return None
+    self.pageLoadTime = None
+    self.pageLoadTimedOut = False
+    self.dwellEndRule = None
+    self.timings = {}
+    self.harBodies = {}
     
     # Making sure we have time for user action
     if(doUserAction):    
@@ -575,20 +1200,23 @@ class LinkFollow:
 
     # Try maxRetry number of time to collect the page
     for i in range(self.maxRetry):
-      if(self.getPage(url)):
-        self.waitAndMoveMouse(self.fileWaitTimeout)
+      loaded = self.getPage(url)
+      dwellStart = time.time()
+      self.dwellEndRule = self.dwell(self.fileWaitTimeout)
+      self.timings['dwell'] = time.time() - dwellStart
+      if(loaded):
         break
-      self.waitAndMoveMouse(self.fileWaitTimeout)
       
     # Getting the data from scraping should succeed or fail together
     try:
-      screenshotData = self.driver.get_screenshot_as_png()
-      performanceFile = json.dumps(self.filterLog(self.driver.get_log('performance')), ensure_ascii=False)
+      screenshotStart = time.time()
+      screenshotData, screenshotHashes = self.takeScreenshot()
+      self.timings['screenshot'] = time.time() - screenshotStart
+      performanceFile = json.dumps(self.collectPerformanceLog(), ensure_ascii=False)
       
-      if(self.proxy is not None):
-        harFile = self.proxy.getHar()
-      else:
-        harFile = ''
+      harStart = time.time()
+      harFile = self.getHar()
+      self.timings['har_fetch'] = time.time() - harStart
       try:
         html = self.driver.find_element_by_tag_name('html').get_attribute('innerHTML')
         html = '<html>'+html+'</html>'
@@ -605,20 +1233,24 @@ class LinkFollow:
     landingUrl = self.driver.current_url
     # If we got this far and we want to do user action then do it now
     if(doUserAction):
-      if(self.proxy is not None):
-        self.proxy.startHarCollection(url)
+      self.startHarCollection(url)
       perWindowData = self.selectAndClickElement(url)
-      if(self.proxy is not None):
-        harFilSecondary = self.proxy.getHar()
-      else:
-        harFileSecondary = ''
-      secondaryData = {'perWindowData':perWindowData,'har':harFilSecondary}
+      harFileSecondary = self.getHar()
+      self.fillStartUrls(perWindowData, harFileSecondary)
+      secondaryData = {'perWindowData':perWindowData,'har':harFileSecondary}
     else:
       secondaryData = None
 
-    data = (time.time(), url, landingUrl, html, harFile, screenshotData, performanceFile, secondaryData, self.httpProxy)    
     # Fix download file names
-    self.updateDownloadedFileNames(url)  
+    downloads = self.updateDownloadedFileNames(url)  
+    data = (time.time(), url, landingUrl, html, harFile, screenshotData, performanceFile, secondaryData, self.httpProxy,
+            self.dwellEndRule, screenshotHashes, downloads, self.harBodies)    
+    # Nothing of this link follower should keep loading while the others visit pages
+    if(self.sharedBrowser is not None):
+      try:
+        self.sharedBrowser.idleContext(self.contextId, self.windowHandle)
+      except Exception as e:
+        logging.error(traceback.format_exc())
     # Save info to disk    
     if(self.saveToDisk):
       self.saveDataToDisk(data)
@@ -18,7 +18,6 @@ from listSources import ListSources
 from config import Config
 
 from getRedirections import getRedirections
-from getFileHashes import getAndSaveHashesMain
 from imageClustering import getPerceptualHashes, getAndSetMaliciousness
 
     
@@ -124,9 +123,15 @@ class Odin:
   
     # Get link orders
     outputFile = self.runConfig.urlsDirectory + 'targetUrls-'+self.runConfig.day+'.csv'
-    c = self.db.getUncrawledTargets(self.runConfig.day,self.runConfig.experimentName,self.runConfig.scrapeTypes)
-    links = scheduleJobs(self.db,list(c),self.runConfig.day)
-    ids = [x[0] for x in links]
+    # Use the saved crawl plan so the targets are scheduled only once
+    if(self.runConfig.jobQueue == 'database'):
+      Crawler(self.runConfig).createCrawlPlan(self.db,0)
+      ids = self.db.getCrawlPlanTargetIds(self.runConfig.day,self.runConfig.experimentName,0)
+    else:
+      c = self.db.getUncrawledTargets(self.runConfig.day,self.runConfig.experimentName,self.runConfig.scrapeTypes)
+      links = scheduleJobs(self.db,list(c),self.runConfig.day,
+                           self.runConfig.scheduleSpacing,self.runConfig.dnsIntensity)
+      ids = [x[0] for x in links]
   
     # Get links
     targets = {}
@@ -206,6 +211,7 @@ class Odin:
       for s in self.searchCounts:
         searchStats += s[0] + ": " + str(s[1]) + " keyword searches, " + str(s[2]) + " results, " + str(s[3]) + " errors\n"
 
+    crawlStats += "\n" + crawlerInst.getCrawlStats()
     message = "Subject: Odin Update\n\n" + totalStats + "\n\n\n" + searchStats + "\n\n\n" + crawlStats
     message += "\n\n\nScrape success:\n\n"
     message += self.db.getDailyScrapeStats(self.runConfig.day)
@@ -221,8 +227,6 @@ class Odin:
     
     print('Extracting redirections')
     getRedirections(self.runConfig)
-    print('Extracting download hashes')
-    getAndSaveHashesMain(self.runConfig)
     print('Perceptual hashes')
     getPerceptualHashes(self.runConfig)
     print('Set maliciousness based on known bad perceptual hashes')
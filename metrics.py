@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+"""
+Formats the labels of a metric, labels is a tuple of (name, value) pairs
+"""
+def formatLabels(labels):
+
+  if(len(labels) == 0):
+    return ''
+  return '{' + ','.join([x + '="' + str(y).replace('\\', '\\\\').replace('"', '\\"') + '"' for x,y in labels]) + '}'
+
+
+class CrawlMetrics:
+
+
+  """
+  Counters and histograms of a crawl, aggregated by the crawler process from the
+  status messages of the workers and rendered in the Prometheus text format.
+  Stages timed by the histogram: driver_start, page_load, dwell, screenshot,
+  har_fetch and db_insert.
+  """
+  def __init__(self):
+
+    self.lock = threading.Lock()
+    self.startTime = time.time()
+    # name -> {labels: value}
+    self.counters = {}
+    # name -> {labels: [bucket counts, sum, count]}
+    self.histograms = {}
+    self.gauges = {}
+    self.help = {}
+    # Times of the visits of the last minute for the pages per minute gauge
+    self.recentVisits = deque()
+
+
+  def inc(self, name, labels = (), value = 1, help = ''):
+
+    with self.lock:
+      self.help.setdefault(name, help)
+      values = self.counters.setdefault(name, {})
+      values[labels] = values.get(labels, 0) + value
+
+
+  def observe(self, name, value, labels = (), help = ''):
+
+    with self.lock:
+      self.help.setdefault(name, help)
+      values = self.histograms.setdefault(name, {})
+      if(labels not in values):
+        values[labels] = [[0] * len(BUCKETS), 0, 0]
+      histogram = values[labels]
+      for i in range(len(BUCKETS)):
+        if(value <= BUCKETS[i]):
+          histogram[0][i] += 1
+      histogram[1] += value
+      histogram[2] += 1
+
+
+  def setGauge(self, name, value, help = ''):
+
+    with self.lock:
+      self.help.setdefault(name, help)
+      self.gauges[name] = value
+
+
+  """
+  timings is a list of (stage, seconds) pairs
+  """
+  def recordVisit(self, scrapeTypeName, failureType, timings):
+
+    self.inc('odin_pages_visited_total', (('scrape_type', scrapeTypeName),), help = 'Pages visited')
+    if(failureType is not None):
+      self.inc('odin_visit_failures_total', (('type', failureType),), help = 'Failed visits by failure type')
+    for stage, seconds in timings:
+      self.observeStage(stage, seconds)
+    with self.lock:
+      self.recentVisits.append(time.time())
+
+
+  def recordFailure(self, failureType):
+
+    self.inc('odin_visit_failures_total', (('type', failureType),), help = 'Failed visits by failure type')
+
+
+  def observeStage(self, stage, seconds):
+
+    if(seconds is not None):
+      self.observe('odin_stage_seconds', seconds, (('stage', stage),), help = 'Time spent in the stages of a visit')
+
+
+  def getPagesPerMinute(self):
+
+    with self.lock:
+      while(len(self.recentVisits) > 0 and self.recentVisits[0] < time.time() - 60):
+        self.recentVisits.popleft()
+      return len(self.recentVisits) * 60 / min(60, max(1, time.time() - self.startTime))
+
+
+  def render(self):
+
+    self.setGauge('odin_pages_per_minute', self.getPagesPerMinute(), help = 'Pages visited in the last minute')
+    lines = []
+    with self.lock:
+      for name, values in self.counters.items():
+        lines.append('# HELP ' + name + ' ' + self.help[name])
+        lines.append('# TYPE ' + name + ' counter')
+        for labels, value in values.items():
+          lines.append(name + formatLabels(labels) + ' ' + str(value))
+      for name, values in self.histograms.items():
+        lines.append('# HELP ' + name + ' ' + self.help[name])
+        lines.append('# TYPE ' + name + ' histogram')
+        for labels, histogram in values.items():
+          for i in range(len(BUCKETS)):
+            lines.append(name + '_bucket' + formatLabels(labels + (('le', str(BUCKETS[i])),)) + ' ' + str(histogram[0][i]))
+          lines.append(name + '_bucket' + formatLabels(labels + (('le', '+Inf'),)) + ' ' + str(histogram[2]))
+          lines.append(name + '_sum' + formatLabels(labels) + ' ' + str(histogram[1]))
+          lines.append(name + '_count' + formatLabels(labels) + ' ' + str(histogram[2]))
+      for name, value in self.gauges.items():
+        lines.append('# HELP ' + name + ' ' + self.help[name])
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append(name + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+
+
+  """
+  Serves the metrics on http://127.0.0.1:port/metrics from a background thread
+  """
+  def __init__(self, metrics, port):
+
+    class Handler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if(self.path != '/metrics'):
+          self.send_error(404)
+          return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+    self.thread.start()
+    print('Serving crawl metrics on port: ', port)
+
+
+  def stop(self):
+
+    self.server.shutdown()
+    self.server.server_close()
@@ -7,9 +7,10 @@ from datetime import datetime
 from datetime import timezone
 from datetime import timedelta
 import time
-import pickle
 import sys
-from urllib.parse import urlparse, parse_qs, unquote_plus
+import tempfile
+from collections import OrderedDict
+import threading
 
 import mitmproxy
 from mitmproxy import http
@@ -18,25 +19,124 @@ from mitmproxy.net.http.headers import Headers
 from mitmproxy import connections  # noqa
 from mitmproxy import version
 from mitmproxy import ctx
+from mitmproxy import exceptions
 from mitmproxy.utils import strutils
 from mitmproxy.net.http import cookies
 
 from redirectChainExtractor import getUrl
-
-
-HAR: typing.Dict = {}
-URL: typing.Dict = {}
-HEADERS_TO_CHANGE: typing.Dict = {}
-COMMANDS: typing.Dict = {}
+from heavyResources import getSuppressReason
+from bodyStore import extractBody, isBodyCaptured
+import proxyControl
+
+
+"""
+State of one browser, a mitmproxy started for one browser has a single tenant.
+A shared mitmproxy (ODIN_MULTI_TENANT is set) has a tenant for each loopback address
+it gave out, the browser of a tenant connects to the proxy on its address.
+ - har: the HAR without its entries, the entries are appended to the spool file as they complete
+ - url: the url of the collection, with its Url object and host computed once for the requests
+ - spool: bodies of at least bodyMinSize characters are spooled once per collection to their own file
+ - capture: only the bodies of the bodyTypes content types of at most bodyMaxSize bytes are kept
+ - heavy: responses above maxSize bytes or of the heavyTypes MIME classes are not passed to the browser
+"""
+def newTenant():
+
+  return {'har': {}, 'url': {}, 'headers': {}, 'commands': {},
+          'spool': {'file': None, 'path': None, 'bodiesFile': None, 'bodiesPath': None,
+                    'bodyMinSize': 0, 'bodiesSeen': set()},
+          'capture': {'bodyTypes': (), 'bodyMaxSize': 0, 'timezone': timezone.utc},
+          'heavy': {'maxSize': 0, 'heavyTypes': []}}
+
+
+MULTI_TENANT = 'ODIN_MULTI_TENANT' in os.environ
+TENANTS: typing.Dict = {} if MULTI_TENANT else {None: newTenant()}
 # A list of server seen till now is maintained so we can avoid
 # using 'connect' time for entries that use an existing connection.
-SERVERS_SEEN: typing.Set[connections.ServerConnection] = set()
-
-
-def harCollectionSetup(mainUrl):
-
-  URL.update({'url':mainUrl})
-  HAR.update({
+# Only the ids of the most recent connections are kept, so it doesn't grow with the life of the proxy.
+SERVERS_SEEN: typing.Dict[str, bool] = OrderedDict()
+MAX_SERVERS_SEEN = 10000
+# Bytes of the spool read at once when the HAR is built
+HAR_CHUNK_SIZE = 1 << 20
+# The commands come from the threads of the control channel
+LOCK = threading.Lock()
+CONTROL: typing.List = []
+# Index of the next loopback address to give out, see allocateAddress
+NEXT_ADDRESS = 2
+
+
+"""
+Returns the tenant of a flow, None if the address it connected to was not given out
+"""
+def getTenant(flow):
+
+  if(not MULTI_TENANT):
+    return TENANTS[None]
+  try:
+    address = flow.client_conn.connection.getsockname()[0]
+  except (AttributeError, OSError):
+    return None
+  return TENANTS.get(address)
+
+
+"""
+Returns a loopback address that is not used by a tenant, 127.0.0.1 is left to other programs.
+The addresses are given out in turn over 127.0.0.0/8, so the address of a closed tenant is
+only reused after the others. Connections of its browser that are still open would
+otherwise be taken for the new tenant.
+"""
+def allocateAddress():
+
+  global NEXT_ADDRESS
+  while(True):
+    i = NEXT_ADDRESS
+    NEXT_ADDRESS = i + 1 if i < (1 << 24) - 2 else 2
+    if(i % 256 not in [0, 255]):
+      address = '127.' + str(i >> 16 & 255) + '.' + str(i >> 8 & 255) + '.' + str(i & 255)
+      if(address not in TENANTS):
+        return address
+
+
+"""
+Closes the spools of the current collection and returns the paths of the entries
+and of the bodies, None if there was no collection
+"""
+def closeSpool(spool):
+
+  paths = spool['path'], spool['bodiesPath']
+  for key in ['file', 'bodiesFile']:
+    if(spool[key] is not None):
+      spool[key].close()
+  spool.update({'file': None, 'path': None, 'bodiesFile': None, 'bodiesPath': None, 'bodiesSeen': set()})
+  return paths
+
+
+def removeSpool(spool):
+
+  for path in closeSpool(spool):
+    if(path is not None):
+      os.remove(path)
+
+
+def openSpool(name):
+
+  fd, path = tempfile.mkstemp(prefix = name + '-', suffix = '.spool')
+  return os.fdopen(fd, mode = 'w', encoding = 'utf-8', errors = 'surrogatepass'), path
+
+
+def harCollectionSetup(tenant, mainUrl, bodyMinSize, bodyTypes, bodyMaxSize):
+
+  spool = tenant['spool']
+  # A collection that was never retrieved is dropped
+  removeSpool(spool)
+  spool['file'], spool['path'] = openSpool('har')
+  spool['bodiesFile'], spool['bodiesPath'] = openSpool('bodies')
+  spool['bodyMinSize'] = bodyMinSize
+  tenant['capture'].update({'bodyTypes': tuple([x.lower() for x in bodyTypes]), 'bodyMaxSize': bodyMaxSize,
+                            'timezone': timezone(offset=utcOffset())})
+  parsed = getUrl(mainUrl)
+  # The hooks read the url without the lock, it is replaced instead of changed
+  tenant['url'] = {'url':mainUrl, 'parsed':parsed, 'host':(parsed.parts.hostname or '')}
+  tenant['har'] = {
     "log": {
       "version": "1.2",
       "creator": {
@@ -48,64 +148,141 @@ def harCollectionSetup(mainUrl):
         "id": mainUrl, 
         "startedDateTime": datetime.now().replace(tzinfo=timezone(offset=utcOffset())).isoformat(), 
         "title": mainUrl, 
-        "pageTimings": {"comment": ""}, "comment": ""}],
-      "entries": []
-      }})
+        "pageTimings": {"comment": ""}, "comment": ""}]
+      }}
+
+  
+"""
+Joins the spooled entries into the HAR without parsing them, yields the HAR json bytes
+in chunks of at most HAR_CHUNK_SIZE bytes of the spool so it is never read at once
+"""
+def buildHar(log, spoolPath):
+
+  header = json.dumps(log).encode('utf-8')
+  yield b'{"log": ' + header[:-1] + b', "entries": ['
+  try:
+    with open(spoolPath, mode = 'rb') as fin:
+      # Every entry ends with a newline, the last one of a chunk becomes a separator
+      # only if another chunk follows
+      carry = b''
+      for chunk in iter(lambda: fin.read(HAR_CHUNK_SIZE), b''):
+        data = carry + chunk
+        carry = b''
+        if(data.endswith(b'\n')):
+          data = data[:-1]
+          carry = b'\n'
+        yield data.replace(b'\n', b',')
+  finally:
+    os.remove(spoolPath)
+  yield b']}}'
+
+
+def readBodies(bodiesPath):
+
+  with open(bodiesPath, mode = 'rb') as fin:
+    bodies = fin.read()
+  os.remove(bodiesPath)
+  return bodies
+
+
+"""
+Runs a command of the control channel and returns the parts of its response.
+The tenants opened on a connection are closed with it.
+"""
+def handleCommand(command, args, session):
+
+  with LOCK:
+    if(command == proxyControl.PING):
+      return []
+    if(command == proxyControl.OPEN_TENANT):
+      if(not MULTI_TENANT):
+        raise ValueError('The proxy is not shared')
+      address = allocateAddress()
+      TENANTS[address] = newTenant()
+      session.setdefault('tenants', set()).add(address)
+      return [address.encode('utf-8')]
+    if(args.get('tenant') not in TENANTS):
+      raise ValueError('Unknown tenant: ' + str(args.get('tenant')))
+    tenant = TENANTS[args.get('tenant')]
+    if(command == proxyControl.CLOSE_TENANT):
+      closeTenant(args['tenant'])
+      session.get('tenants', set()).discard(args['tenant'])
+    elif(command == proxyControl.START_HAR):
+      harCollectionSetup(tenant, args['url'], args.get('bodyMinSize', 0), args.get('bodyTypes', []),
+                         args.get('bodyMaxSize', 0))
+    elif(command == proxyControl.GET_HAR):
+      spool, bodies = closeSpool(tenant['spool'])
+      log = tenant['har'].get('log')
+      tenant['har'] = {}
+      tenant['url'] = {}
+    # The headers are replaced instead of changed, request reads them without the lock
+    elif(command == proxyControl.ADD_HEADER):
+      tenant['headers'] = dict(tenant['headers'], **{args['header']: args['value']})
+    elif(command == proxyControl.REMOVE_ADD_HEADER):
+      tenant['headers'] = {k: v for k, v in tenant['headers'].items() if k != args['header']}
+    elif(command == proxyControl.REMOVE_RESPONSE):
+      tenant['commands']['removeResponse'] = True
+    elif(command == proxyControl.KEEP_RESPONSE):
+      tenant['commands']['removeResponse'] = False
+    elif(command == proxyControl.SUPPRESS_HEAVY):
+      tenant['heavy']['maxSize'] = args['maxSize']
+      tenant['heavy']['heavyTypes'] = args['heavyTypes']
+    else:
+      raise ValueError('Unknown command: ' + str(command))
+  if(command != proxyControl.GET_HAR):
+    return []
+  # The HAR is sent in its stored form, the files are read outside of the lock
+  chunks = [b'{}'] if spool is None else buildHar(log, spool)
+  if(args.get('compress', False)):
+    # Only the compressed HAR is kept in memory
+    compressor = zlib.compressobj()
+    har = b''.join([compressor.compress(x) for x in chunks] + [compressor.flush()])
+  else:
+    har = b''.join(chunks)
+  return [har, b'' if bodies is None else readBodies(bodies)]
+
+
+def closeTenant(address):
+
+  tenant = TENANTS.pop(address, None)
+  if(tenant is not None):
+    removeSpool(tenant['spool'])
+
+
+"""
+Closes the tenants of a client that disconnected without closing them
+"""
+def closeSession(session):
+
+  with LOCK:
+    for address in session.get('tenants', set()):
+      closeTenant(address)
+
+
+def running():
+
+  if('ODIN_CONTROL_SOCKET' in os.environ):
+    CONTROL.append(proxyControl.ControlServer(os.environ['ODIN_CONTROL_SOCKET'], handleCommand, closeSession))
 
   
 def request(flow):
 
-  global HAR
-  global URL
-  global HEADERS_TO_CHANGE
-  parsedUrl = urlparse(flow.request.url)
-  hostname = parsedUrl.hostname
-  params = parse_qs(parsedUrl.query)
-  # ctx.log.error(hostname)
-  if(hostname == 'startharcollection'):
-    HAR = {}
-    URL = {}
-    harCollectionSetup(unquote_plus(params['url'][0]))
-    resp = http.HTTPResponse.make(200,  b"true",{"Content-Type": "text/html"})
-    flow.response = resp
-  elif(hostname == 'gethar'):
-    hardump = pickle.dumps(HAR)
-    resp = http.HTTPResponse.make(200, hardump, {"Content-Type": "text/html"})
-    flow.response = resp
-    HAR = {}
-    URL = {}
-  elif(hostname == 'addheader'):
-    header = next(iter(params))
-    value = unquote_plus(params[header][0])
-    header = unquote_plus(header)
-    HEADERS_TO_CHANGE[header] = value
-    resp = http.HTTPResponse.make(200,  b"true",{"Content-Type": "text/html"})
-    flow.response = resp
-  elif(hostname == 'removeaddheader'):
-    header = unquote_plus(next(iter(params)))
-    if(header in HEADERS_TO_CHANGE):
-      del HEADERS_TO_CHANGE[header]
-    resp = http.HTTPResponse.make(200,  b"true",{"Content-Type": "text/html"})
-    flow.response = resp
-  elif(hostname == 'removeresponse'):
-    COMMANDS['removeResponse'] = True
-    resp = http.HTTPResponse.make(200,  b"true",{"Content-Type": "text/html"})
-    flow.response = resp
-  elif(hostname == 'keepresponse'):
-    COMMANDS['removeResponse'] = False
-    resp = http.HTTPResponse.make(200,  b"true",{"Content-Type": "text/html"})
-    flow.response = resp
-  # If request is not one of our commands and we already set the url property
-  # flow.request.method == "GET"
-  elif('removeResponse' in COMMANDS and COMMANDS['removeResponse'] 
-       and flow.request.method == "GET"):
+  tenant = getTenant(flow)
+  if(tenant is None):
+    return
+  if(tenant['commands'].get('removeResponse', False) and flow.request.method == "GET"):
     resp = http.HTTPResponse.make(200,b'<html><body>Modified for log collection</body></html>',{"Content-Type": "text/html"})
     flow.response = resp
     flow.response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     flow.response.headers["Pragma"] = "no-cache"
     flow.response.headers["Expires"] = "0"
-  elif('url' in URL and getUrl(flow.request.url) == getUrl(URL['url'])):
-    for header, value in HEADERS_TO_CHANGE.items():
+    return
+  headers = tenant['headers']
+  url = tenant['url']
+  # The url is only parsed for the requests to the host of the collection when there are headers to add
+  if(len(headers) > 0 and 'url' in url and flow.request.host.lower() == url['host']
+     and getUrl(flow.request.url) == url['parsed']):
+    for header, value in headers.items():
       if(header not in flow.request.headers):
         flow.request.headers[header] = value
 
@@ -117,30 +294,86 @@ def utcOffset():
   return utc_offset
 
 
-def response(flow):
+def isIgnored(tenant, flow):
+
+  if(tenant is None or tenant['url'].get('url', '') == ''):
+    return True
+  if(tenant['commands'].get('removeResponse', False) and flow.request.method == "GET"):
+    return True
+  return False
+
+
+def responseheaders(flow):
   """
-  Called when a server response has been received.
+  Called when the headers of a server response have been received, before the body.
+  Heavy responses are recorded in the HAR without a body and the connection is
+  closed, so the browser stops loading them and the body is never read.
   """
-  hostname = urlparse(flow.request.url).hostname
-  if(hostname in ['startharcollection','gethar','addheader','removeaddheader',
-                  'removeresponse','keepresponse']):
+  tenant = getTenant(flow)
+  if(isIgnored(tenant, flow)):
     return
-  if('url' not in URL or URL['url'] == ''):
+  heavy = tenant['heavy']
+  if(heavy['maxSize'] == 0 and len(heavy['heavyTypes']) == 0):
     return
-  if('removeResponse' in COMMANDS and COMMANDS['removeResponse']
-    and flow.request.method == "GET"):
+  contentLength = flow.response.headers.get('Content-Length', '')
+  contentLength = int(contentLength) if contentLength.isdigit() else None
+  reason = getSuppressReason(flow.response.headers.get('Content-Type', ''), contentLength,
+                             heavy['maxSize'], heavy['heavyTypes'])
+  if(reason is not None):
+    addEntry(tenant, flow, reason)
+    flow.kill()
+  elif(contentLength is None and heavy['maxSize'] > 0):
+    # Chunked and streamed responses are only measured while they are read
+    flow.response.stream = limitStream(tenant, flow, heavy['maxSize'])
+
+
+def limitStream(tenant, flow, maxSize):
+  """
+  Returns the stream of a response without a Content-Length. The response is passed
+  to the browser as it is read and added to the HAR when it is complete. Past maxSize
+  bytes it is added to the HAR without a body and the connection is closed.
+  """
+  def stream(chunks):
+    size = 0
+    body = []
+    for chunk in chunks:
+      size += len(chunk)
+      if(size > maxSize):
+        addEntry(tenant, flow, 'size')
+        raise exceptions.HttpException('Response above ' + str(maxSize) + ' bytes suppressed')
+      body.append(chunk)
+      yield chunk
+    flow.response.data.content = b''.join(body)
+    flow.response.timestamp_end = time.time()
+    addEntry(tenant, flow)
+  return stream
+
+
+def response(flow):
+  """
+  Called when a server response has been received, before the body of a streamed response.
+  """
+  tenant = getTenant(flow)
+  if(isIgnored(tenant, flow)):
     return
-    
   flow.response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
   flow.response.headers["Pragma"] = "no-cache"
   flow.response.headers["Expires"] = "0"
-    
+  # A streamed response is added by its stream once it is read
+  if(not callable(flow.response.stream)):
+    addEntry(tenant, flow)
+  
+  
+def addEntry(tenant, flow, suppressed = None):
+  """
+  Adds the HAR entry of a flow, a suppressed response is added without its body
+  """
   # -1 indicates that these values do not apply to current request
   ssl_time = -1/1000
   connect_time = -1/1000
 
   try:
-    if(flow.server_conn and flow.server_conn not in SERVERS_SEEN):
+    if(flow.server_conn and flow.server_conn.id not in SERVERS_SEEN):
       connect_time = (flow.server_conn.timestamp_tcp_setup -
                       flow.server_conn.timestamp_start)
 
@@ -148,16 +381,21 @@ def response(flow):
         ssl_time = (flow.server_conn.timestamp_tls_setup -
                     flow.server_conn.timestamp_tcp_setup)
 
-      SERVERS_SEEN.add(flow.server_conn)
+      SERVERS_SEEN[flow.server_conn.id] = True
+      if(len(SERVERS_SEEN) > MAX_SERVERS_SEEN):
+        SERVERS_SEEN.popitem(last = False)
     # Calculate raw timings from timestamps. DNS timings can not be calculated
     # for lack of a way to measure it. The same goes for HAR blocked.
     # mitmproxy will open a server connection as soon as it receives the host
     # and port from the client connection. So, the time spent waiting is actually
     # spent waiting between request.timestamp_end and response.timestamp_start
     # thus it correlates to HAR wait instead.
+    receive_time = 0
+    if(suppressed is None):
+      receive_time = flow.response.timestamp_end - flow.response.timestamp_start
     timings_raw = {
       'send': flow.request.timestamp_end - flow.request.timestamp_start,
-      'receive': flow.response.timestamp_end - flow.response.timestamp_start,
+      'receive': receive_time,
       'wait': flow.response.timestamp_start - flow.request.timestamp_end,
       'connect': connect_time,
       'ssl': ssl_time,
@@ -170,15 +408,24 @@ def response(flow):
     # Timings set to -1 will be ignored as per spec.
     full_time = sum(v for v in timings.values() if v > -1)
 
-    started_date_time = datetime.fromtimestamp(flow.request.timestamp_start).replace(tzinfo=timezone(offset=utcOffset())).isoformat()
+    capture = tenant['capture']
+    started_date_time = datetime.fromtimestamp(flow.request.timestamp_start, capture['timezone']).isoformat()
 
-    # Response body size and encoding
-    response_body_size = len(flow.response.raw_content)
-    response_body_decoded_size = len(flow.response.content)
+    # Response body size and encoding, the body is only decoded if it is kept
+    mime_type = flow.response.headers.get('Content-Type', '')
+    captured = False
+    if(suppressed is None):
+      response_body_size = len(flow.response.raw_content)
+      captured = isBodyCaptured(mime_type, response_body_size, capture['bodyTypes'], capture['bodyMaxSize'])
+      response_body_decoded_size = len(flow.response.content) if captured else response_body_size
+    else:
+      contentLength = flow.response.headers.get('Content-Length', '')
+      response_body_size = int(contentLength) if contentLength.isdigit() else -1
+      response_body_decoded_size = response_body_size
     response_body_compression = response_body_decoded_size - response_body_size
 
     entry = {
-      "pageref":URL['url'],
+      "pageref":tenant['url'].get('url', ''),
       "startedDateTime": started_date_time,
       "time": full_time,
       "request": {
@@ -200,7 +447,7 @@ def response(flow):
         "content": {
           "size": response_body_size,
           "compression": response_body_compression,
-          "mimeType": flow.response.headers.get('Content-Type', '')
+          "mimeType": mime_type
         },
         "redirectURL": flow.response.headers.get('Location', ''),
         "headersSize": len(str(flow.response.headers)),
@@ -211,7 +458,12 @@ def response(flow):
     }
 
     # Store binary data as base64
-    if(strutils.is_mostly_bin(flow.response.content)):
+    if(suppressed is not None):
+      entry["response"]["content"]["text"] = ""
+      entry["response"]["content"]["comment"] = "suppressed: " + suppressed
+    elif(not captured):
+      entry["response"]["content"]["comment"] = "body not captured"
+    elif(strutils.is_mostly_bin(flow.response.content)):
       entry["response"]["content"]["text"] = base64.b64encode(flow.response.content).decode()
       entry["response"]["content"]["encoding"] = "base64"
     else:
@@ -234,7 +486,16 @@ def response(flow):
   except Exception as e:
     print('Mitmproxy, adding entry to HAR failed: ', e)
   else:
-    HAR["log"]["entries"].append(entry)
+    with LOCK:
+      spool = tenant['spool']
+      if(spool['file'] is None):
+        return
+      bodies = {}
+      bodyRef = extractBody(entry["response"]["content"], spool['bodyMinSize'], bodies)
+      if(bodyRef is not None and bodyRef not in spool['bodiesSeen']):
+        spool['bodiesSeen'].add(bodyRef)
+        spool['bodiesFile'].write(json.dumps({'sha256': bodyRef, 'body': bodies[bodyRef]}) + '\n')
+      spool['file'].write(json.dumps(entry) + '\n')
 
 
 def format_cookies(cookie_list):
@@ -0,0 +1,90 @@
+import os
+import signal
+import time
+
+
+"""
+True if a process of the process group is still running
+"""
+def isProcessGroupAlive(pgid):
+
+  try:
+    os.killpg(pgid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+"""
+Kills every process of a process group, returns False if it had no processes left
+"""
+def killProcessGroup(pgid):
+
+  try:
+    os.killpg(pgid, signal.SIGKILL)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    print('Not allowed to kill process group: ', pgid)
+    return False
+  return True
+
+
+"""
+Waits at most timeout seconds for the given process groups to exit.
+Returns the process groups that are still alive.
+"""
+def waitForProcessGroups(pgids, timeout):
+
+  deadline = time.time() + timeout
+  alive = [x for x in pgids if isProcessGroupAlive(x)]
+  while(len(alive) > 0 and time.time() < deadline):
+    time.sleep(0.2)
+    alive = [x for x in alive if isProcessGroupAlive(x)]
+  return alive
+
+
+"""
+Pid of the X server of a pyvirtualdisplay Display, it has to be taken before the
+display is stopped since stopping removes the lock file. The pid is read from the
+lock file of the display number if the Display doesn't have it.
+"""
+def getDisplayServerPid(display):
+
+  pid = getattr(display, 'pid', None)
+  if(pid is not None):
+    return pid
+  displayNumber = getattr(display, 'display', None)
+  if(displayNumber is None):
+    return None
+  try:
+    with open('/tmp/.X' + str(displayNumber) + '-lock') as fin:
+      return int(fin.read().strip())
+  except (OSError, ValueError):
+    return None
+
+
+"""
+Kills the X server with the given pid if it is still running. The command line of
+the process has to have the display number, so a pid reused by another process
+(or a server of another display) is not touched.
+"""
+def stopDisplayServer(pid, displayNumber):
+
+  try:
+    with open('/proc/' + str(pid) + '/cmdline', 'rb') as fin:
+      args = fin.read().split(b'\0')
+  except OSError:
+    return False
+  if((':' + str(displayNumber)).encode('utf-8') not in args):
+    return False
+  try:
+    os.kill(pid, signal.SIGKILL)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    print('Not allowed to kill X server of display: ', displayNumber)
+    return False
+  return True
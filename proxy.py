@@ -1,100 +1,300 @@
 from subprocess import Popen, PIPE
-from urllib import request as urlrequest
-from urllib.parse import urlencode, quote_plus
-import pickle
+import os
+import socket
+import tempfile
 import time
 import json
+import zlib
+
+import proxyControl
+
+
+"""
+Asks the kernel for a free port by binding to port 0
+"""
+def allocatePort():
+
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(('', 0))
+    return sock.getsockname()[1]
+
 
 class Proxy:
 
 
-  def __init__(self, portBase, httpProxy = None):
+  """
+  A multiTenant mitmproxy is shared by many browsers through ProxyTenant
+  """
+  def __init__(self, httpProxy = None, startTimeout = 10, multiTenant = False):
   
-    self.portBase = portBase
     self.httpProxy = httpProxy
-    self.prefixes = [20000,30000,40000,50000]
+    self.startTimeout = startTimeout
+    self.multiTenant = multiTenant
+    self.tenant = None
+    self.maxAttempts = 4
     self.proc = None
     self.proxyPort = None
     self.proxyUrl = None
+    self.controlPath = None
+    self.control = None
     
-  def startProxy(self):
+    
+  """
+  Starts mitmproxy on a free port. With wait False it returns right after the
+  process was started and retryUntilReady has to be called before using the proxy,
+  so the browser can start while mitmproxy is loading.
+  """
+  def startProxy(self, wait = True):
 
-    # Port prefixes to try in case some of them are used already
-    for prefix in self.prefixes:   
-      self.proxyPort = str(prefix+self.portBase)
-      commands = ['mitmdump', '--ssl-insecure', '-q', '-p', self.proxyPort, '-s', 'mitmInterceptor.py']
-      if(self.httpProxy is not None):
-        commands.extend(['--mode','upstream:'+self.httpProxy])
-      self.proc = Popen(commands)
-      self.proxyUrl = 'localhost:'+self.proxyPort
-      time.sleep(0.01)
-      poll = self.proc.poll()
-      if(poll is not None):
-        print("Failed to start proxy: ", self.proxyPort)
-        self.proc.kill()
-        self.proc = None
-        self.proxyPort = None
-        self.proxyUrl = None
-        time.sleep(1)
+    self.launch()
+    if(not wait):
+      return True
+    return self.retryUntilReady()
+    
+    
+  """
+  Waits until the launched mitmproxy is ready and relaunches it on a new port if it
+  isn't, at most maxAttempts times. A browser started with the old proxyUrl has to
+  be restarted if proxyUrl changed.
+  """
+  def retryUntilReady(self):
+  
+    for i in range(self.maxAttempts):
+      if(i > 0):
+        self.launch()
+      if(self.waitUntilReady()):
+        return True
+      # The port might have been taken by someone else before mitmproxy bound it
+      self.stopProc()
+    print("Proxy couldn't start")
+    return False
+    
+    
+  def launch(self):
+  
+    self.proxyPort = str(allocatePort())
+    commands = ['mitmdump', '--ssl-insecure', '-q', '-p', self.proxyPort, '-s', 'mitmInterceptor.py']
+    if(self.httpProxy is not None):
+      commands.extend(['--mode','upstream:'+self.httpProxy])
+    # The commands go through a Unix domain socket instead of the proxy port
+    self.controlPath = os.path.join(tempfile.gettempdir(), 'odin-proxy-' + self.proxyPort + '.sock')
+    env = dict(os.environ, ODIN_CONTROL_SOCKET = self.controlPath)
+    if(self.multiTenant):
+      env['ODIN_MULTI_TENANT'] = '1'
+    self.proc = Popen(commands, env = env)
+    self.proxyUrl = 'localhost:'+self.proxyPort
+    
+    
+  """
+  Waits until the proxy and its control channel accept connections, returns False
+  if it exited or didn't accept connections in startTimeout seconds
+  """
+  def waitUntilReady(self):
+  
+    deadline = time.time() + self.startTimeout
+    while(time.time() < deadline):
+      if(self.proc.poll() is not None):
+        break
+      try:
+        socket.create_connection(('localhost', int(self.proxyPort)), timeout = 1).close()
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.connect(self.controlPath)
+      except OSError:
+        self.closeControl()
+        time.sleep(0.05)
       else:
         return True
-    print("Proxy couldn't start: " + str(self.portBase))
+    print("Failed to start proxy: ", self.proxyPort)
     return False
     
     
-  def sendCommand(self,command):
+  def closeControl(self):
   
-    req = urlrequest.Request(command)
-    req.set_proxy(self.proxyUrl , 'http')
-    return urlrequest.urlopen(req).read()
+    if(self.control is not None):
+      self.control.close()
+      self.control = None
     
     
-  def sendSimpleCommand(self,command,key,value):
+  def removeControlPath(self):
   
-    if(key is None):
-      response = self.sendCommand('http://'+command+'/').decode()
-    else:
-      params = urlencode({quote_plus(key):quote_plus(value)})  
-      response = self.sendCommand('http://'+command+'/?'+params).decode()
-    if(response != 'true'):
-      print('Command failed: '+ command)
-      return False
-    return True
+    if(self.controlPath is not None and os.path.exists(self.controlPath)):
+      os.remove(self.controlPath)
+    self.controlPath = None
+    
+    
+  def isAlive(self):
+  
+    return self.proc is not None and self.proc.poll() is None
+    
+    
+  def stopProc(self):
+  
+    self.closeControl()
+    self.proc.kill()
+    self.proc.wait()
+    self.removeControlPath()
+    self.proc = None
+    self.proxyPort = None
+    self.proxyUrl = None
+    
+    
+  """
+  Sends a command on the control channel, returns the parts of the response or
+  None if the command failed
+  """
+  def sendCommand(self,command,args = {}):
+  
+    if(self.tenant is not None):
+      args = dict(args, tenant = self.tenant)
+    status, parts = proxyControl.sendRequest(self.control, command, args)
+    if(status != 0):
+      print('Command failed: ' + str(command) + ' ' + b''.join(parts).decode('utf-8', 'replace'))
+      return None
+    return parts
+    
+    
+  def sendSimpleCommand(self,command,args = {}):
+  
+    return self.sendCommand(command, args) is not None
   
     
   def addHeader(self,header,value):
   
-    return self.sendSimpleCommand('addHeader',header,value)
+    return self.sendSimpleCommand(proxyControl.ADD_HEADER, {'header':header, 'value':value})
     
     
   def removeAddHeader(self,header):
   
-    return self.sendSimpleCommand('removeAddHeader',header,'empty')
+    return self.sendSimpleCommand(proxyControl.REMOVE_ADD_HEADER, {'header':header})
     
     
   def removeResponse(self):
   
-    return self.sendSimpleCommand('removeResponse',None,None)
+    return self.sendSimpleCommand(proxyControl.REMOVE_RESPONSE)
     
     
   def keepResponse(self):
   
-    return self.sendSimpleCommand('keepResponse',None,None)
+    return self.sendSimpleCommand(proxyControl.KEEP_RESPONSE)
   
     
-  def startHarCollection(self,url):
+  """
+  Responses above maxSize bytes (0 means no limit) or of the heavyTypes MIME classes
+  are recorded without their body and not passed to the browser
+  """
+  def suppressHeavy(self,maxSize,heavyTypes):
+  
+    return self.sendSimpleCommand(proxyControl.SUPPRESS_HEAVY, {'maxSize':maxSize, 'heavyTypes':list(heavyTypes)})
   
-    return self.sendSimpleCommand('startHarCollection','url',url)
+    
+  """
+  Starts a new HAR, the bodies of at least bodyMinSize characters are returned
+  separately by getHar, 0 keeps them in the HAR. Only the bodies of the bodyTypes
+  content types of at most bodyMaxSize bytes are captured, see bodyStore.isBodyCaptured.
+  """
+  def startHarCollection(self,url,bodyMinSize = 0,bodyTypes = (),bodyMaxSize = 0):
   
+    return self.sendSimpleCommand(proxyControl.START_HAR, {'url':url, 'bodyMinSize':bodyMinSize,
+                                                           'bodyTypes':list(bodyTypes), 'bodyMaxSize':bodyMaxSize})
   
-  def getHar(self):
   
-    response = self.sendCommand('http://getHar/')
-    return json.dumps(pickle.loads(response))
+  """
+  Returns the HAR and the bodies taken out of it by sha256.
+  mitmproxy joins the spooled entries into the HAR bytes once, with compress they
+  are zlib compressed in mitmproxy and returned as bytes to be stored as they are,
+  otherwise the HAR is a json string.
+  """
+  def getHar(self,compress = False):
+  
+    parts = self.sendCommand(proxyControl.GET_HAR, {'compress':compress})
+    if(parts is None):
+      parts = [zlib.compress(b'{}') if compress else b'{}', b'']
+    har, bodiesData = parts
+    bodies = {}
+    for line in bodiesData.decode('utf-8', 'surrogatepass').splitlines():
+      body = json.loads(line)
+      bodies[body['sha256']] = body['body']
+    if(compress):
+      return har, bodies
+    return har.decode('utf-8', 'surrogatepass'), bodies
     
 
   def close(self):
     
-    self.proc.kill()
+    self.closeControl()
+    if(self.proc is not None):
+      self.proc.kill()
+    self.removeControlPath()
+    
+    
+class ProxyTenant(Proxy):
 
-    
\ No newline at end of file
+
+  """
+  The part of a shared mitmproxy used by one browser, with the interface of Proxy.
+  The proxy gives the tenant a loopback address, the browser connects to the proxy
+  on that address and the proxy keeps the HAR, the headers and the commands of
+  each address apart. The tenant has its own control connection, so a worker can
+  use it after fork, and the proxy closes the tenant when the connection closes.
+  Shared proxies are started with one upstream web proxy each, the tenant uses
+  the upstream of the shared proxy it was opened on.
+  """
+  def __init__(self, sharedProxy):
+  
+    super().__init__(sharedProxy.httpProxy, sharedProxy.startTimeout)
+    self.sharedPort = sharedProxy.proxyPort
+    self.sharedControlPath = sharedProxy.controlPath
+    
+    
+  def startProxy(self, wait = True):
+  
+    try:
+      self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.control.connect(self.sharedControlPath)
+      parts = self.sendCommand(proxyControl.OPEN_TENANT)
+    except OSError:
+      parts = None
+    if(parts is None):
+      self.closeControl()
+      print("Proxy tenant couldn't start: ", self.sharedPort)
+      return False
+    self.tenant = parts[0].decode('utf-8')
+    self.proxyPort = self.sharedPort
+    self.proxyUrl = self.tenant + ':' + self.proxyPort
+    return True
+    
+    
+  def waitUntilReady(self):
+  
+    return self.control is not None
+    
+    
+  def retryUntilReady(self):
+  
+    return self.waitUntilReady()
+    
+    
+  def isAlive(self):
+  
+    try:
+      return self.control is not None and proxyControl.sendRequest(self.control, proxyControl.PING, {})[0] == 0
+    except OSError:
+      return False
+    
+    
+  def stopProc(self):
+  
+    self.close()
+    
+    
+  def close(self):
+  
+    try:
+      if(self.control is not None and self.tenant is not None):
+        self.sendCommand(proxyControl.CLOSE_TENANT)
+    except OSError:
+      pass
+    self.closeControl()
+    self.tenant = None
+    self.proxyPort = None
+    self.proxyUrl = None
@@ -0,0 +1,123 @@
+import json
+import os
+import socket
+import struct
+import threading
+
+
+"""
+Control channel of the mitmproxy of a Proxy on a Unix domain socket, so the
+commands don't go through the proxy as HTTP requests.
+A request is the command code (1 byte), the length of the arguments (4 bytes)
+and the arguments as json. A response is the status (1 byte, 0 is ok), the number
+of parts (1 byte) and every part as its length (4 bytes) and its bytes.
+A mitmproxy shared by many browsers has a tenant for each of them, the commands
+of a tenant have its address as the tenant argument.
+"""
+ADD_HEADER = 1
+REMOVE_ADD_HEADER = 2
+REMOVE_RESPONSE = 3
+KEEP_RESPONSE = 4
+START_HAR = 5
+GET_HAR = 6
+SUPPRESS_HEAVY = 7
+OPEN_TENANT = 8
+CLOSE_TENANT = 9
+PING = 10
+
+REQUEST_HEADER = struct.Struct('!BI')
+RESPONSE_HEADER = struct.Struct('!BB')
+PART_HEADER = struct.Struct('!I')
+
+
+def receiveExactly(sock, size):
+
+  data = bytearray()
+  while(len(data) < size):
+    chunk = sock.recv(min(size - len(data), 1 << 20))
+    if(not chunk):
+      raise ConnectionError('Control channel closed')
+    data.extend(chunk)
+  return bytes(data)
+
+
+def sendResponse(sock, status, parts):
+
+  frame = [RESPONSE_HEADER.pack(status, len(parts))]
+  for part in parts:
+    frame.append(PART_HEADER.pack(len(part)))
+    frame.append(part)
+  sock.sendall(b''.join(frame))
+
+
+"""
+Sends a command and returns the status and the parts of the response
+"""
+def sendRequest(sock, command, args):
+
+  payload = json.dumps(args).encode('utf-8')
+  sock.sendall(REQUEST_HEADER.pack(command, len(payload)) + payload)
+  status, numParts = RESPONSE_HEADER.unpack(receiveExactly(sock, RESPONSE_HEADER.size))
+  parts = []
+  for i in range(numParts):
+    size = PART_HEADER.unpack(receiveExactly(sock, PART_HEADER.size))[0]
+    parts.append(receiveExactly(sock, size))
+  return status, parts
+
+
+class ControlServer:
+
+
+  """
+  Serves the control channel from a background thread of mitmproxy.
+  handler(command, args, session) returns the parts of the response, an exception is
+  returned as an error with its message. The session is a dict kept for the
+  connection, closeHandler(session) is called when the client disconnects,
+  also when the client process was killed.
+  """
+  def __init__(self, path, handler, closeHandler = None):
+
+    self.path = path
+    self.handler = handler
+    self.closeHandler = closeHandler
+    if(os.path.exists(path)):
+      os.remove(path)
+    self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.server.bind(path)
+    self.server.listen(4)
+    self.thread = threading.Thread(target = self.serve, daemon = True)
+    self.thread.start()
+
+
+  def serve(self):
+
+    while(True):
+      conn, address = self.server.accept()
+      threading.Thread(target = self.serveConnection, args = (conn,), daemon = True).start()
+
+
+  def serveConnection(self, conn):
+
+    session = {}
+    try:
+      with conn:
+        self.serveSession(conn, session)
+    finally:
+      if(self.closeHandler is not None):
+        self.closeHandler(session)
+
+
+  def serveSession(self, conn, session):
+
+    while(True):
+      try:
+        command, size = REQUEST_HEADER.unpack(receiveExactly(conn, REQUEST_HEADER.size))
+        args = json.loads(receiveExactly(conn, size).decode('utf-8'))
+      except ConnectionError:
+        return
+      try:
+        sendResponse(conn, 0, self.handler(command, args, session))
+      except ConnectionError:
+        return
+      except Exception as e:
+        sendResponse(conn, 1, [str(e).encode('utf-8')])
@@ -119,6 +119,29 @@ def getHtml(entry):
  
 
       
+"""
+Parses a HAR json string and puts back the bodies that were stored separately,
+bodyLoader is a bodyStore.BodyLoader. HARs without body references are unchanged.
+"""
+def loadHar(harJson, bodyLoader = None):
+
+  har = json.loads(harJson)
+  contents = []
+  for entry in har.get('log', {}).get('entries', []):
+    if('_bodyRef' in entry['response']['content']):
+      contents.append(entry['response']['content'])
+  if(len(contents) == 0 or bodyLoader is None):
+    return har
+  bodies = bodyLoader.getBodies(set([x['_bodyRef'] for x in contents]))
+  for content in contents:
+    body = bodies.get(content['_bodyRef'])
+    if(body is not None):
+      content['text'] = body['text']
+      if(body['encoding'] is not None):
+        content['encoding'] = body['encoding']
+  return har
+
+
 """
 Can be used to load HAR and performance log files
 """
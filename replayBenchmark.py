@@ -0,0 +1,114 @@
+import base64
+import json
+import sys
+import time
+
+from mitmproxy import exceptions
+from mitmproxy import http
+from mitmproxy.test import tflow
+
+import mitmInterceptor
+import proxyControl
+
+
+# Headers of the recorded response that don't apply to the replayed body
+SKIPPED_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding']
+
+
+def getHeaders(har, skipped):
+
+  return [(x['name'].encode('utf-8'), x['value'].encode('utf-8')) for x in har['headers']
+          if(not x['name'].startswith(':') and x['name'].lower() not in skipped)]
+
+
+"""
+Body of a HAR response, the bodies that are not in the HAR are replaced by
+spaces of their size
+"""
+def getBody(content):
+
+  if('text' not in content):
+    return b' ' * max(0, content.get('size', 0))
+  if(content.get('encoding') == 'base64'):
+    return base64.b64decode(content['text'])
+  return content['text'].encode('utf-8', 'surrogatepass')
+
+
+"""
+Creates mitmproxy flows of the entries of HAR files, the responses are returned
+separately so they can be added after the request hook like in mitmproxy
+"""
+def loadFlows(harFiles):
+
+  flows = []
+  for harFile in harFiles:
+    with open(harFile, encoding = 'utf-8') as fin:
+      har = json.load(fin)
+    for entry in har.get('log', {}).get('entries', []):
+      request = entry['request']
+      response = entry['response']
+      # Blocked requests never had a response
+      if(response['status'] < 100):
+        continue
+      flow = tflow.tflow()
+      flow.request = http.HTTPRequest.make(request['method'], request['url'], b'', getHeaders(request, []))
+      flows.append((flow, http.HTTPResponse.make(response['status'], getBody(response['content']),
+                                                 getHeaders(response, SKIPPED_HEADERS))))
+  return flows
+
+
+"""
+Runs the flows through the hooks of the interceptor, returns the seconds per flow
+and the size of the HAR
+"""
+def replay(flows, mainUrl, bodyTypes, bodyMaxSize, bodyMinSize):
+
+  mitmInterceptor.handleCommand(proxyControl.START_HAR, {'url': mainUrl, 'bodyMinSize': bodyMinSize,
+                                                         'bodyTypes': bodyTypes, 'bodyMaxSize': bodyMaxSize}, {})
+  start = time.time()
+  for flow, response in flows:
+    mitmInterceptor.request(flow)
+    flow.response = response
+    mitmInterceptor.responseheaders(flow)
+    mitmInterceptor.response(flow)
+    # Like mitmproxy, a streamed body is read after the response hook
+    if(callable(flow.response.stream)):
+      try:
+        for chunk in flow.response.stream([flow.response.content]):
+          pass
+      except exceptions.HttpException:
+        pass
+  duration = time.time() - start
+  har, bodies = mitmInterceptor.handleCommand(proxyControl.GET_HAR, {'compress': True}, {})
+  return duration/max(1, len(flows)), len(har) + len(bodies)
+
+
+"""
+Replays the entries of recorded HAR files through the interceptor, capturing
+every body and with the capture policy of the config, and reports the time a
+flow spends in the hooks. The proxy and the network are not part of the time.
+"""
+def benchmark(configFile, harFiles, repeat = 5):
+
+  from config import Config
+
+  runConfig = Config(configFile)
+  policies = [('every body', [], 0), ('capture policy', runConfig.harBodyTypes, runConfig.harBodyMaxSize)]
+  print('policy, flows, microseconds per flow, compressed HAR bytes')
+  for name, bodyTypes, bodyMaxSize in policies:
+    total = 0
+    for i in range(repeat):
+      # The hooks change the flows, every run gets new ones
+      flows = loadFlows(harFiles)
+      mainUrl = flows[0][0].request.url if len(flows) > 0 else ''
+      perFlow, harSize = replay(flows, mainUrl, bodyTypes, bodyMaxSize, runConfig.harBodyMinSize)
+      total += perFlow
+    print(name, ', ', len(flows), ', ', round(1000000*total/repeat, 1), ', ', harSize)
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 3):
+    print('Usage: python replayBenchmark.py runConfig.txt file.har [file.har ...]')
+    exit()
+  benchmark(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,137 @@
+import sys
+import time
+
+from linkFollow import LinkFollow
+from devtoolsCapture import sendDevtoolsCommand
+
+
+MARKER = 'odin_reset'
+# Async scripts get a callback as their last argument
+INDEXEDDB_SCRIPT = """
+var done = arguments[arguments.length - 1];
+indexedDB.databases().then(function(dbs) { done(dbs.map(function(x) { return x.name; })); },
+                           function() { done([]); });
+"""
+CACHES_SCRIPT = """
+var done = arguments[arguments.length - 1];
+caches.keys().then(done, function() { done([]); });
+"""
+PERMISSION_SCRIPT = """
+var done = arguments[arguments.length - 1];
+navigator.permissions.query({name: 'geolocation'}).then(function(x) { done(x.state); },
+                                                         function() { done('error'); });
+"""
+SERVICE_WORKER_SCRIPT = """
+var done = arguments[arguments.length - 1];
+if(!navigator.serviceWorker) { done(0); }
+else { navigator.serviceWorker.getRegistrations().then(function(x) { done(x.length); },
+                                                       function() { done(0); }); }
+"""
+
+
+"""
+Visits the url and leaves state behind in every place the reset should clear.
+Returns the number of service workers the page registered itself.
+"""
+def plantState(linkFollower, url):
+
+  driver = linkFollower.driver
+  driver.get(url)
+  driver.add_cookie({'name':MARKER, 'value':'1'})
+  driver.execute_script("window.localStorage.setItem('" + MARKER + "', '1');")
+  driver.execute_script("window.sessionStorage.setItem('" + MARKER + "', '1');")
+  driver.execute_script("indexedDB.open('" + MARKER + "', 1);")
+  driver.execute_async_script("var done = arguments[arguments.length - 1];"
+                              "caches.open('" + MARKER + "').then(function() { done(); }, function() { done(); });")
+  origin = driver.execute_script("return window.location.origin;")
+  sendDevtoolsCommand(driver, 'Browser.grantPermissions', {'origin':origin, 'permissions':['geolocation']})
+  driver.execute_script("window.open('" + url + "');")
+  time.sleep(2)
+  return driver.execute_async_script(SERVICE_WORKER_SCRIPT)
+
+
+"""
+Visits the url again after a reset and returns what survived the reset
+"""
+def checkState(linkFollower, url, serviceWorkers):
+
+  driver = linkFollower.driver
+  leftovers = []
+  if(len(linkFollower.getWindowHandles()) > 1):
+    leftovers.append('windows')
+  driver.get(url)
+  # A navigation served from the cache transfers nothing
+  if(driver.execute_script("return performance.getEntriesByType('navigation')[0].transferSize === 0;")):
+    leftovers.append('http cache')
+  if(MARKER in [x['name'] for x in driver.get_cookies()]):
+    leftovers.append('cookies')
+  if(driver.execute_script("return window.localStorage.getItem('" + MARKER + "');") is not None):
+    leftovers.append('localStorage')
+  if(driver.execute_script("return window.sessionStorage.getItem('" + MARKER + "');") is not None):
+    leftovers.append('sessionStorage')
+  if(MARKER in driver.execute_async_script(INDEXEDDB_SCRIPT)):
+    leftovers.append('IndexedDB')
+  if(MARKER in driver.execute_async_script(CACHES_SCRIPT)):
+    leftovers.append('cache storage')
+  if(driver.execute_async_script(PERMISSION_SCRIPT) == 'granted'):
+    leftovers.append('permissions')
+  # The page registers its service workers again when it loads, so only more than that is a leftover
+  if(driver.execute_async_script(SERVICE_WORKER_SCRIPT) > serviceWorkers):
+    leftovers.append('service workers')
+  return leftovers
+
+
+"""
+Checks the full reset of one scrape type on the url, then compares the time of
+resetting the browser with the time of restarting it, which is what a low
+requestPerDriver pays for on nearly every target.
+"""
+def benchmark(configFile, url, repeat = 5):
+
+  from pyvirtualdisplay import Display
+  from config import Config
+
+  runConfig = Config(configFile)
+  # The reset is measured on its own, without a proxy
+  runConfig.networkCapture = 'devtools'
+  runConfig.fullReset = True
+  scrapeType = dict(runConfig.scrapeTypes[0], ref = False)
+  display = Display(visible = 0, size = (1280, 768))
+  display.start()
+  linkFollower = LinkFollow(0, runConfig, scrapeType, None)
+  serviceWorkers = plantState(linkFollower, url)
+  # The origins of the visited frames are collected from the performance log
+  linkFollower.drainPerformanceLog()
+  linkFollower.resetState()
+  leftovers = checkState(linkFollower, url, serviceWorkers)
+  print('state left after reset: ', leftovers if len(leftovers) > 0 else 'none', flush=True)
+
+  resetTime = 0
+  for i in range(repeat):
+    linkFollower.driver.get(url)
+    linkFollower.drainPerformanceLog()
+    start = time.time()
+    linkFollower.resetState()
+    resetTime += time.time() - start
+  linkFollower.driver.quit()
+  restartTime = 0
+  for i in range(repeat):
+    start = time.time()
+    linkFollower = LinkFollow(0, runConfig, scrapeType, None)
+    restartTime += time.time() - start
+    linkFollower.driver.get(url)
+    linkFollower.driver.quit()
+  print('reset, seconds: ', round(resetTime/repeat, 2))
+  print('restart, seconds: ', round(restartTime/repeat, 2))
+  display.stop()
+  # Exit with an error if the reset is not complete so scripts can check it
+  if(len(leftovers) > 0):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 3):
+    print('Usage: python resetCheck.py runConfig.txt url [repeat]')
+    exit()
+  benchmark(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 5)
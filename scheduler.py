@@ -0,0 +1,170 @@
+import heapq
+import random
+import time
+import sys
+
+
+"""
+Orders jobs so that every group is spread evenly over the whole schedule and jobs
+sharing a spacing value are at least a minimum distance apart.
+
+ - groups: the group of each job (aligned with jobs). The jobs of a group are
+   shuffled and spread evenly, like a round robin weighted by the group sizes.
+ - constraints: list of (values, distance) pairs. values is aligned with jobs and
+   two jobs with the same value (None means no value) should be at least
+   distance positions apart.
+
+The groups are kept in two heaps: the groups whose next job satisfies every
+constraint ordered by how far behind their even share they are, and the groups
+that have to wait ordered by the position they become eligible. Constraints are
+only re-checked when a group reaches the top of a heap, so scheduling takes
+O(n log g) time as long as a placed job delays few other groups.
+If no job satisfies every constraint the one that becomes eligible first is
+placed and counted as a violation.
+
+Returns the ordered jobs and the number of violations.
+"""
+def interleaveJobs(jobs, groups, constraints, seed = 0):
+
+  rnd = random.Random(seed)
+  bucketIds = {}
+  buckets = []
+  for i in range(len(jobs)):
+    bucketId = bucketIds.get(groups[i])
+    if(bucketId is None):
+      bucketId = len(buckets)
+      bucketIds[groups[i]] = bucketId
+      buckets.append([])
+    buckets[bucketId].append(i)
+  for bucket in buckets:
+    rnd.shuffle(bucket)
+  # Random offsets so the first jobs of all groups don't compete for the beginning
+  offsets = [rnd.random() for x in buckets]
+  heads = [0] * len(buckets)
+  lastPositions = [{} for x in constraints]
+
+  def priority(b):
+    return (heads[b] + offsets[b]) / len(buckets[b])
+
+  def eligibleAt(b):
+    j = buckets[b][heads[b]]
+    eligible = 0
+    for k in range(len(constraints)):
+      value = constraints[k][0][j]
+      if(value is not None):
+        last = lastPositions[k].get(value)
+        if(last is not None and last + constraints[k][1] > eligible):
+          eligible = last + constraints[k][1]
+    return eligible
+
+  ready = [(priority(b), b) for b in range(len(buckets))]
+  heapq.heapify(ready)
+  waiting = []
+  order = []
+  violations = 0
+  for pos in range(len(jobs)):
+    while(len(waiting) > 0 and waiting[0][0] <= pos):
+      e, b = heapq.heappop(waiting)
+      heapq.heappush(ready, (priority(b), b))
+    chosen = None
+    while(len(ready) > 0):
+      p, b = heapq.heappop(ready)
+      e = eligibleAt(b)
+      if(e <= pos):
+        chosen = b
+        break
+      heapq.heappush(waiting, (e, b))
+    # No job satisfies every constraint, take the one closest to being eligible
+    while(chosen is None):
+      e, b = heapq.heappop(waiting)
+      eNew = eligibleAt(b)
+      if(eNew > e):
+        heapq.heappush(waiting, (eNew, b))
+      else:
+        chosen = b
+        violations += 1
+    j = buckets[chosen][heads[chosen]]
+    order.append(jobs[j])
+    for k in range(len(constraints)):
+      value = constraints[k][0][j]
+      if(value is not None):
+        lastPositions[k][value] = pos
+    heads[chosen] += 1
+    if(heads[chosen] < len(buckets[chosen])):
+      heapq.heappush(ready, (priority(chosen), chosen))
+  return order, violations
+
+
+"""
+Minimum distance between two jobs with the same value for every constraint
+"""
+def getMinDistances(order, keyOf):
+
+  minDistances = {}
+  for k, key in keyOf.items():
+    lastPositions = {}
+    minDistance = None
+    for pos in range(len(order)):
+      value = key(order[pos])
+      if(value is None):
+        continue
+      if(value in lastPositions):
+        distance = pos - lastPositions[value]
+        if(minDistance is None or distance < minDistance):
+          minDistance = distance
+      lastPositions[value] = pos
+    minDistances[k] = minDistance
+  return minDistances
+
+
+"""
+Synthetic jobs similar to a daily crawl: most jobs are typo domains on name servers
+with a long tailed size distribution, the rest are pharma/copyright/list targets.
+Each job is (id, target_type, nameServer, registeredDomain, ip).
+"""
+def getSyntheticJobs(numJobs, seed = 0):
+
+  rnd = random.Random(seed)
+  numNameServers = max(1, int(numJobs / 40))
+  numIps = max(1, int(numJobs / 10))
+  otherTypes = ['pharma','copyright','phishTank','alexa']
+  jobs = []
+  for i in range(numJobs):
+    if(rnd.random() < 0.9):
+      ns = 'ns' + str(int(numNameServers * rnd.paretovariate(1.2)) % numNameServers) + '.example'
+      jobs.append((i, 'typosquatting', ns, 'typo' + str(i) + '.com', 'ip' + str(rnd.randrange(numIps))))
+    else:
+      domain = 'site' + str(rnd.randrange(int(numJobs / 20) + 1)) + '.com'
+      jobs.append((i, rnd.choice(otherTypes), None, domain, 'ip' + str(rnd.randrange(numIps))))
+  return jobs
+
+
+"""
+Schedules synthetic jobs of increasing sizes and reports the time per job,
+which should stay roughly constant as the number of jobs grows.
+"""
+def benchmark(sizes):
+
+  print('jobs, seconds, microseconds per job, violations, min distance (nameServer, registeredDomain, ip)')
+  for size in sizes:
+    jobs = getSyntheticJobs(size)
+    groups = [x[2] if x[2] is not None else x[1] for x in jobs]
+    constraints = [([x[2] for x in jobs], 50),
+                   ([x[3] for x in jobs], 20),
+                   ([x[4] for x in jobs], 5)]
+    start = time.time()
+    order, violations = interleaveJobs(jobs, groups, constraints, seed = size)
+    took = time.time() - start
+    minDistances = getMinDistances(order, {'nameServer':lambda x: x[2],
+                                           'registeredDomain':lambda x: x[3],
+                                           'ip':lambda x: x[4]})
+    print(size, round(took,2), round(took*1000000/size,2), violations,
+          minDistances['nameServer'], minDistances['registeredDomain'], minDistances['ip'], flush=True)
+
+
+if __name__ == '__main__':
+
+  sizes = [10000, 100000, 1000000, 3000000]
+  if(len(sys.argv) > 1):
+    sizes = [int(x) for x in sys.argv[1:]]
+  benchmark(sizes)
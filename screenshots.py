@@ -0,0 +1,73 @@
+import io
+
+import dhash
+from PIL import Image
+
+
+EXTENSIONS = {'png':'png', 'webp':'webp', 'jpeg':'jpg'}
+
+
+"""
+Average hash of an image in the same hex format as dhash.format_hex
+"""
+def averageHash(image, size = 8):
+
+  pixels = list(image.convert('L').resize((size, size), Image.LANCZOS).getdata())
+  mean = sum(pixels) / len(pixels)
+  value = 0
+  for pixel in pixels:
+    value = (value << 1) | (1 if pixel > mean else 0)
+  return '{:0{}x}'.format(value, size*size//4)
+
+
+def getHashes(image, hashTypes):
+
+  hashes = {}
+  for hashType in hashTypes:
+    if(hashType == 'dhash'):
+      r, c = dhash.dhash_row_col(image)
+      hashes[hashType] = dhash.format_hex(r, c)
+    elif(hashType == 'ahash'):
+      hashes[hashType] = averageHash(image)
+  return hashes
+
+
+"""
+File extension of a stored screenshot
+"""
+def getImageExtension(data):
+
+  if(data[:4] == b'RIFF' and data[8:12] == b'WEBP'):
+    return 'webp'
+  if(data[:3] == b'\xff\xd8\xff'):
+    return 'jpg'
+  return 'png'
+
+
+"""
+Hashes a png screenshot while it is in memory and converts it to the stored format.
+The image is decoded once and the hashes are computed from the full resolution image,
+so they match the ones imageClustering computed from the stored pngs.
+Returns the bytes to store and the hashes by hash type.
+ - screenshotFormat: png, webp or jpeg
+ - screenshotQuality: quality of webp and jpeg
+ - screenshotMaxWidth: wider screenshots are downscaled, 0 keeps the size
+"""
+def processScreenshot(png, runConfig):
+
+  image = Image.open(io.BytesIO(png))
+  hashes = getHashes(image, runConfig.screenshotHashes)
+  if(runConfig.screenshotFormat == 'png' and
+     (runConfig.screenshotMaxWidth == 0 or image.width <= runConfig.screenshotMaxWidth)):
+    return png, hashes
+  if(runConfig.screenshotMaxWidth > 0 and image.width > runConfig.screenshotMaxWidth):
+    height = max(1, int(image.height * runConfig.screenshotMaxWidth / image.width))
+    image = image.resize((runConfig.screenshotMaxWidth, height), Image.LANCZOS)
+  out = io.BytesIO()
+  if(runConfig.screenshotFormat == 'jpeg'):
+    image.convert('RGB').save(out, format = 'JPEG', quality = runConfig.screenshotQuality)
+  elif(runConfig.screenshotFormat == 'webp'):
+    image.save(out, format = 'WEBP', quality = runConfig.screenshotQuality)
+  else:
+    image.save(out, format = 'PNG', optimize = True)
+  return out.getvalue(), hashes
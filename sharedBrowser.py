@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+
+from linkFollow import LinkFollow
+from devtoolsCapture import sendDevtoolsCommand, getMemoryMb, getGroupProcesses
+
+
+class SharedBrowser:
+
+
+  """
+  One Chrome shared by the link followers of a worker instead of one Chrome per
+  scrape type. Each link follower gets its own browser context, so cookies, cache
+  and storage are not shared between the scrape types, and the user agent and
+  device metrics of the scrape type are set on its windows through DevTools.
+  The link followers have to visit pages one after the other, which the workers do.
+  The browser itself is started by a host link follower that doesn't visit pages.
+  """
+  def __init__(self, id, runConfig, proxy, httpProxy = None):
+
+    scrapeType = {'name':'shared', 'ua':runConfig.scrapeTypes[0]['ua'], 'ref':False,
+                  'browser':'chrome', 'mobile':False}
+    self.host = LinkFollow(id, runConfig, scrapeType, proxy, httpProxy)
+    self.driver = self.host.driver
+    self.current = None
+
+
+  """
+  Creates a browser context with one window whose downloads go to downloadFolder,
+  returns the context id and the window handle
+  """
+  def createContext(self, downloadFolder):
+
+    contextId = sendDevtoolsCommand(self.driver, 'Target.createBrowserContext')['browserContextId']
+    # Without it the downloads of every context go to the folder of the host
+    sendDevtoolsCommand(self.driver, 'Browser.setDownloadBehavior',
+                        {'behavior':'allow', 'browserContextId':contextId, 'downloadPath':downloadFolder})
+    targetId = sendDevtoolsCommand(self.driver, 'Target.createTarget',
+                                   {'url':'about:blank', 'browserContextId':contextId})['targetId']
+    return contextId, self.getHandle(targetId)
+
+
+  """
+  Window handle of a target, chromedriver handles end with the target id
+  """
+  def getHandle(self, targetId):
+
+    for handle in self.driver.window_handles:
+      if(handle.endswith(targetId)):
+        return handle
+    return None
+
+
+  """
+  Window handles of the pages of a browser context
+  """
+  def getContextHandles(self, contextId):
+
+    targets = sendDevtoolsCommand(self.driver, 'Target.getTargets')['targetInfos']
+    targetIds = [x['targetId'] for x in targets if x['type'] == 'page' and x.get('browserContextId') == contextId]
+    return [x for x in self.driver.window_handles if any([x.endswith(y) for y in targetIds])]
+
+
+  def activate(self, handle):
+
+    if(self.current != handle):
+      self.driver.switch_to.window(handle)
+      self.current = handle
+
+
+  """
+  Closes the windows of a context except its main window and leaves the main
+  window on a blank page, so nothing keeps loading while other contexts visit pages
+  """
+  def idleContext(self, contextId, mainHandle):
+
+    for handle in self.getContextHandles(contextId):
+      if(handle != mainHandle):
+        self.driver.switch_to.window(handle)
+        self.driver.close()
+    self.current = None
+    self.activate(mainHandle)
+    self.driver.get('about:blank')
+
+
+  def quit(self):
+
+    self.driver.quit()
+
+
+"""
+Checks that the link followers of a shared browser don't see each other's cookies,
+storage and cache. Each link follower visits the url and stores a marker, then every
+link follower checks for the markers of the others.
+Returns the list of leaks found as (link follower, leaked from, kind).
+"""
+def checkIsolation(linkFollowers, url):
+
+  leaks = []
+  # A navigation served from the cache transfers nothing
+  cachedScript = "return performance.getEntriesByType('navigation')[0].transferSize === 0;"
+  for linkFollower in linkFollowers:
+    linkFollower.activate()
+    linkFollower.driver.get(url)
+    # Only the first link follower visited the url before, so the others can't have it cached
+    if(linkFollower is not linkFollowers[0] and linkFollower.driver.execute_script(cachedScript)):
+      leaks.append((linkFollower.name, linkFollowers[0].name, 'cache'))
+    marker = 'odin_' + linkFollower.name
+    linkFollower.driver.add_cookie({'name':marker, 'value':'1'})
+    linkFollower.driver.execute_script("window.localStorage.setItem('" + marker + "', '1');")
+    linkFollower.driver.execute_script("window.sessionStorage.setItem('" + marker + "', '1');")
+  for linkFollower in linkFollowers:
+    linkFollower.activate()
+    cookies = set([x['name'] for x in linkFollower.driver.get_cookies()])
+    for other in linkFollowers:
+      if(other is linkFollower):
+        continue
+      marker = 'odin_' + other.name
+      if(marker in cookies):
+        leaks.append((linkFollower.name, other.name, 'cookie'))
+      if(linkFollower.driver.execute_script("return window.localStorage.getItem('" + marker + "');") is not None):
+        leaks.append((linkFollower.name, other.name, 'localStorage'))
+      if(linkFollower.driver.execute_script("return window.sessionStorage.getItem('" + marker + "');") is not None):
+        leaks.append((linkFollower.name, other.name, 'sessionStorage'))
+  return leaks
+
+
+"""
+Starts the link followers of one worker with one Chrome per scrape type and with
+a shared Chrome, reports the processes and memory of both and checks that the
+scrape types of the shared Chrome are isolated.
+"""
+def measure(configFile, url):
+
+  from pyvirtualdisplay import Display
+  from config import Config
+
+  os.setpgid(0, 0)
+  runConfig = Config(configFile)
+  # Without proxies only the browsers are measured
+  runConfig.networkCapture = 'devtools'
+  scrapeTypes = [dict(x, ref = False) for x in runConfig.scrapeTypes]
+  display = Display(visible = 0, size = (1280, 768))
+  display.start()
+  print('mode, processes, memory MB')
+  linkFollowers = [LinkFollow(0, runConfig, x, None) for x in scrapeTypes]
+  for linkFollower in linkFollowers:
+    linkFollower.followLink(url)
+  pids = getGroupProcesses()
+  print('browser per scrape type', len(pids), round(getMemoryMb(pids)), flush=True)
+  for linkFollower in linkFollowers:
+    linkFollower.driver.quit()
+  time.sleep(2)
+
+  sharedBrowser = SharedBrowser(0, runConfig, None)
+  linkFollowers = [LinkFollow(0, runConfig, x, None, sharedBrowser = sharedBrowser) for x in scrapeTypes]
+  for linkFollower in linkFollowers:
+    linkFollower.followLink(url)
+  pids = getGroupProcesses()
+  print('shared browser', len(pids), round(getMemoryMb(pids)), flush=True)
+  leaks = checkIsolation(linkFollowers, url)
+  print('isolation leaks: ', leaks if len(leaks) > 0 else 'none')
+  sharedBrowser.quit()
+  display.stop()
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 3):
+    print('Usage: python sharedBrowser.py runConfig.txt url')
+    exit()
+  measure(sys.argv[1], sys.argv[2])
@@ -0,0 +1,171 @@
+import json
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+
+import proxyControl
+from proxy import Proxy, ProxyTenant
+from devtoolsCapture import getMemoryMb
+
+
+"""
+Answers every GET with the Referer header it received, so a check can see which
+headers the proxy added
+"""
+class EchoHandler(BaseHTTPRequestHandler):
+
+
+  def do_GET(self):
+
+    body = json.dumps({'path': self.path, 'referer': self.headers.get('Referer')}).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def log_message(self, format, *args):
+
+    pass
+
+
+def startEchoServer():
+
+  server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+  threading.Thread(target = server.serve_forever, daemon = True).start()
+  return server
+
+
+def fetch(proxy, url):
+
+  opener = urlrequest.build_opener(urlrequest.ProxyHandler({'http': 'http://' + proxy.proxyUrl}))
+  return opener.open(url, timeout = 10).read()
+
+
+def getHarUrls(proxy):
+
+  har = json.loads(proxy.getHar()[0])
+  return [x['request']['url'] for x in har.get('log', {}).get('entries', [])]
+
+
+"""
+Gives two tenants of the shared proxy different HARs, headers and commands and
+returns what leaked from one tenant to the other
+"""
+def checkIsolation(sharedProxy, baseUrl):
+
+  problems = []
+  tenantA = ProxyTenant(sharedProxy)
+  tenantB = ProxyTenant(sharedProxy)
+  if(not tenantA.startProxy() or not tenantB.startProxy()):
+    return ['tenants could not be opened']
+  urlA = baseUrl + '/a'
+  urlB = baseUrl + '/b'
+  tenantA.startHarCollection(urlA)
+  tenantB.startHarCollection(urlB)
+  tenantA.addHeader('Referer', 'http://tenant-a/')
+  tenantB.removeResponse()
+  if(json.loads(fetch(tenantA, urlA))['referer'] != 'http://tenant-a/'):
+    problems.append('header of tenant a not added')
+  if(b'Modified for log collection' not in fetch(tenantB, urlB)):
+    problems.append('removeResponse of tenant b not applied')
+  tenantB.keepResponse()
+  if(json.loads(fetch(tenantB, urlB))['referer'] is not None):
+    problems.append('header of tenant a added for tenant b')
+  if(getHarUrls(tenantA) != [urlA]):
+    problems.append('HAR of tenant a has the requests of other tenants')
+  if(getHarUrls(tenantB) != [urlB]):
+    problems.append('HAR of tenant b has the requests of other tenants')
+  tenantA.close()
+  tenantB.close()
+
+  # A worker that is killed doesn't close its tenant, the proxy closes it with the connection
+  tenantC = ProxyTenant(sharedProxy)
+  tenantC.startProxy()
+  address = tenantC.tenant
+  tenantC.closeControl()
+  time.sleep(0.5)
+  tenantD = ProxyTenant(sharedProxy)
+  tenantD.startProxy()
+  # The proxy answers the commands of a tenant it closed with an error
+  if(proxyControl.sendRequest(tenantD.control, proxyControl.KEEP_RESPONSE, {'tenant': address})[0] == 0):
+    problems.append('tenant of a closed connection not closed')
+  if(tenantD.tenant == address):
+    problems.append('address of a closed tenant given out again right away')
+  tenantD.close()
+  return problems
+
+
+"""
+Compares the processes and memory of numBrowsers mitmproxies with one shared
+mitmproxy with numBrowsers tenants, after each browser made one request
+"""
+def compareMemory(startTimeout, baseUrl, numBrowsers):
+
+  proxies = []
+  for i in range(numBrowsers):
+    proxy = Proxy(None, startTimeout)
+    proxy.startProxy()
+    proxies.append(proxy)
+  for proxy in proxies:
+    proxy.startHarCollection(baseUrl)
+    fetch(proxy, baseUrl)
+    proxy.getHar()
+  separateMemory = getMemoryMb([x.proc.pid for x in proxies])
+  for proxy in proxies:
+    proxy.close()
+
+  sharedProxy = Proxy(None, startTimeout, multiTenant = True)
+  sharedProxy.startProxy()
+  tenants = []
+  for i in range(numBrowsers):
+    tenant = ProxyTenant(sharedProxy)
+    tenant.startProxy()
+    tenant.startHarCollection(baseUrl)
+    fetch(tenant, baseUrl)
+    tenant.getHar()
+    tenants.append(tenant)
+  sharedMemory = getMemoryMb([sharedProxy.proc.pid])
+  for tenant in tenants:
+    tenant.close()
+  sharedProxy.close()
+  print('mode, processes, memory MB')
+  print('separate, ', numBrowsers, ', ', round(separateMemory, 1))
+  print('shared, ', 1, ', ', round(sharedMemory, 1))
+
+
+"""
+Checks the isolation of the tenants of a shared mitmproxy, then compares its
+memory with a mitmproxy for each browser
+"""
+def benchmark(configFile, numBrowsers = 10):
+
+  from config import Config
+
+  runConfig = Config(configFile)
+  server = startEchoServer()
+  baseUrl = 'http://127.0.0.1:' + str(server.server_address[1])
+  sharedProxy = Proxy(None, runConfig.proxyStartTimeout, multiTenant = True)
+  if(not sharedProxy.startProxy()):
+    sys.exit(1)
+  try:
+    problems = checkIsolation(sharedProxy, baseUrl)
+  finally:
+    sharedProxy.close()
+  print('tenant isolation problems: ', problems if len(problems) > 0 else 'none', flush=True)
+  compareMemory(runConfig.proxyStartTimeout, baseUrl, numBrowsers)
+  server.shutdown()
+  # Exit with an error if the tenants are not isolated so scripts can check it
+  if(len(problems) > 0):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+
+  if(len(sys.argv) < 2):
+    print('Usage: python tenantCheck.py runConfig.txt [numBrowsers]')
+    exit()
+  benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10)
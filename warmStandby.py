@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+class WarmStandby:
+
+
+  """
+  Starts the next browser and proxy (or set of them) in a background thread while the
+  current one is in use, so swapping to a fresh one doesn't wait for the start.
+   - start(generation) returns the started item or None if it couldn't be started
+   - stop(item) stops an item
+  """
+  def __init__(self, start, stop):
+
+    self.start = start
+    self.stop = stop
+    self.thread = None
+    self.item = None
+    self.swapTime = 0
+
+
+  """
+  Starts preparing the item of the given generation. The previous item is stopped first
+  in the same background thread.
+  swapTime is the time a synchronous swap would have taken (stop, wait and start).
+  """
+  def prepare(self, generation, previous = None):
+
+    def run():
+      swapStart = time.time()
+      if(previous is not None):
+        self.stop(previous)
+      self.item = self.start(generation)
+      # The synchronous swap also waited a second between the stop and the start
+      self.swapTime = time.time() - swapStart + 1
+
+    self.item = None
+    self.thread = threading.Thread(target = run, daemon = True)
+    self.thread.start()
+
+
+  """
+  Returns the prepared item, the time a synchronous swap would have taken and
+  the time spent waiting for the item to be ready.
+  """
+  def take(self):
+
+    waitStart = time.time()
+    self.thread.join()
+    self.thread = None
+    return self.item, self.swapTime, time.time() - waitStart
+
+
+  """
+  Stops the prepared item if there is one
+  """
+  def discard(self):
+
+    if(self.thread is None):
+      return
+    item, swapTime, waitTime = self.take()
+    if(item is not None):
+      self.stop(item)